@@ -0,0 +1,279 @@
+"""Paginated, filtered listings of admin models.
+
+GET /admin/api/<model_name> and the model editor take:
+
+- limit: rows per page (ADMIN_PAGE_SIZE by default, at most
+  ADMIN_MAX_PAGE_SIZE),
+- cursor: the X-Next-Cursor of the previous page. Pages are read with keyset
+  pagination (WHERE (sort, id) > cursor), so a deep page costs the same as
+  the first,
+- sort: an indexed column, prefixed with '-' for descending (default: the
+  primary key). A later column of a composite index is sortable once the
+  columns before it are filtered by equality, e.g. SensorData
+  ?device_id=x&sort=-timestamp. Rows whose sort column is NULL are skipped,
+- <column>=value or <column>__<op>=value filters, op one of ne, gt, gte, lt,
+  lte or in (comma-separated values). On the sharded tables only indexed
+  columns can be filtered,
+- fields: comma-separated columns to return instead of to_dict(),
+- count: 'estimate' (default), 'exact' or 'none'. An estimate counts up to
+  ADMIN_COUNT_LIMIT matching rows; beyond that an unfiltered table reports
+  its table_stats row count (or the range of its primary key), and a
+  filtered one reports the limit as a lower bound.
+
+Credential columns (PROTECTED_COLUMNS, and any column named like a password
+or secret) can't be filtered, sorted or projected.
+"""
+import json
+import base64
+import heapq
+import operator
+from datetime import datetime, date
+
+from sqlalchemy import select, func, and_, or_, literal, UniqueConstraint
+
+import sharding
+import table_stats
+
+FILTER_OPERATORS = {
+    'eq': operator.eq, 'ne': operator.ne, 'gt': operator.gt, 'gte': operator.ge,
+    'lt': operator.lt, 'lte': operator.le,
+}
+# Query string arguments that are not column filters
+RESERVED_ARGS = {'limit', 'cursor', 'sort', 'fields', 'count', 'access_token'}
+COUNT_MODES = {'estimate', 'exact', 'none'}
+# Columns never filtered, sorted or returned by fields=, per table
+PROTECTED_COLUMNS = {
+    'users': {'password_hash', 'access_token'},
+}
+PROTECTED_NAME_PARTS = ('password', 'secret')
+
+
+class ListingError(ValueError):
+    """Raised for invalid listing parameters."""
+
+
+def index_columns(table):
+    """Return the column names of the primary key and of each index of `table`."""
+    indexes = [[column.name for column in table.primary_key.columns]]
+    indexes.extend([column.name for column in index.columns] for index in table.indexes)
+    indexes.extend(
+        [column.name for column in constraint.columns] for constraint in table.constraints
+        if isinstance(constraint, UniqueConstraint)
+    )
+    return indexes
+
+
+def is_indexed(table, name, equal_columns=()):
+    """Return True if an index can read `name` in order once `equal_columns` are fixed."""
+    for names in index_columns(table):
+        for column_name in names:
+            if column_name == name:
+                return True
+            if column_name not in equal_columns:
+                break
+    return False
+
+
+def is_protected(table, name):
+    """Return True if `name` of `table` holds credentials."""
+    if name in PROTECTED_COLUMNS.get(table.name, ()):
+        return True
+    return any(part in name for part in PROTECTED_NAME_PARTS)
+
+
+def convert(column, raw):
+    """Convert a query string value to the Python type of `column`."""
+    try:
+        python_type = column.type.python_type
+    except NotImplementedError:
+        return raw
+    try:
+        if python_type is bool:
+            return raw.lower() in ('1', 'true', 'yes', 'on')
+        if python_type in (datetime, date):
+            return python_type.fromisoformat(raw)
+        return python_type(raw)
+    except ValueError:
+        raise ListingError(f'Invalid value for {column.name}: {raw}')
+
+
+def plain(value):
+    """Return a value as it appears in to_dict() output."""
+    return value.isoformat() if isinstance(value, (datetime, date)) else value
+
+
+class Listing:
+    """One page of a model's rows, as described by query string arguments."""
+
+    def __init__(self, model_class, args, page_size=100, max_page_size=1000):
+        self.model = model_class
+        self.table = model_class.__table__
+        self.columns = self.table.columns
+        self.sharded = self.table.name in sharding.SHARDED_TABLES
+        self.key = list(self.table.primary_key.columns)[0]
+
+        try:
+            self.limit = int(args.get('limit', page_size))
+        except ValueError:
+            raise ListingError('limit must be an integer')
+        if not 1 <= self.limit <= max_page_size:
+            raise ListingError(f'limit must be between 1 and {max_page_size}')
+
+        self.count_mode = args.get('count', 'estimate')
+        if self.count_mode not in COUNT_MODES:
+            raise ListingError(f"count must be one of {', '.join(sorted(COUNT_MODES))}")
+
+        self.filters = []
+        self.device_id = None
+        equal_columns = set()
+        for name, raw in args.items():
+            if name in RESERVED_ARGS:
+                continue
+            column_name, _, op = name.partition('__')
+            column = self.columns.get(column_name)
+            if column is None:
+                raise ListingError(f'Unknown column: {column_name}')
+            if is_protected(self.table, column_name):
+                raise ListingError(f'{column_name} cannot be filtered')
+            if self.sharded and not is_indexed(self.table, column_name):
+                raise ListingError(f'{column_name} is not indexed and cannot be filtered on {self.table.name}')
+            op = op or 'eq'
+            if op == 'in':
+                self.filters.append(column.in_([convert(column, value) for value in raw.split(',')]))
+            elif op in FILTER_OPERATORS:
+                self.filters.append(FILTER_OPERATORS[op](column, convert(column, raw)))
+            else:
+                raise ListingError(f'Unknown filter operator: {op}')
+            if op == 'eq':
+                equal_columns.add(column_name)
+                if column_name == 'device_id':
+                    self.device_id = raw
+
+        sort = args.get('sort') or self.key.name
+        self.descending = sort.startswith('-')
+        sort_name = sort.lstrip('-')
+        self.sort_column = self.columns.get(sort_name)
+        if self.sort_column is None:
+            raise ListingError(f'Unknown column: {sort_name}')
+        if is_protected(self.table, sort_name):
+            raise ListingError(f'{sort_name} cannot be sorted on')
+        if not is_indexed(self.table, sort_name, equal_columns):
+            raise ListingError(f'{sort_name} is not indexed and cannot be sorted on')
+
+        self.fields = None
+        if args.get('fields'):
+            self.fields = [name.strip() for name in args['fields'].split(',') if name.strip()]
+            unknown = [name for name in self.fields if name not in self.columns]
+            if unknown:
+                raise ListingError(f"Unknown column(s): {', '.join(unknown)}")
+            protected = [name for name in self.fields if is_protected(self.table, name)]
+            if protected:
+                raise ListingError(f"Column(s) cannot be returned: {', '.join(protected)}")
+
+        self.cursor = None
+        if args.get('cursor'):
+            try:
+                value, key = json.loads(base64.urlsafe_b64decode(args['cursor'].encode()))
+            except (ValueError, TypeError):
+                raise ListingError('Invalid cursor')
+            if isinstance(value, str):
+                value = convert(self.sort_column, value)
+            self.cursor = (value, key)
+
+    def shards(self):
+        """Return the shards to read: one if the rows are filtered to a single device."""
+        if not self.sharded:
+            return [None]
+        if self.device_id is not None:
+            return [sharding.device_shard(self.device_id)]
+        return sharding.shards()
+
+    def _conditions(self):
+        conditions = list(self.filters)
+        if self.sort_column is not self.key and self.sort_column.nullable:
+            conditions.append(self.sort_column.isnot(None))
+        if self.cursor is not None:
+            value, key = self.cursor
+            after = operator.lt if self.descending else operator.gt
+            if self.sort_column is self.key:
+                conditions.append(after(self.key, key))
+            else:
+                conditions.append(or_(
+                    after(self.sort_column, value),
+                    and_(self.sort_column == value, after(self.key, key))
+                ))
+        return conditions
+
+    def statement(self):
+        if self.fields is None:
+            statement = select(self.model)
+        else:
+            names = dict.fromkeys(self.fields + [self.sort_column.name, self.key.name])
+            statement = select(*[self.columns[name] for name in names])
+        order = [self.sort_column, self.key] if self.sort_column is not self.key else [self.key]
+        if self.descending:
+            order = [column.desc() for column in order]
+        return statement.where(*self._conditions()).order_by(*order).limit(self.limit + 1)
+
+    def _sort_key(self, item):
+        if self.fields is None:
+            return getattr(item, self.sort_column.key), getattr(item, self.key.key)
+        return item._mapping[self.sort_column.name], item._mapping[self.key.name]
+
+    def page(self, session, options=()):
+        """Return (items, next cursor or None); items are model instances or rows."""
+        statement = self.statement().options(*options) if self.fields is None else self.statement()
+        results = []
+        for shard in self.shards():
+            with sharding.use(shard):
+                result = session.execute(statement)
+                results.append(result.scalars().all() if self.fields is None else result.all())
+        items = results[0] if len(results) == 1 else list(
+            heapq.merge(*results, key=self._sort_key, reverse=self.descending)
+        )
+        next_cursor = None
+        if len(items) > self.limit:
+            items = items[:self.limit]
+            value, key = self._sort_key(items[-1])
+            next_cursor = base64.urlsafe_b64encode(json.dumps([plain(value), key]).encode()).decode()
+        return items, next_cursor
+
+    def serialize(self, item):
+        if self.fields is None:
+            return item.to_dict()
+        return {name: plain(item._mapping[name]) for name in self.fields}
+
+    def estimate_rows(self, session):
+        """Estimate the rows of the whole table from the range of its primary key."""
+        if self.key.type.python_type is not int:
+            return None
+        lowest = highest = None
+        for shard in self.shards():
+            with sharding.use(shard):
+                low, high = session.execute(select(func.min(self.key), func.max(self.key))).one()
+            if low is not None:
+                lowest = low if lowest is None else min(lowest, low)
+                highest = high if highest is None else max(highest, high)
+        return 0 if lowest is None else highest - lowest + 1
+
+    def count(self, session, limit=10000):
+        """Return (total, exact) for the rows matching the filters, or (None, None)."""
+        if self.count_mode == 'none':
+            return None, None
+        total, exact = 0, True
+        for shard in self.shards():
+            with sharding.use(shard):
+                if self.count_mode == 'exact':
+                    total += session.scalar(select(func.count()).select_from(self.table).where(*self.filters))
+                    continue
+                matching = select(literal(1)).select_from(self.table).where(*self.filters).limit(limit + 1)
+                counted = session.scalar(select(func.count()).select_from(matching.subquery()))
+                if counted > limit:
+                    exact = False
+                total += counted
+        if not exact and not self.filters:
+            estimate = table_stats.service.rows(self.table.name)
+            if estimate is None:
+                estimate = self.estimate_rows(session)
+            total = max(estimate or 0, total)
+        return total, exact
@@ -1,8 +1,14 @@
-from flask import render_template, redirect, url_for, flash, request, jsonify, current_app
+from flask import render_template, redirect, url_for, flash, request, jsonify, current_app, Response, stream_with_context
 from flask_login import login_required, current_user
 from functools import wraps
 from . import admin
-from models import db, User, Home, Floor, Room, Device, SensorData, UserAction, HomeAccess, UserRole, UserRoleMapping
+from models import db, User, Home, Floor, Room, Device, SensorData, UserAction, HomeAccess, UserRole, UserRoleMapping, COUNTER_FIELDS
+from serialization import api_response
+from sqlalchemy.orm import joinedload
+from .listing import Listing, ListingError
+import sharding
+import table_stats
+import inventory
 import logging
 
 # Get logger
@@ -55,9 +61,16 @@ def homes():
 @login_required
 @admin_required
 def devices():
-    devices_list = Device.query.all()
+    try:
+        listing = make_listing(Device)
+    except ListingError as e:
+        flash(str(e), 'danger')
+        return redirect(url_for('admin.devices'))
+    devices_list, next_cursor = listing.page(db.session, options=[joinedload(Device.room).joinedload(Room.floor)])
+    total, exact = listing.count(db.session, current_app.config.get('ADMIN_COUNT_LIMIT', 10000))
     homes_list = Home.query.all()  # Need homes list for dropdown selection
-    return render_template('admin/devices.html', devices=devices_list, homes=homes_list)
+    return render_template('admin/devices.html', devices=devices_list, homes=homes_list,
+                           next_url=next_page_url(next_cursor), total=total, total_exact=exact)
 
 # Test route that doesn't require authentication
 @admin.route('/test')
@@ -90,20 +103,58 @@ def test_admin_access():
             'message': 'User is not authenticated'
         })
 
+def make_listing(model_class):
+    """Parse the pagination, filter and projection arguments of the current request."""
+    return Listing(model_class, request.args,
+                   page_size=current_app.config.get('ADMIN_PAGE_SIZE', 100),
+                   max_page_size=current_app.config.get('ADMIN_MAX_PAGE_SIZE', 1000))
+
+def next_page_url(cursor):
+    """Return the URL of the current view's next page, or None on the last page."""
+    if cursor is None:
+        return None
+    args = request.args.to_dict()
+    args['cursor'] = cursor
+    return url_for(request.endpoint, **(request.view_args or {}), **args)
+
+def get_item(model_class, id):
+    """Get a row of a model by ID, searching every shard for sharded models."""
+    if model_class.__tablename__ in sharding.SHARDED_TABLES:
+        return sharding.find(db.session, model_class, id)
+    return model_class.query.get(id)
+
 # Generic model CRUD API endpoints
 @admin.route('/api/<model_name>', methods=['GET'])
 @login_required
 @admin_required
 def get_model_data(model_name):
-    """Get all items for a model."""
+    """Get a page of items for a model (see admin/listing.py for the arguments).
+    
+    The body is the list of items; the X-Total-Count (and
+    X-Total-Count-Exact) and X-Next-Cursor headers, and a Link header to the
+    next page, describe the rest of the listing.
+    """
     # Import here to avoid circular imports
     import models
     model_class = getattr(models, model_name, None)
     if not model_class:
-        return jsonify({'error': f'Model {model_name} not found'}), 404
+        return api_response({'error': f'Model {model_name} not found'}), 404
     
-    items = model_class.query.all()
-    return jsonify([item.to_dict() for item in items])
+    try:
+        listing = make_listing(model_class)
+    except ListingError as e:
+        return api_response({'success': False, 'error': str(e)}), 400
+    items, next_cursor = listing.page(db.session)
+    total, exact = listing.count(db.session, current_app.config.get('ADMIN_COUNT_LIMIT', 10000))
+    
+    response = api_response([listing.serialize(item) for item in items])
+    if total is not None:
+        response.headers['X-Total-Count'] = str(total)
+        response.headers['X-Total-Count-Exact'] = 'true' if exact else 'false'
+    if next_cursor is not None:
+        response.headers['X-Next-Cursor'] = next_cursor
+        response.headers['Link'] = f'<{next_page_url(next_cursor)}>; rel="next"'
+    return response
 
 @admin.route('/api/<model_name>/<int:id>', methods=['GET'])
 @login_required
@@ -114,13 +165,13 @@ def get_model_item(model_name, id):
     import models
     model_class = getattr(models, model_name, None)
     if not model_class:
-        return jsonify({'success': False, 'error': f'Model {model_name} not found'}), 404
+        return api_response({'success': False, 'error': f'Model {model_name} not found'}), 404
     
-    item = model_class.query.get(id)
+    item = get_item(model_class, id)
     if not item:
-        return jsonify({'success': False, 'error': 'Item not found'}), 404
+        return api_response({'success': False, 'error': 'Item not found'}), 404
     
-    return jsonify({'success': True, 'data': item.to_dict()})
+    return api_response({'success': True, 'data': item.to_dict()})
 
 @admin.route('/api/<model_name>/<int:id>', methods=['PUT'])
 @login_required
@@ -131,15 +182,15 @@ def update_model_item(model_name, id):
     import models
     model_class = getattr(models, model_name, None)
     if not model_class:
-        return jsonify({'success': False, 'error': f'Model {model_name} not found'}), 404
+        return api_response({'success': False, 'error': f'Model {model_name} not found'}), 404
     
-    item = model_class.query.get(id)
+    item = get_item(model_class, id)
     if not item:
-        return jsonify({'success': False, 'error': 'Item not found'}), 404
+        return api_response({'success': False, 'error': 'Item not found'}), 404
     
     data = request.get_json()
     if not data:
-        return jsonify({'success': False, 'error': 'No data provided'}), 400
+        return api_response({'success': False, 'error': 'No data provided'}), 400
     
     # Special handling for User model to hash passwords
     if model_name == 'User' and 'password' in data and data['password']:
@@ -149,19 +200,20 @@ def update_model_item(model_name, id):
                 setattr(item, key, value)
         item.set_password(password)
     else:
-        # Update attributes for other models
+        # Update attributes for other models (device counters are maintained automatically)
         for key, value in data.items():
-            if hasattr(item, key) and key != 'id':
+            if hasattr(item, key) and key != 'id' and key not in COUNTER_FIELDS:
                 setattr(item, key, value)
     
     try:
-        db.session.commit()
-        logger.info(f"Updated {model_name} id={id}")
-        return jsonify({'success': True, 'data': item.to_dict(), 'message': f'{model_name} updated successfully'})
+        with sharding.for_instance(item):
+            db.session.commit()
+            logger.info(f"Updated {model_name} id={id}")
+            return api_response({'success': True, 'data': item.to_dict(), 'message': f'{model_name} updated successfully'})
     except Exception as e:
         db.session.rollback()
         logger.error(f"Error updating {model_name} id={id}: {str(e)}")
-        return jsonify({'success': False, 'error': f'Error updating item: {str(e)}'}), 500
+        return api_response({'success': False, 'error': f'Error updating item: {str(e)}'}), 500
 
 @admin.route('/api/<model_name>', methods=['POST'])
 @login_required
@@ -172,11 +224,11 @@ def create_model_item(model_name):
     import models
     model_class = getattr(models, model_name, None)
     if not model_class:
-        return jsonify({'success': False, 'error': f'Model {model_name} not found'}), 404
+        return api_response({'success': False, 'error': f'Model {model_name} not found'}), 404
     
     data = request.get_json()
     if not data:
-        return jsonify({'success': False, 'error': 'No data provided'}), 400
+        return api_response({'success': False, 'error': 'No data provided'}), 400
     
     # Create new instance
     item = model_class()
@@ -189,20 +241,21 @@ def create_model_item(model_name):
                 setattr(item, key, value)
         item.set_password(password)
     else:
-        # Set attributes for other models
+        # Set attributes for other models (device counters are maintained automatically)
         for key, value in data.items():
-            if hasattr(item, key):
+            if hasattr(item, key) and key not in COUNTER_FIELDS:
                 setattr(item, key, value)
     
     try:
-        db.session.add(item)
-        db.session.commit()
-        logger.info(f"Created new {model_name}: {item}")
-        return jsonify({'success': True, 'data': item.to_dict(), 'message': f'{model_name} created successfully'}), 201
+        with sharding.for_instance(item):
+            db.session.add(item)
+            db.session.commit()
+            logger.info(f"Created new {model_name}: {item}")
+            return api_response({'success': True, 'data': item.to_dict(), 'message': f'{model_name} created successfully'}), 201
     except Exception as e:
         db.session.rollback()
         logger.error(f"Error creating {model_name}: {str(e)}")
-        return jsonify({'success': False, 'error': f'Error creating item: {str(e)}'}), 500
+        return api_response({'success': False, 'error': f'Error creating item: {str(e)}'}), 500
 
 @admin.route('/api/<model_name>/<int:id>', methods=['DELETE'])
 @login_required
@@ -213,21 +266,23 @@ def delete_model_item(model_name, id):
     import models
     model_class = getattr(models, model_name, None)
     if not model_class:
-        return jsonify({'success': False, 'error': f'Model {model_name} not found'}), 404
+        return api_response({'success': False, 'error': f'Model {model_name} not found'}), 404
     
-    item = model_class.query.get(id)
+    item = get_item(model_class, id)
     if not item:
-        return jsonify({'success': False, 'error': 'Item not found'}), 404
+        return api_response({'success': False, 'error': 'Item not found'}), 404
     
     try:
-        db.session.delete(item)
-        db.session.commit()
+        # Deleting a home, floor, room or device loads the rows of its shard
+        with sharding.for_instance(item):
+            db.session.delete(item)
+            db.session.commit()
         logger.info(f"Deleted {model_name} id={id}")
-        return jsonify({'success': True, 'message': f'{model_name} deleted successfully'}), 200
+        return api_response({'success': True, 'message': f'{model_name} deleted successfully'}), 200
     except Exception as e:
         db.session.rollback()
         logger.error(f"Error deleting {model_name} id={id}: {str(e)}")
-        return jsonify({'success': False, 'error': f'Error deleting item: {str(e)}'}), 500
+        return api_response({'success': False, 'error': f'Error deleting item: {str(e)}'}), 500
 
 @admin.route('/model/<model_name>')
 @login_required
@@ -241,7 +296,13 @@ def model_editor(model_name):
         flash(f"Model '{model_name}' not found", "danger")
         return redirect(url_for('admin.dashboard'))
 
-    items = model_class.query.all()
+    try:
+        listing = make_listing(model_class)
+    except ListingError as e:
+        flash(str(e), 'danger')
+        return redirect(url_for('admin.model_editor', model_name=model_name))
+    items, next_cursor = listing.page(db.session)
+    total, exact = listing.count(db.session, current_app.config.get('ADMIN_COUNT_LIMIT', 10000))
     
     # Try to determine the model's primary field (usually 'name' or 'username' etc.)
     primary_field = 'name' if hasattr(model_class, 'name') else 'id'
@@ -250,7 +311,10 @@ def model_editor(model_name):
     
     return render_template('admin/model_editor.html', 
                            model_name=model_name,
-                           items=items,
+                           items=[listing.serialize(item) for item in items],
+                           next_url=next_page_url(next_cursor),
+                           total=total,
+                           total_exact=exact,
                            primary_field=primary_field,
                            display_name=model_name.replace('_', ' ').title())
 
@@ -278,33 +342,68 @@ def floor_rooms(floor_id):
 def get_floor_rooms(floor_id):
     """Get all rooms for a specific floor."""
     rooms = Room.query.filter_by(floor_id=floor_id).all()
-    return jsonify([room.to_dict() for room in rooms])
+    return api_response([room.to_dict() for room in rooms])
+
+@admin.route('/api/inventory/import', methods=['POST'])
+@login_required
+@admin_required
+def api_import_inventory():
+    """Upsert homes, floors, rooms and devices from a JSON or CSV inventory.
+    
+    The inventory is the request body (JSON, or CSV with a text/csv content
+    type) or an uploaded 'file'. ?owner=<username> owns the homes that do not
+    name one (default: the current user); ?dry_run=1 only validates.
+    """
+    upload = request.files.get('file')
+    is_csv = (request.mimetype == 'text/csv' or request.args.get('format') == 'csv'
+              or (upload is not None and upload.filename.lower().endswith('.csv')))
+    try:
+        if upload is not None:
+            text = upload.read().decode('utf-8-sig')
+        else:
+            text = request.get_data(as_text=True)
+        homes = inventory.parse_csv(text.splitlines()) if is_csv else inventory.parse_json(text)
+        summary = inventory.import_homes(
+            homes, db.session,
+            owner=request.args.get('owner') or current_user.id,
+            dry_run=request.args.get('dry_run', '').lower() in ('1', 'true', 'yes')
+        )
+    except inventory.InventoryError as e:
+        return api_response({'success': False, 'error': str(e), 'errors': e.errors}), 400
+    except (ValueError, UnicodeDecodeError) as e:
+        return api_response({'success': False, 'error': f'Invalid inventory: {e}'}), 400
+    return api_response({'success': True, 'message': 'Inventory imported', 'summary': summary})
+
+@admin.route('/api/inventory/export', methods=['GET'])
+@login_required
+@admin_required
+def api_export_inventory():
+    """Stream the inventory of every home (or ?home_id=1,2) as JSON or ?format=csv."""
+    home_ids = None
+    if request.args.get('home_id'):
+        try:
+            home_ids = [int(home_id) for home_id in request.args['home_id'].split(',')]
+        except ValueError:
+            return api_response({'success': False, 'error': 'home_id must be a list of integers'}), 400
+    if request.args.get('format') == 'csv':
+        chunks, mimetype, filename = inventory.export_csv(db.session, home_ids), 'text/csv', 'inventory.csv'
+    else:
+        chunks, mimetype, filename = inventory.export_json(db.session, home_ids), 'application/json', 'inventory.json'
+    response = Response(stream_with_context(chunks), mimetype=mimetype)
+    response.headers['Content-Disposition'] = f'attachment; filename={filename}'
+    return response
 
 @admin.route('/api/debug-info', methods=['GET'])
 @login_required
 @admin_required
 def api_debug_info():
-    """Get debug information about database models."""
-    import inspect
-    import models
+    """Get debug information about database models.
     
-    # Get all model classes from models module
-    model_classes = []
-    for name, obj in inspect.getmembers(models):
-        if inspect.isclass(obj) and hasattr(obj, '__tablename__'):
-            try:
-                count = obj.query.count()
-                model_classes.append({
-                    'name': name,
-                    'table': obj.__tablename__,
-                    'count': count
-                })
-            except Exception as e:
-                model_classes.append({
-                    'name': name,
-                    'table': obj.__tablename__,
-                    'error': str(e)
-                })
+    Row counts and the other table statistics come from table_stats and are
+    approximate for large tables (see rows_exact and rows_source).
+    """
+    snapshot = table_stats.service.snapshot(db)
+    model_classes = [{**snapshot[name], 'count': snapshot[name]['rows']} for name in sorted(snapshot)]
     
     return jsonify({
         'models': model_classes,
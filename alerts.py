@@ -0,0 +1,502 @@
+"""Alert rules evaluated incrementally as readings are stored.
+
+An AlertRule watches one device, or every device of a type (optionally only
+those in one room), for one of three conditions:
+
+- 'threshold': the value compares true against `threshold` (with `operator`)
+  for at least `duration` seconds, e.g. humidity > 70 for 600 s,
+- 'count': the value compares true at least `min_count` times within
+  `window` seconds,
+- 'deviation': the value is more than `sigma` standard deviations away from
+  an exponentially weighted moving average (smoothing `alpha`): the
+  device's own, or for a rule scoped to a room, the one shared by the
+  devices of the same type in that room.
+
+Readings inserted through the ORM are evaluated once their transaction
+commits, in timestamp order. Rules are indexed by device id and device type,
+so a reading only visits the rules that apply to its device, and every
+(rule, device) pair keeps a fixed-size state: the start of the current run,
+two window counters (the previous window's count is weighted by how much of
+it still overlaps the sliding window), or the EWMA mean and variance (kept
+once per device type for room baselines). A rule fires for a device when its
+condition becomes true and not again until it has cleared.
+
+Alerts are delivered on a background thread to the notifiers named in
+ALERT_NOTIFIERS: 'log' and 'database' (the alert_events table) are built in,
+`register_notifier()` adds more. Rules are reloaded when they are changed in
+this process and every ALERT_RULES_REFRESH seconds. Readings written with
+Core bulk inserts (fake_data_generator.py --bulk) are not evaluated.
+"""
+import time
+import queue
+import logging
+import operator
+import threading
+from datetime import datetime
+from operator import itemgetter
+
+from sqlalchemy import event, inspect, select
+from sqlalchemy.orm import Session
+
+import metrics
+from models import db, Device, SensorData, AlertRule, AlertEvent
+
+# Get logger
+logger = logging.getLogger('smart_home.alerts')
+
+OPERATORS = {
+    '>': operator.gt, '>=': operator.ge, '<': operator.lt, '<=': operator.le,
+    '==': operator.eq, '!=': operator.ne,
+}
+# Readings a device's moving average needs before deviations are judged
+DEVIATION_WARMUP = 10
+
+_EPOCH = datetime(1970, 1, 1)
+_READINGS_KEY = 'alert_readings'
+_CHANGES_KEY = 'alert_changes'
+
+
+class Alert:
+    """A rule that fired for a reading."""
+    __slots__ = ('rule_id', 'kind', 'device_id', 'value', 'timestamp', 'message')
+
+    def __init__(self, rule, device_id, value, timestamp):
+        self.rule_id = rule.id
+        self.kind = rule.kind
+        self.device_id = device_id
+        self.value = value
+        self.timestamp = timestamp
+        self.message = f"{rule.name}: {device_id} reported {value} ({rule.describe()})"
+
+    def to_dict(self):
+        return {
+            'rule_id': self.rule_id,
+            'device_id': self.device_id,
+            'value': self.value,
+            'message': self.message,
+            'triggered_at': self.timestamp.isoformat()
+        }
+
+
+class CompiledRule:
+    """An AlertRule reduced to what evaluating it needs."""
+    __slots__ = ('id', 'name', 'device_id', 'device_type', 'room_id', 'operator', 'compare',
+                 'threshold', 'duration', 'window', 'min_count', 'sigma', 'alpha')
+    kind = None
+
+    def __init__(self, rule):
+        self.id = rule.id
+        self.name = rule.name
+        self.device_id = rule.device_id
+        self.device_type = rule.device_type
+        self.room_id = rule.room_id
+        self.operator = rule.operator or '>'
+        if self.operator not in OPERATORS:
+            raise ValueError(f'Unsupported alert operator: {self.operator}')
+        self.compare = OPERATORS[self.operator]
+        self.threshold = rule.threshold
+        self.duration = rule.duration or 0
+        self.window = rule.window or 300
+        self.min_count = rule.min_count or 1
+        self.sigma = rule.sigma if rule.sigma is not None else 3.0
+        self.alpha = rule.alpha if rule.alpha is not None else 0.1
+
+    def signature(self):
+        """Definition of the rule; its device states are kept across reloads while unchanged."""
+        return (self.kind,) + tuple(getattr(self, name) for name in CompiledRule.__slots__ if name != 'compare')
+
+    def applies_to(self, device_type, room_id):
+        if self.device_type is not None and self.device_type != device_type:
+            return False
+        return self.room_id is None or self.room_id == room_id
+
+    def baseline_key(self, device_type, room_id):
+        """Key of the state shared by the devices a reading is compared with, or None."""
+        return None
+
+    def new_state(self, baseline=None):
+        raise NotImplementedError
+
+    def check(self, state, value, at):
+        """Update `state` with a reading at `at` (epoch seconds); return True if the rule fires."""
+        raise NotImplementedError
+
+    def describe(self):
+        raise NotImplementedError
+
+
+class ThresholdRule(CompiledRule):
+    __slots__ = ()
+    kind = 'threshold'
+
+    def new_state(self, baseline=None):
+        # [start of the current run of matching readings, fired]
+        return [None, False]
+
+    def check(self, state, value, at):
+        if self.compare(value, self.threshold):
+            if state[0] is None:
+                state[0] = at
+            if not state[1] and at - state[0] >= self.duration:
+                state[1] = True
+                return True
+        else:
+            state[0] = None
+            state[1] = False
+        return False
+
+    def describe(self):
+        held = f' for {self.duration}s' if self.duration else ''
+        return f'{self.operator} {self.threshold}{held}'
+
+
+class CountRule(CompiledRule):
+    __slots__ = ()
+    kind = 'count'
+
+    def new_state(self, baseline=None):
+        # [window number, matches in it, matches in the window before, fired]
+        return [None, 0, 0, False]
+
+    def check(self, state, value, at):
+        position = at / self.window
+        bucket = int(position)
+        if state[0] is None or bucket > state[0]:
+            state[2] = state[1] if state[0] is not None and bucket == state[0] + 1 else 0
+            state[1] = 0
+            state[0] = bucket
+        if self.compare(value, self.threshold):
+            state[1] += 1
+        estimate = state[2] * (1.0 - (position - state[0])) + state[1]
+        if estimate >= self.min_count:
+            if not state[3]:
+                state[3] = True
+                return True
+        else:
+            state[3] = False
+        return False
+
+    def describe(self):
+        return f'{self.operator} {self.threshold} at least {self.min_count} time(s) in {self.window}s'
+
+
+class DeviationRule(CompiledRule):
+    __slots__ = ('per_room',)
+    kind = 'deviation'
+
+    def __init__(self, rule):
+        super().__init__(rule)
+        # Rules scoped to a room compare each device with its room's baseline
+        self.per_room = self.room_id is not None and self.device_id is None
+
+    def baseline_key(self, device_type, room_id):
+        # Devices of different types report different quantities
+        return (room_id, device_type) if self.per_room else None
+
+    def new_baseline(self):
+        # [readings seen, EWMA mean, EWMA variance]
+        return [0, 0.0, 0.0]
+
+    def new_state(self, baseline=None):
+        # [baseline, fired]
+        return [baseline if baseline is not None else self.new_baseline(), False]
+
+    def check(self, state, value, at):
+        baseline = state[0]
+        count, mean, variance = baseline
+        if count == 0:
+            baseline[0], baseline[1] = 1, value
+            return False
+        diff = value - mean
+        outlier = (count >= DEVIATION_WARMUP and variance > 0.0
+                   and diff * diff > self.sigma * self.sigma * variance)
+        increment = self.alpha * diff
+        baseline[0] = count + 1
+        baseline[1] = mean + increment
+        baseline[2] = (1.0 - self.alpha) * (variance + diff * increment)
+        if outlier:
+            if not state[1]:
+                state[1] = True
+                return True
+        else:
+            state[1] = False
+        return False
+
+    def describe(self):
+        average = "the room's moving average" if self.per_room else 'the moving average'
+        return f'more than {self.sigma} sigma from {average}'
+
+
+RULE_KINDS = {rule_class.kind: rule_class for rule_class in (ThresholdRule, CountRule, DeviationRule)}
+
+
+def compile_rule(rule):
+    """Return the CompiledRule for an AlertRule (or any object with its attributes)."""
+    rule_class = RULE_KINDS.get(rule.kind)
+    if rule_class is None:
+        raise ValueError(f'Unsupported alert rule kind: {rule.kind}')
+    if rule_class is not DeviationRule and rule.threshold is None:
+        raise ValueError(f'Alert rule {rule.name!r} has no threshold')
+    return rule_class(rule)
+
+
+class AlertEngine:
+    """Evaluates readings against the rules that apply to their device."""
+
+    def __init__(self, notify=None):
+        self.enabled = True
+        self.notify = notify
+        self.loaded_at = None
+        self._rules = {}
+        self._by_device = {}
+        self._by_type = {}
+        self._devices = {}
+        # (rule id, device id, baseline key) -> state, (rule id, baseline key) ->
+        # shared baseline, and device id -> [(rule, state)]
+        self._states = {}
+        self._watches = {}
+        self._lock = threading.Lock()
+
+    def load(self, rules, devices):
+        """Replace the rules, and the (type, room id) of every device."""
+        compiled = {}
+        for rule in rules:
+            try:
+                compiled[rule.id] = compile_rule(rule)
+            except ValueError as e:
+                logger.warning(f"Skipping alert rule {rule.id}: {e}")
+        by_device, by_type = {}, {}
+        for rule in compiled.values():
+            if rule.device_id is not None:
+                by_device.setdefault(rule.device_id, []).append(rule)
+            else:
+                # Keyed by None when the rule applies to every type
+                by_type.setdefault(rule.device_type, []).append(rule)
+        with self._lock:
+            unchanged = {rule_id for rule_id, rule in compiled.items()
+                         if rule_id in self._rules and self._rules[rule_id].signature() == rule.signature()}
+            self._states = {key: state for key, state in self._states.items() if key[0] in unchanged}
+            self._rules, self._by_device, self._by_type = compiled, by_device, by_type
+            self._devices = dict(devices)
+            self._watches = {}
+            self.loaded_at = time.monotonic()
+
+    def forget_device(self, device_id):
+        """Drop what is known of a device that was added, changed or deleted."""
+        with self._lock:
+            self._devices.pop(device_id, None)
+            self._watches.pop(device_id, None)
+
+    def lookup_device(self, device_id):
+        """Return (type, room id) of a device the engine does not know yet, or None."""
+        return None
+
+    def _watch(self, device_id):
+        if device_id not in self._devices:
+            self._devices[device_id] = self.lookup_device(device_id)
+        device = self._devices[device_id]
+        watch = []
+        if device is not None:
+            device_type, room_id = device
+            rules = self._by_device.get(device_id, []) + self._by_type.get(device_type, []) + self._by_type.get(None, [])
+            for rule in rules:
+                if rule.applies_to(device_type, room_id):
+                    baseline_key = rule.baseline_key(device_type, room_id)
+                    key = (rule.id, device_id, baseline_key)
+                    state = self._states.get(key)
+                    if state is None:
+                        baseline = None
+                        if baseline_key is not None:
+                            baseline = self._states.get((rule.id, baseline_key))
+                            if baseline is None:
+                                baseline = self._states[(rule.id, baseline_key)] = rule.new_baseline()
+                        state = self._states[key] = rule.new_state(baseline)
+                    watch.append((rule, state))
+        self._watches[device_id] = watch
+        return watch
+
+    def process(self, readings):
+        """Evaluate (device id, value, timestamp) readings in order; return the alerts raised."""
+        alerts = []
+        if not self._rules:
+            return alerts
+        with self._lock:
+            watches = self._watches
+            for device_id, value, timestamp in readings:
+                watch = watches.get(device_id)
+                if watch is None:
+                    watch = self._watch(device_id)
+                if not watch:
+                    continue
+                at = (timestamp - _EPOCH).total_seconds()
+                for rule, state in watch:
+                    if rule.check(state, value, at):
+                        alerts.append(Alert(rule, device_id, value, timestamp))
+        if alerts:
+            for alert in alerts:
+                metrics.alerts_fired.inc(alert.kind)
+            if self.notify is not None:
+                self.notify(alerts)
+        return alerts
+
+
+class DatabaseAlertEngine(AlertEngine):
+    """AlertEngine that loads its rules and devices from the primary database."""
+
+    def __init__(self, notify=None, refresh=60.0):
+        super().__init__(notify)
+        self.refresh = refresh
+        self.stale = True
+
+    def lookup_device(self, device_id):
+        with db.engine.connect() as connection:
+            row = connection.execute(
+                select(Device.type, Device.room_id).where(Device.device_id == device_id)
+            ).first()
+        return tuple(row) if row else None
+
+    def reload(self):
+        with db.engine.connect() as connection:
+            rules = connection.execute(select(AlertRule).where(AlertRule.is_active.is_(True))).all()
+            devices = connection.execute(select(Device.device_id, Device.type, Device.room_id)).all()
+        self.load(rules, ((device_id, (device_type, room_id)) for device_id, device_type, room_id in devices))
+        self.stale = False
+        logger.info(f"Loaded {len(self._rules)} alert rule(s)")
+
+    def process(self, readings):
+        if self.stale or time.monotonic() - self.loaded_at >= self.refresh:
+            self.reload()
+        return super().process(readings)
+
+
+class LogNotifier:
+    """Writes alerts to the smart_home.alerts log."""
+
+    def __init__(self, app):
+        pass
+
+    def notify(self, alerts):
+        for alert in alerts:
+            logger.warning(alert.message)
+
+
+class DatabaseNotifier:
+    """Stores alerts in the alert_events table."""
+
+    def __init__(self, app):
+        pass
+
+    def notify(self, alerts):
+        now = datetime.utcnow()
+        with db.engine.begin() as connection:
+            connection.execute(AlertEvent.__table__.insert(), [
+                {'rule_id': alert.rule_id, 'device_id': alert.device_id, 'value': alert.value,
+                 'message': alert.message[:255], 'triggered_at': alert.timestamp, 'created_at': now}
+                for alert in alerts
+            ])
+
+
+NOTIFIERS = {'log': LogNotifier, 'database': DatabaseNotifier}
+
+
+def register_notifier(name, factory):
+    """Make a notifier available to ALERT_NOTIFIERS.
+
+    `factory(app)` returns an object whose notify(alerts) delivers a list of
+    Alert objects. It is called from the delivery thread, in an app context.
+    """
+    NOTIFIERS[name] = factory
+
+
+class AlertDelivery:
+    """Hands alerts to the notifiers on a background thread."""
+
+    def __init__(self, app, notifiers, max_queued=10000):
+        self.app = app
+        self.notifiers = notifiers
+        self._queue = queue.Queue(maxsize=max_queued)
+        threading.Thread(target=self._run, name='alert-delivery', daemon=True).start()
+
+    def submit(self, alerts):
+        try:
+            self._queue.put_nowait(alerts)
+        except queue.Full:
+            metrics.alerts_dropped.inc(amount=len(alerts))
+            logger.error(f"Alert queue full, dropped {len(alerts)} alert(s)")
+
+    def _run(self):
+        while True:
+            alerts = self._queue.get()
+            with self.app.app_context():
+                for notifier in self.notifiers:
+                    try:
+                        notifier.notify(alerts)
+                    except Exception:
+                        logger.exception(f"Alert notifier {type(notifier).__name__} failed")
+
+
+engine = DatabaseAlertEngine()
+engine.enabled = False
+
+
+@event.listens_for(Session, 'after_flush')
+def _collect_readings(session, flush_context):
+    if not engine.enabled:
+        return
+    readings = [
+        (instance.device_id, instance.value, instance.timestamp) for instance in session.new
+        if isinstance(instance, SensorData) and instance.timestamp is not None
+    ]
+    if readings:
+        session.info.setdefault(_READINGS_KEY, []).extend(readings)
+    changes = []
+    new, deleted = session.new, session.deleted
+    for instance in list(new) + list(session.dirty) + list(deleted):
+        if isinstance(instance, AlertRule):
+            changes.append(('rules', None))
+        elif isinstance(instance, Device):
+            state = inspect(instance)
+            if (instance in new or instance in deleted
+                    or state.attrs.type.history.has_changes() or state.attrs.room_id.history.has_changes()):
+                changes.append(('device', instance.device_id))
+    if changes:
+        session.info.setdefault(_CHANGES_KEY, []).extend(changes)
+
+
+@event.listens_for(Session, 'after_commit')
+def _evaluate_readings(session):
+    changes = session.info.pop(_CHANGES_KEY, None)
+    readings = session.info.pop(_READINGS_KEY, None)
+    for change, device_id in changes or ():
+        if change == 'rules':
+            engine.stale = True
+        else:
+            engine.forget_device(device_id)
+    if readings:
+        readings.sort(key=itemgetter(2))
+        try:
+            engine.process(readings)
+        except Exception:
+            # Alerts must never fail the write that stored the readings
+            logger.exception('Alert evaluation failed')
+
+
+@event.listens_for(Session, 'after_rollback')
+def _discard_readings(session):
+    session.info.pop(_READINGS_KEY, None)
+    session.info.pop(_CHANGES_KEY, None)
+
+
+def init_app(app):
+    """Evaluate alert rules on stored readings and deliver alerts to the configured notifiers."""
+    engine.enabled = app.config.get('ALERTS_ENABLED', True)
+    if not engine.enabled:
+        return
+    names = [name.strip() for name in app.config.get('ALERT_NOTIFIERS', 'log,database').split(',') if name.strip()]
+    unknown = [name for name in names if name not in NOTIFIERS]
+    if unknown:
+        raise ValueError(f"Unknown ALERT_NOTIFIERS: {', '.join(unknown)}")
+    delivery = AlertDelivery(app, [NOTIFIERS[name](app) for name in names],
+                             max_queued=app.config.get('ALERT_QUEUE_SIZE', 10000))
+    engine.notify = delivery.submit
+    engine.refresh = app.config.get('ALERT_RULES_REFRESH', 60.0)
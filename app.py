@@ -1,9 +1,13 @@
 import os
 import json
+import heapq
 import secrets
-from datetime import datetime, timedelta, timezone
+import time
+from datetime import datetime, timedelta
+from itertools import islice
 from flask import Flask, render_template, request, jsonify, redirect, url_for, flash, send_from_directory
 import logging
+import click
 from flask_login import LoginManager, login_user, logout_user, login_required, current_user
 from functools import wraps
 
@@ -22,8 +26,73 @@ logging.basicConfig(
 logger = logging.getLogger('smart_home')
 
 # Import and initialize database
-from models import db, Device, SensorData, UserAction, User, Home, Floor, Room, HomeAccess
-db.init_app(app)
+from models import db, Device, SensorData, UserAction, User, Home, Floor, Room, HomeAccess, reconcile_device_counters
+from models import add_counter_columns, LateDataEvent
+from models import DeviceAlias, AutomationRule, SensorDataSketch, SKETCH_BUCKET, sketch_bucket_start, rebuild_sensor_sketches
+from sketches import DDSketch, RunningStats
+from sqlalchemy.orm import joinedload, contains_eager
+# Connection pool options and SQLite pragmas
+import database
+database.init_app(app, db)
+
+# Reads of GET requests on the read replica, if configured
+import replica
+replica.init_app(app, db)
+
+# Sensor data and user actions sharded by home, if configured
+import sharding
+sharding.init_app(app, db)
+
+# Per-request SQL statistics (Server-Timing header, N+1 detection)
+import instrumentation
+instrumentation.init_app(app)
+
+# Prometheus metrics (HTTP, DB pool, ingest, caches) on /metrics
+import metrics
+metrics.init_app(app, db)
+
+# Cache of statistics and aggregates over closed days
+import result_cache
+result_cache.init_app(app)
+
+# Response encoding (orjson, MessagePack) and compression
+import serialization
+from serialization import api_response
+serialization.init_app(app)
+
+# Device commands over MQTT
+import device_commands
+device_commands.init_app(app)
+
+# Alert rules evaluated on readings as they are stored
+import alerts
+alerts.init_app(app)
+
+# Automation rules sending device commands on readings
+import automation
+automation.init_app(app)
+
+# Devices marked offline when they go silent
+import liveness
+liveness.init_app(app)
+
+# Approximate table statistics for the admin dashboard
+import table_stats
+table_stats.init_app(app, db)
+
+# In-memory index of device ids and their aliases
+import device_aliases
+
+# In-memory device search by name, id, type, room and home
+import device_search
+device_search.init_app(app)
+
+# Bulk import and export of the home hierarchy
+import inventory
+
+# HTTP cache policy (immutable static assets, ETags and 304s for pages/APIs)
+import http_cache
+http_cache.init_app(app)
 
 # Initialize Flask-Login
 login_manager = LoginManager()
@@ -71,15 +140,115 @@ def init_app():
     # Create database tables if they don't exist
     with app.app_context():
         db.create_all()
+        sharding.create_tables()
         logger.info("Database tables created successfully")
+        # Databases created before the device counters existed
+        altered = add_counter_columns()
+        if altered:
+            repaired = reconcile_device_counters()
+            logger.info(f"Added device counter columns to {', '.join(altered)}; "
+                        f"recomputed {sum(repaired.values())} counter row(s)")
+        # Indexes added to tables that may already exist
+        for index in LateDataEvent.__table__.indexes:
+            index.create(db.engine, checkfirst=True)
+        added = device_aliases.add_legacy_aliases()
+        if added:
+            logger.info(f"Registered {added} legacy device alias(es)")
+
+@app.cli.command('reconcile-counters')
+def reconcile_counters_command():
+    """Repair drift in the denormalized Room/Floor/Home device counters."""
+    repaired = reconcile_device_counters()
+    for table, count in repaired.items():
+        print(f"{table}: {count} row(s) repaired")
+
+@app.cli.command('rebuild-sketches')
+def rebuild_sketches_command():
+    """Recompute the hourly sensor data sketches from raw readings."""
+    written = rebuild_sensor_sketches()
+    print(f"{written} sketch bucket(s) written")
 
-# Disable caching for development
-@app.after_request
-def add_header(response):
-    response.headers['Cache-Control'] = 'no-store, no-cache, must-revalidate, post-check=0, pre-check=0, max-age=0'
-    response.headers['Pragma'] = 'no-cache'
-    response.headers['Expires'] = '-1'
-    return response
+@app.cli.command('sync-replica')
+@click.option('--interval', type=float, default=None,
+              help='Keep copying every INTERVAL seconds instead of once.')
+def sync_replica_command(interval):
+    """Copy the SQLite primary database into the replica file."""
+    with app.app_context():
+        if replica.REPLICA_BIND not in db.engines:
+            raise click.ClickException('REPLICA_DATABASE_URL is not set')
+        primary, replica_engine = db.engines[None], db.engines[replica.REPLICA_BIND]
+    if primary.dialect.name != 'sqlite' or replica_engine.dialect.name != 'sqlite':
+        raise click.ClickException('Only SQLite replicas can be synced; use database replication otherwise')
+    while True:
+        started = time.perf_counter()
+        replica.sync_sqlite_replica(primary, replica_engine)
+        print(f"Replica synced in {time.perf_counter() - started:.2f}s")
+        if interval is None:
+            break
+        time.sleep(interval)
+
+@app.cli.command('add-legacy-aliases')
+def add_legacy_aliases_command():
+    """Register the ids older dashboards used for every device."""
+    with app.app_context():
+        added = device_aliases.add_legacy_aliases()
+    print(f"{added} alias(es) added")
+
+@app.cli.command('move-home')
+@click.argument('home_id', type=int)
+@click.argument('shard', type=int)
+@click.option('--from-primary', is_flag=True,
+              help='Move rows written to the primary database before sharding was enabled.')
+def move_home_command(home_id, shard, from_primary):
+    """Move a home's sensor data and user actions to another shard."""
+    if not sharding.shard_map.enabled:
+        raise click.ClickException('SHARD_DATABASE_URLS is not set')
+    with app.app_context():
+        if not db.session.get(Home, home_id):
+            raise click.ClickException(f'Home {home_id} not found')
+        try:
+            sharding.move_home(home_id, shard, from_primary=from_primary, log=print)
+        except ValueError as e:
+            raise click.ClickException(str(e))
+    print(f"Home {home_id} moved to shard {shard}")
+
+@app.cli.command('import-homes')
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--format', 'file_format', type=click.Choice(['json', 'csv']), default=None,
+              help='Inventory format (default: from the file extension).')
+@click.option('--owner', default=None, help='Username owning the homes that do not name an owner.')
+@click.option('--dry-run', is_flag=True, help='Validate and count the changes without writing them.')
+def import_homes_command(path, file_format, owner, dry_run):
+    """Upsert homes, floors, rooms and devices from a JSON or CSV inventory."""
+    file_format = file_format or ('csv' if path.lower().endswith('.csv') else 'json')
+    started = time.perf_counter()
+    with app.app_context():
+        try:
+            with open(path, newline='', encoding='utf-8-sig') as f:
+                homes = inventory.parse_csv(f) if file_format == 'csv' else inventory.parse_json(json.load(f))
+            summary = inventory.import_homes(homes, owner=owner, dry_run=dry_run)
+        except inventory.InventoryError as e:
+            for error in e.errors:
+                print(error)
+            raise click.ClickException(f'{len(e.errors)} error(s); nothing was imported')
+        except ValueError as e:
+            raise click.ClickException(f'Invalid inventory: {e}')
+    for level, counts in summary.items():
+        print(f"{level}: {counts['created']} created, {counts['updated']} updated, {counts['unchanged']} unchanged")
+    print(f"{'Validated' if dry_run else 'Imported'} in {time.perf_counter() - started:.2f}s")
+
+@app.cli.command('export-homes')
+@click.option('--output', '-o', type=click.Path(dir_okay=False), default=None,
+              help='File to write (default: standard output).')
+@click.option('--format', 'file_format', type=click.Choice(['json', 'csv']), default='json')
+@click.option('--home-id', 'home_ids', type=int, multiple=True, help='Export only this home (repeatable).')
+def export_homes_command(output, file_format, home_ids):
+    """Write the homes, floors, rooms and devices as a JSON or CSV inventory."""
+    with app.app_context():
+        export = inventory.export_csv if file_format == 'csv' else inventory.export_json
+        with click.open_file(output or '-', 'w', encoding='utf-8') as f:
+            for chunk in export(db.session, list(home_ids) or None):
+                f.write(chunk)
 
 # Generate a secure token
 def generate_token():
@@ -105,7 +274,7 @@ def token_required(f):
             }), 401
         # Find user with this token
         user = User.query.filter_by(access_token=token).first()
-        if not user or not user.token_expiry or user.token_expiry < datetime.now(timezone.utc):
+        if not user or not user.token_expiry or user.token_expiry < datetime.utcnow():
             return jsonify({
                 'success': False,
                 'message': 'Invalid or expired token'
@@ -114,6 +283,36 @@ def token_required(f):
         return f(user, *args, **kwargs)
     return decorated
 
+# Session or token authentication decorator
+def session_or_token_required(f):
+    @wraps(f)
+    def decorated(*args, **kwargs):
+        # First check if user is logged in via Flask-Login session
+        if current_user.is_authenticated:
+            return f(current_user._get_current_object(), *args, **kwargs)
+        token = None
+        # Check if token is in headers
+        if 'Authorization' in request.headers:
+            auth_header = request.headers['Authorization']
+            if auth_header.startswith('Bearer '):
+                token = auth_header[7:]  # Remove 'Bearer ' prefix
+        # Check if token is in query parameters
+        if not token and 'access_token' in request.args:
+            token = request.args.get('access_token')
+        if not token:
+            return jsonify({
+                'success': False,
+                'message': 'Authentication required'
+            }), 401
+        user = User.query.filter_by(access_token=token).first()
+        if not user or not user.token_expiry or user.token_expiry < datetime.utcnow():
+            return jsonify({
+                'success': False,
+                'message': 'Invalid or expired token'
+            }), 401
+        return f(user, *args, **kwargs)
+    return decorated
+
 # Routes
 @app.route('/')
 def index():
@@ -141,7 +340,7 @@ def login():
             user.last_login = datetime.utcnow()
             # Generate access token for API usage
             user.access_token = generate_token()
-            user.token_expiry = datetime.now(timezone.utc) + timedelta(days=7)  # Token valid for 7 days
+            user.token_expiry = datetime.utcnow() + timedelta(days=7)  # Token valid for 7 days
             db.session.commit()
             
             # Debug logging to troubleshoot admin redirects
@@ -237,7 +436,8 @@ def dashboard(home_id=None):
                         # Get the latest sensor data if applicable
                         latest_data = None
                         if device.type in ['temperature', 'humidity', 'light']:
-                            latest_data = SensorData.query.filter_by(device_id=device.device_id).order_by(SensorData.timestamp.desc()).first()
+                            with sharding.for_device(device.device_id):
+                                latest_data = SensorData.query.filter_by(device_id=device.device_id).order_by(SensorData.timestamp.desc()).first()
                         device_info = device.to_dict()
                         device_info.update({
                             'latest_value': latest_data.value if latest_data else None,
@@ -295,20 +495,48 @@ def dashboard(home_id=None):
                               current_home=current_home,
                               devices=all_devices)
 
+def search_devices(user, query='', offset=0, limit=20):
+    """Return (devices, total, has_more): one page of the indexed devices `user` can access."""
+    home_ids = device_search.user_home_ids(db.session, user)
+    return device_search.index.search(db.session, query, home_ids, offset=offset, limit=limit)
+
 @app.route('/devices')
 @login_required
 def devices():
-    """Render the devices management page."""
+    """Render the devices management page, one page of (searched) devices at a time."""
     with app.app_context():
-        all_devices = Device.query.all()
-        return render_template('devices.html', devices=all_devices)
+        query = request.args.get('q', '').strip()
+        offset = max(request.args.get('offset', 0, type=int), 0)
+        page_size = app.config['DEVICES_PAGE_SIZE']
+        docs, total, has_more = search_devices(current_user, query, offset, page_size)
+        loaded = {device.id: device for device in Device.query.options(
+            joinedload(Device.room).joinedload(Room.floor)
+        ).filter(Device.id.in_([doc.id for doc in docs]))}
+        page = [loaded[doc.id] for doc in docs if doc.id in loaded]
+        return render_template('devices.html',
+                              devices=page,
+                              query=query,
+                              total=total,
+                              offset=offset,
+                              next_offset=offset + page_size if has_more else None,
+                              previous_offset=max(offset - page_size, 0) if offset else None)
 
 @app.route('/history')
 @login_required
 def history():
-    """Render the data history page."""
+    """Render the data history page.
+    
+    The device picker starts with the first page of the user's devices (and
+    the ?device= one); the search box above it queries /api/devices/search.
+    """
     with app.app_context():
-        devices = Device.query.all()
+        docs, _, _ = search_devices(current_user, limit=app.config['DEVICE_SEARCH_PAGE_SIZE'])
+        selected = request.args.get('device')
+        if selected and all(doc.device_id != selected for doc in docs):
+            found, _, _ = search_devices(current_user, selected, limit=1)
+            if found and found[0].device_id == selected:
+                docs = found + docs
+        devices = [device_search.index.describe(doc) for doc in docs]
         return render_template('history.html', devices=devices)
 
 @app.route('/floors')
@@ -362,11 +590,45 @@ def api_get_devices(user):
         room_ids = [room.id for room in rooms]
         # Get all devices in these rooms
         devices = Device.query.filter(Device.room_id.in_(room_ids)).all()
-        return jsonify({
+        return api_response({
             'success': True,
             'devices': [device.to_dict() for device in devices]
         })
 
+@app.route('/api/devices/search', methods=['GET'])
+@session_or_token_required
+def api_search_devices(user):
+    """Search the user's devices by name, device id, type, room and home (typeahead).
+    
+    Takes q (every word must match the start of a word, or for words of 3+
+    characters any part of a name), limit and offset. Exact and prefix
+    matches on the device id or name come first, then devices in name order.
+    total is null when a very broad query was paged without counting it.
+    """
+    try:
+        limit = int(request.args.get('limit', app.config['DEVICE_SEARCH_PAGE_SIZE']))
+        offset = int(request.args.get('offset', 0))
+    except ValueError:
+        return jsonify({
+            'success': False,
+            'message': 'limit and offset must be integers'
+        }), 400
+    max_limit = app.config['DEVICE_SEARCH_MAX_PAGE_SIZE']
+    if not 1 <= limit <= max_limit or offset < 0:
+        return jsonify({
+            'success': False,
+            'message': f'limit must be between 1 and {max_limit} and offset at least 0'
+        }), 400
+    
+    with app.app_context():
+        docs, total, has_more = search_devices(user, request.args.get('q', ''), offset, limit)
+        return jsonify({
+            'success': True,
+            'devices': [device_search.index.describe(doc) for doc in docs],
+            'total': total,
+            'next_offset': offset + limit if has_more else None
+        })
+
 @app.route('/api/devices/<device_id>', methods=['GET'])
 @token_required
 def api_get_device(user, device_id):
@@ -444,6 +706,12 @@ def api_add_device(user):
             status='offline'
         )
         db.session.add(new_device)
+        # Register the ids older dashboards would use for it
+        db.session.add_all([
+            DeviceAlias(alias=alias, device_id=new_device.device_id)
+            for alias in device_aliases.legacy_aliases(new_device.device_id, new_device.type, room.name, floor.floor_number)
+            if not device_aliases.index.known(db.session, alias)
+        ])
         db.session.commit()
         return jsonify({
             'success': True,
@@ -490,6 +758,13 @@ def api_update_device(user, device_id):
                     'success': False,
                     'message': 'Access denied to the target room'
                 }), 403
+            # A device's readings and actions live on its home's shard, and are not moved
+            home_id = device.room.floor.home_id
+            if sharding.shard_map.enabled and room.floor.home_id != home_id:
+                return jsonify({
+                    'success': False,
+                    'message': f'Device belongs to home {home_id} and cannot move to another home'
+                }), 400
             device.room_id = data['room_id']
         if 'is_active' in data:
             device.is_active = data['is_active']
@@ -531,8 +806,10 @@ def api_delete_device(user, device_id):
                             'success': False,
                             'message': 'You do not have permission to delete devices from this home'
                         }), 403
-        db.session.delete(device)
-        db.session.commit()
+        # The cascade loads the device's readings and actions from its shard
+        with sharding.for_device(device.device_id):
+            db.session.delete(device)
+            db.session.commit()
         return jsonify({
             'success': True,
             'message': 'Device deleted'
@@ -541,73 +818,92 @@ def api_delete_device(user, device_id):
 @app.route('/api/devices/<device_id>/data', methods=['GET'])
 @token_required
 def api_get_device_data(user, device_id):
-    """Get sensor data for a device."""
+    """Get sensor data for a device.
+    
+    `format=columnar` returns one series per device (metadata, then parallel
+    epoch-millisecond `timestamps` and `values` arrays, oldest first, plus
+    `min`, `max` and `count` arrays for aggregated resolutions) instead of
+    one object per reading.
+    """
     days = request.args.get('days', 1, type=int)
     limit = request.args.get('limit', 100, type=int)
     from_date = request.args.get('from')
     to_date = request.args.get('to')
     resolution = request.args.get('resolution', 'raw')
+    output_format = request.args.get('format', 'rows')
+    if output_format not in ('rows', 'columnar'):
+        return api_response({
+            'success': False,
+            'message': f'Unsupported format: {output_format}'
+        }), 400
+    columnar = output_format == 'columnar'
     
     with app.app_context():
         device = Device.query.filter_by(device_id=device_id).first()
         if not device and device_id != 'all':
-            return jsonify({
+            return api_response({
                 'success': False,
                 'message': 'Device not found'
             }), 404
         
-        # Base query
-        query = SensorData.query
-        
         if device_id != 'all':
             # Check if user has access to this device
             if not user_has_access_to_device(user, device):
-                return jsonify({
+                return api_response({
                     'success': False,
                     'message': 'Access denied to this device'
                 }), 403
-            query = query.filter_by(device_id=device.device_id)
+            device_ids = [device.device_id]
         else:
             # For 'all', get all devices the user has access to
             accessible_devices = get_user_accessible_devices(user)
             if not accessible_devices:
-                return jsonify({
+                return api_response({
                     'success': True,
                     'device_id': device_id,
-                    'data': []
+                    **({'format': 'columnar', 'series': []} if columnar else {'data': []})
                 })
-            query = query.filter(SensorData.device_id.in_([d.device_id for d in accessible_devices]))
+            device_ids = [d.device_id for d in accessible_devices]
         
         # Apply date filters
+        since = None
+        until = None
         if from_date:
             try:
-                from_datetime = datetime.strptime(from_date, '%Y-%m-%d')
-                query = query.filter(SensorData.timestamp >= from_datetime)
+                since = datetime.strptime(from_date, '%Y-%m-%d')
             except ValueError:
                 pass  # Invalid date format, ignore
         elif days:
             # If no from_date, use days
             since = datetime.utcnow() - timedelta(days=days)
-            query = query.filter(SensorData.timestamp >= since)
         
         if to_date:
             try:
                 # Set to end of the day
-                to_datetime = datetime.strptime(to_date, '%Y-%m-%d')
-                to_datetime = to_datetime.replace(hour=23, minute=59, second=59)
-                query = query.filter(SensorData.timestamp <= to_datetime)
+                until = datetime.strptime(to_date, '%Y-%m-%d')
+                until = until.replace(hour=23, minute=59, second=59)
             except ValueError:
                 pass  # Invalid date format, ignore
         
         # Apply resolution (data aggregation)
-        if resolution == 'raw':
+        if resolution == 'raw' and columnar:
+            rows = newest_sensor_rows(device_ids, limit, since, until)
+            devices = [device] if device_id != 'all' else accessible_devices
+            readings = {}
+            for row_device_id, timestamp, value in rows:
+                readings.setdefault(row_device_id, []).append((timestamp, value))
+            return api_response(columnar_response(device_id, resolution, devices, readings))
+        
+        elif resolution == 'raw':
             # Just order and limit the results
-            data = query.order_by(SensorData.timestamp.desc()).limit(limit).all()
+            data = newest_sensor_rows(device_ids, limit, since, until)
+            # The devices are already loaded; look them up rather than query each row's
+            devices = [device] if device_id != 'all' else accessible_devices
+            devices_by_id = {d.device_id: d for d in devices}
             result = []
             
             for item in data:
-                # Get device information
-                device_info = Device.query.filter_by(device_id=item.device_id).first()
+                device_info = devices_by_id.get(item.device_id)
                 device_name = device_info.name if device_info else item.device_id
                 device_type = device_info.type if device_info else "unknown"
                 
@@ -620,121 +916,112 @@ def api_get_device_data(user, device_id):
                     'unit': get_unit_by_type(device_type)
                 })
             
-            return jsonify({
+            return api_response({
                 'success': True,
                 'device_id': device_id,
                 'data': result
             })
         
         elif resolution in ['hourly', 'daily']:
-            # Use SQLAlchemy's func for aggregation
-            from sqlalchemy import func
+            devices = [device] if device_id != 'all' else accessible_devices
+            aggregates = aggregate_sensor_data([d.device_id for d in devices], resolution, since, until)
+            
+            if columnar:
+                if device_id == 'all':
+                    # Keep the newest `limit` buckets across all devices
+                    newest = sorted(
+                        ((row, row_device_id) for row_device_id, rows in aggregates.items() for row in rows[:limit]),
+                        key=lambda item: item[0][0], reverse=True
+                    )[:limit]
+                    aggregates = {}
+                    for row, row_device_id in newest:
+                        aggregates.setdefault(row_device_id, []).append(row)
+                else:
+                    aggregates = {device.device_id: aggregates[device.device_id][:limit]}
+                return api_response(columnar_response(device_id, resolution, devices, aggregates))
             
-            # Different time grouping based on resolution
-            if resolution == 'hourly':
-                # Group by year, month, day, hour
-                date_trunc = func.date_format(SensorData.timestamp, '%Y-%m-%d %H:00:00')
-            else:  # daily
-                # Group by year, month, day
-                date_trunc = func.date_format(SensorData.timestamp, '%Y-%m-%d 00:00:00')
+            result = []
+            for item_device in devices:
+                for timestamp, avg_value, min_value, max_value, count in aggregates[item_device.device_id][:limit]:
+                    result.append({
+                        'timestamp': timestamp,
+                        'device_id': item_device.device_id,
+                        'device_name': item_device.name,
+                        'type': item_device.type,
+                        'value': avg_value,
+                        'min': min_value,
+                        'max': max_value,
+                        'count': count,
+                        'unit': get_unit_by_type(item_device.type)
+                    })
             
-            # For 'all' devices, we need to include device_id in the grouping
             if device_id == 'all':
-                result = []
-                # We need to query by device type separately to avoid mixing different metrics
-                device_types = db.session.query(Device.type).distinct().all()
-                
-                for device_type in device_types:
-                    type_value = device_type[0]
-                    # Get all devices of this type
-                    devices_of_type = Device.query.filter_by(type=type_value).all()
-                    if not devices_of_type:
-                        continue
-                    
-                    device_ids = [d.device_id for d in devices_of_type]
-                    # Only include devices the user has access to
-                    accessible_ids = [d for d in device_ids if any(ad.device_id == d for ad in accessible_devices)]
-                    if not accessible_ids:
-                        continue
-                    
-                    # For each device of this type
-                    for device_id in accessible_ids:
-                        agg_data = db.session.query(
-                            date_trunc.label('timestamp'),
-                            func.avg(SensorData.value).label('avg_value'),
-                            func.min(SensorData.value).label('min_value'),
-                            func.max(SensorData.value).label('max_value'),
-                            func.count(SensorData.value).label('count')
-                        ).filter(
-                            SensorData.device_id == device_id,
-                            SensorData.timestamp >= (datetime.utcnow() - timedelta(days=days) if not from_date else None),
-                            SensorData.timestamp <= (to_datetime if to_date else None)
-                        ).group_by(date_trunc).order_by(date_trunc.desc()).limit(limit).all()
-                        
-                        device_info = Device.query.filter_by(device_id=device_id).first()
-                        
-                        for item in agg_data:
-                            result.append({
-                                'timestamp': item.timestamp,
-                                'device_id': device_id,
-                                'device_name': device_info.name if device_info else device_id,
-                                'type': type_value,
-                                'value': item.avg_value,
-                                'min': item.min_value,
-                                'max': item.max_value,
-                                'count': item.count,
-                                'unit': get_unit_by_type(type_value)
-                            })
-                
-                # Sort by timestamp
+                # Sort by timestamp and limit total results
                 result.sort(key=lambda x: x['timestamp'], reverse=True)
-                # Limit total results
                 result = result[:limit]
-                
-                return jsonify({
-                    'success': True,
-                    'device_id': 'all',
-                    'data': result
-                })
             
-            else:
-                # For a single device, simpler aggregation
-                agg_data = db.session.query(
-                    date_trunc.label('timestamp'),
-                    func.avg(SensorData.value).label('avg_value'),
-                    func.min(SensorData.value).label('min_value'),
-                    func.max(SensorData.value).label('max_value'),
-                    func.count(SensorData.value).label('count')
-                ).filter(
-                    SensorData.device_id == device.device_id
-                ).group_by(date_trunc).order_by(date_trunc.desc()).limit(limit).all()
-                
-                result = []
-                for item in agg_data:
-                    result.append({
-                        'timestamp': item.timestamp,
-                        'device_id': device.device_id,
-                        'device_name': device.name,
-                        'type': device.type,
-                        'value': item.avg_value,
-                        'min': item.min_value,
-                        'max': item.max_value,
-                        'count': item.count,
-                        'unit': get_unit_by_type(device.type)
-                    })
-                
-                return jsonify({
-                    'success': True,
-                    'device_id': device_id,
-                    'data': result
-                })
+            return api_response({
+                'success': True,
+                'device_id': device_id,
+                'data': result
+            })
         
         else:
-            return jsonify({
+            return api_response({
                 'success': False,
                 'message': f'Unsupported resolution: {resolution}'
             }), 400
 
+EPOCH = datetime(1970, 1, 1)
+
+def epoch_ms(timestamp):
+    """Convert a naive UTC datetime or 'YYYY-MM-DD HH:MM:SS' bucket to epoch milliseconds."""
+    if isinstance(timestamp, str):
+        timestamp = datetime.fromisoformat(timestamp)
+    return (timestamp - EPOCH) // timedelta(milliseconds=1)
+
+def columnar_series(devices, rows_by_device, aggregated, skip_empty=False):
+    """Build columnar series, oldest first, from newest-first rows per device.
+    
+    Rows are (timestamp, value) for raw readings and (timestamp, avg, min,
+    max, count) for aggregates.
+    """
+    series = []
+    for item_device in devices:
+        rows = rows_by_device.get(item_device.device_id)
+        if not rows and skip_empty:
+            continue
+        rows = (rows or [])[::-1]
+        item = {
+            'device_id': item_device.device_id,
+            'device_name': item_device.name,
+            'type': item_device.type,
+            'unit': get_unit_by_type(item_device.type),
+            'timestamps': [epoch_ms(row[0]) for row in rows],
+            'values': [row[1] for row in rows]
+        }
+        if aggregated:
+            item['min'] = [row[2] for row in rows]
+            item['max'] = [row[3] for row in rows]
+            item['count'] = [row[4] for row in rows]
+        series.append(item)
+    return series
+
+def columnar_response(device_id, resolution, devices, rows_by_device):
+    """Build the columnar payload of /api/devices/<id>/data.
+    
+    A single device always gets a series; for 'all', devices without
+    readings are left out.
+    """
+    return {
+        'success': True,
+        'device_id': device_id,
+        'format': 'columnar',
+        'resolution': resolution,
+        'series': columnar_series(devices, rows_by_device, resolution != 'raw',
+                                  skip_empty=device_id == 'all')
+    }
+
 # Add a helper function to get user accessible devices
 def get_user_accessible_devices(user):
     """Get all devices a user has access to."""
@@ -772,20 +1059,248 @@ def get_unit_by_type(sensor_type):
     }
     return units.get(sensor_type, '')
 
+def time_bucket(column, resolution):
+    """Truncate a timestamp column to the hour ('hourly') or day ('daily').
+    
+    Buckets are returned as 'YYYY-MM-DD HH:00:00' strings on every supported
+    database.
+    """
+    from sqlalchemy import func
+    dialect = db.engine.dialect.name
+    if dialect == 'postgresql':
+        fmt = 'YYYY-MM-DD HH24:00:00' if resolution == 'hourly' else 'YYYY-MM-DD 00:00:00'
+        return func.to_char(column, fmt)
+    fmt = '%Y-%m-%d %H:00:00' if resolution == 'hourly' else '%Y-%m-%d 00:00:00'
+    if dialect == 'sqlite':
+        return func.strftime(fmt, column)
+    return func.date_format(column, fmt)
+
+def parse_percentiles(value):
+    """Parse a 'percentiles=50,95,99' parameter into a list of floats."""
+    percentiles = []
+    for part in value.split(','):
+        part = part.strip()
+        if not part:
+            continue
+        percentile = float(part)
+        if not 0 <= percentile <= 100:
+            raise ValueError(f'Percentile out of range: {part}')
+        percentiles.append(percentile)
+    return percentiles
+
+def percentile_key(percentile):
+    """Format a percentile as a response key, e.g. 95 -> 'p95', 99.9 -> 'p99.9'."""
+    return f"p{percentile:g}"
+
+def summarize_sensor_data(device_ids, since=None, until=None, until_inclusive=True):
+    """Summarize readings of the given devices between since and until.
+    
+    Whole hours are served from the hourly sketches; only the partial hours at
+    the edges of the window are read from sensor_data.
+    Returns a (RunningStats, DDSketch) pair.
+    """
+    stats, sketch = RunningStats(), DDSketch()
+    
+    first_full = None
+    if since:
+        first_full = sketch_bucket_start(since)
+        if first_full < since:
+            first_full += SKETCH_BUCKET
+    last_full_end = sketch_bucket_start(until) if until else None
+    
+    raw_ranges = []
+    if first_full and last_full_end and first_full >= last_full_end:
+        # The window does not contain a whole bucket
+        raw_ranges.append((since, until))
+    else:
+        sketch_query = db.session.query(
+            SensorDataSketch.count, SensorDataSketch.mean, SensorDataSketch.m2,
+            SensorDataSketch.min_value, SensorDataSketch.max_value, SensorDataSketch.sketch
+        ).filter(SensorDataSketch.device_id.in_(device_ids))
+        if first_full:
+            sketch_query = sketch_query.filter(SensorDataSketch.bucket_start >= first_full)
+            raw_ranges.append((since, first_full))
+        if last_full_end:
+            sketch_query = sketch_query.filter(SensorDataSketch.bucket_start < last_full_end)
+            if until_inclusive or last_full_end < until:
+                raw_ranges.append((last_full_end, until))
+        for count, mean, m2, min_value, max_value, sketch_json in sketch_query:
+            stats.merge(RunningStats(count, mean, m2, min_value, max_value))
+            sketch.merge(DDSketch.from_json(sketch_json))
+    
+    shard_groups = sharding.group_by_shard(device_ids) if raw_ranges else {}
+    for range_start, range_end in raw_ranges:
+        for shard, shard_device_ids in shard_groups.items():
+            query = db.session.query(SensorData.value).filter(SensorData.device_id.in_(shard_device_ids))
+            if range_start:
+                query = query.filter(SensorData.timestamp >= range_start)
+            if range_end:
+                if range_end is until and until_inclusive:
+                    query = query.filter(SensorData.timestamp <= range_end)
+                else:
+                    query = query.filter(SensorData.timestamp < range_end)
+            with sharding.use(shard):
+                for (value,) in query:
+                    stats.add(value)
+                    sketch.add(value)
+    return stats, sketch
+
+def summarize_sensor_days(device_ids, days):
+    """Summarize readings of the given devices per whole day from the hourly sketches.
+    
+    Returns {day: (RunningStats, DDSketch)} for every day in `days`.
+    """
+    summaries = {day: (RunningStats(), DDSketch()) for day in days}
+    query = db.session.query(
+        SensorDataSketch.bucket_start, SensorDataSketch.count, SensorDataSketch.mean,
+        SensorDataSketch.m2, SensorDataSketch.min_value, SensorDataSketch.max_value,
+        SensorDataSketch.sketch
+    ).filter(
+        SensorDataSketch.device_id.in_(device_ids),
+        SensorDataSketch.bucket_start >= min(days),
+        SensorDataSketch.bucket_start < max(days) + timedelta(days=1)
+    )
+    for bucket_start, count, mean, m2, min_value, max_value, sketch_json in query:
+        summary = summaries.get(bucket_start.replace(hour=0))
+        if summary:
+            summary[0].merge(RunningStats(count, mean, m2, min_value, max_value))
+            summary[1].merge(DDSketch.from_json(sketch_json))
+    return summaries
+
+def summarize_sensor_data_cached(device_ids, since=None, until=None):
+    """Summarize readings like summarize_sensor_data, serving closed days from the result cache."""
+    cache = result_cache.cache
+    cache.sync(db.session)
+    days, head, tail = cache.split_window(since, until)
+    if not days:
+        return summarize_sensor_data(device_ids, since, until)
+    
+    scope = frozenset(device_ids)
+    stats, sketch = RunningStats(), DDSketch()
+    missing = []
+    for day in days:
+        summary = cache.get('statistics', (scope, day))
+        if summary is None:
+            missing.append(day)
+        else:
+            stats.merge(summary[0])
+            sketch.merge(summary[1])
+    if missing:
+        for day, summary in summarize_sensor_days(device_ids, missing).items():
+            cache.set('statistics', (scope, day), summary, scope, day)
+            stats.merge(summary[0])
+            sketch.merge(summary[1])
+    
+    # The partial first day and the open days are always computed
+    partials = [summarize_sensor_data(device_ids, tail[0], tail[1])]
+    if head:
+        partials.append(summarize_sensor_data(device_ids, head[0], head[1], until_inclusive=False))
+    for partial_stats, partial_sketch in partials:
+        stats.merge(partial_stats)
+        sketch.merge(partial_sketch)
+    return stats, sketch
+
+def aggregate_sensor_rows(device_ids, resolution, since=None, until=None, until_inclusive=True):
+    """Return (device_id, timestamp, avg, min, max, count) rows per device and time bucket."""
+    from sqlalchemy import func
+    date_trunc = time_bucket(SensorData.timestamp, resolution)
+    rows = []
+    for shard, shard_device_ids in sharding.group_by_shard(device_ids).items():
+        query = db.session.query(
+            SensorData.device_id,
+            date_trunc.label('timestamp'),
+            func.avg(SensorData.value).label('avg_value'),
+            func.min(SensorData.value).label('min_value'),
+            func.max(SensorData.value).label('max_value'),
+            func.count(SensorData.value).label('count')
+        ).filter(SensorData.device_id.in_(shard_device_ids))
+        if since:
+            query = query.filter(SensorData.timestamp >= since)
+        if until:
+            if until_inclusive:
+                query = query.filter(SensorData.timestamp <= until)
+            else:
+                query = query.filter(SensorData.timestamp < until)
+        with sharding.use(shard):
+            rows.extend(query.group_by(SensorData.device_id, date_trunc).all())
+    return rows
+
+def aggregate_sensor_data(device_ids, resolution, since=None, until=None):
+    """Aggregate readings of the given devices into hourly or daily buckets.
+    
+    Closed days are served from the result cache. Returns {device_id: rows}
+    with (timestamp, avg, min, max, count) rows, newest first.
+    """
+    cache = result_cache.cache
+    cache.sync(db.session)
+    days, head, tail = cache.split_window(since, until)
+    buckets = {device_id: [] for device_id in device_ids}
+    
+    missing = set()
+    for device_id in device_ids:
+        for day in days:
+            rows = cache.get('aggregates', (device_id, resolution, day))
+            if rows is None:
+                missing.add((device_id, day))
+            else:
+                buckets[device_id].extend(rows)
+    if missing:
+        fresh = {key: [] for key in missing}
+        missing_days = {day for _, day in missing}
+        for row in aggregate_sensor_rows(sorted({device_id for device_id, _ in missing}), resolution,
+                                         min(missing_days), max(missing_days) + timedelta(days=1),
+                                         until_inclusive=False):
+            rows = fresh.get((row[0], datetime.strptime(row[1][:10], '%Y-%m-%d')))
+            if rows is not None:
+                rows.append(tuple(row[1:]))
+        for (device_id, day), rows in fresh.items():
+            cache.set('aggregates', (device_id, resolution, day), rows, (device_id,), day)
+            buckets[device_id].extend(rows)
+    
+    # The partial first day and the open days are always computed
+    if days:
+        ranges = [(tail[0], tail[1], True)] + ([(head[0], head[1], False)] if head else [])
+    else:
+        ranges = [(since, until, True)]
+    for range_start, range_end, inclusive in ranges:
+        for row in aggregate_sensor_rows(device_ids, resolution, range_start, range_end, inclusive):
+            buckets[row[0]].append(tuple(row[1:]))
+    
+    for rows in buckets.values():
+        rows.sort(key=lambda row: row[0], reverse=True)
+    return buckets
+
 @app.route('/api/data/statistics', methods=['GET'])
 @token_required
 def api_get_data_statistics(user):
-    """Get statistics for sensor data."""
+    """Get statistics for sensor data.
+    
+    Returns count, min, max, avg, std_dev and the percentiles requested with
+    `percentiles=` (default 50,95,99), estimated to within 1%.
+    """
     device_id = request.args.get('device_id')
     data_type = request.args.get('type')
     days = request.args.get('days', 7, type=int)
     from_date = request.args.get('from')
     to_date = request.args.get('to')
+    try:
+        percentiles = parse_percentiles(request.args.get('percentiles', '50,95,99'))
+    except ValueError:
+        return jsonify({
+            'success': False,
+            'message': 'Invalid percentiles parameter. Use comma-separated values between 0 and 100.'
+        }), 400
+    
+    empty_statistics = {
+        'count': 0,
+        'min': None,
+        'max': None,
+        'avg': None,
+        'std_dev': None,
+        'percentiles': {percentile_key(p): None for p in percentiles}
+    }
     
     with app.app_context():
-        # Base query
-        query = SensorData.query
-        
         # Filter by device if specified
         if device_id and device_id != 'all':
             device = Device.query.filter_by(device_id=device_id).first()
@@ -802,68 +1317,49 @@ def api_get_data_statistics(user):
                     'message': 'Access denied to this device'
                 }), 403
                 
-            query = query.filter_by(device_id=device.device_id)
+            device_ids = [device.device_id]
         else:
             # For 'all', get all devices the user has access to
-            accessible_devices = get_user_accessible_devices(user)
-            if not accessible_devices:
-                return jsonify({
-                    'success': True,
-                    'statistics': {
-                        'count': 0,
-                        'min': None,
-                        'max': None,
-                        'avg': None
-                    }
-                })
-            query = query.filter(SensorData.device_id.in_([d.device_id for d in accessible_devices]))
+            device_ids = [d.device_id for d in get_user_accessible_devices(user)]
         
         # Filter by type if specified
         if data_type and data_type != 'all':
             # Find devices of this type
-            devices_of_type = Device.query.filter_by(type=data_type).all()
-            if not devices_of_type:
-                return jsonify({
-                    'success': True,
-                    'statistics': {
-                        'count': 0,
-                        'min': None,
-                        'max': None,
-                        'avg': None
-                    }
-                })
-            
-            query = query.filter(SensorData.device_id.in_([d.device_id for d in devices_of_type]))
+            devices_of_type = {d.device_id for d in Device.query.filter_by(type=data_type).all()}
+            device_ids = [d for d in device_ids if d in devices_of_type]
+        
+        if not device_ids:
+            return jsonify({
+                'success': True,
+                'statistics': empty_statistics
+            })
         
         # Apply date filters
+        since = None
+        until = None
         if from_date:
             try:
-                from_datetime = datetime.strptime(from_date, '%Y-%m-%d')
-                query = query.filter(SensorData.timestamp >= from_datetime)
+                since = datetime.strptime(from_date, '%Y-%m-%d')
             except ValueError:
                 pass  # Invalid date format, ignore
         elif days:
             # If no from_date, use days
             since = datetime.utcnow() - timedelta(days=days)
-            query = query.filter(SensorData.timestamp >= since)
         
         if to_date:
             try:
                 # Set to end of the day
-                to_datetime = datetime.strptime(to_date, '%Y-%m-%d')
-                to_datetime = to_datetime.replace(hour=23, minute=59, second=59)
-                query = query.filter(SensorData.timestamp <= to_datetime)
+                until = datetime.strptime(to_date, '%Y-%m-%d')
+                until = until.replace(hour=23, minute=59, second=59)
             except ValueError:
                 pass  # Invalid date format, ignore
         
-        # Calculate statistics using SQLAlchemy's func
-        from sqlalchemy import func
-        stats = db.session.query(
-            func.count(SensorData.id).label('count'),
-            func.min(SensorData.value).label('min'),
-            func.max(SensorData.value).label('max'),
-            func.avg(SensorData.value).label('avg')
-        ).filter(query.whereclause).first()
+        stats, sketch = summarize_sensor_data_cached(device_ids, since, until)
+        if not stats.count:
+            return jsonify({
+                'success': True,
+                'statistics': empty_statistics
+            })
         
         return jsonify({
             'success': True,
@@ -871,8 +1367,172 @@ def api_get_data_statistics(user):
                 'count': stats.count,
                 'min': stats.min,
                 'max': stats.max,
-                'avg': stats.avg
+                'avg': stats.mean,
+                'std_dev': stats.std_dev,
+                'percentiles': {percentile_key(p): sketch.quantile(p / 100) for p in percentiles}
+            }
+        })
+
+def parse_time_window(default_days):
+    """Read the days/from/to request arguments into a (since, until) pair."""
+    since = None
+    until = None
+    from_date = request.args.get('from')
+    to_date = request.args.get('to')
+    days = request.args.get('days', default_days, type=int)
+    if from_date:
+        try:
+            since = datetime.strptime(from_date, '%Y-%m-%d')
+        except ValueError:
+            pass  # Invalid date format, ignore
+    elif days:
+        since = datetime.utcnow() - timedelta(days=days)
+    if to_date:
+        try:
+            # Set to end of the day
+            until = datetime.strptime(to_date, '%Y-%m-%d').replace(hour=23, minute=59, second=59)
+        except ValueError:
+            pass  # Invalid date format, ignore
+    return since, until
+
+def accessible_devices_query(user):
+    """Query the devices a user may read, with rooms and floors joined."""
+    query = Device.query.join(Room, Device.room_id == Room.id).join(Floor, Room.floor_id == Floor.id)
+    if user.is_admin:
+        return query
+    shared_home_ids = db.session.query(HomeAccess.home_id).filter(HomeAccess.user_id == user.id)
+    return query.join(Home, Floor.home_id == Home.id).filter(
+        (Home.owner_id == user.id) | Home.id.in_(shared_home_ids)
+    )
+
+def latest_readings(device_ids, limit, since=None, until=None):
+    """Return the newest `limit` (timestamp, value) readings per device, newest first."""
+    from sqlalchemy import func
+    position = func.row_number().over(
+        partition_by=SensorData.device_id,
+        order_by=SensorData.timestamp.desc()
+    ).label('position')
+    readings = {}
+    for shard, shard_device_ids in sharding.group_by_shard(device_ids).items():
+        ranked = db.session.query(
+            SensorData.device_id, SensorData.timestamp, SensorData.value, position
+        ).filter(SensorData.device_id.in_(shard_device_ids))
+        if since:
+            ranked = ranked.filter(SensorData.timestamp >= since)
+        if until:
+            ranked = ranked.filter(SensorData.timestamp <= until)
+        ranked = ranked.subquery()
+        
+        rows = db.session.query(
+            ranked.c.device_id, ranked.c.timestamp, ranked.c.value
+        ).filter(ranked.c.position <= limit).order_by(ranked.c.device_id, ranked.c.timestamp.desc())
+        with sharding.use(shard):
+            for device_id, timestamp, value in rows:
+                readings.setdefault(device_id, []).append((timestamp, value))
+    return readings
+
+def newest_sensor_rows(device_ids, limit, since=None, until=None):
+    """Return the newest `limit` (device_id, timestamp, value) readings of the devices, newest first."""
+    per_shard = []
+    for shard, shard_device_ids in sharding.group_by_shard(device_ids).items():
+        query = db.session.query(
+            SensorData.device_id, SensorData.timestamp, SensorData.value
+        ).filter(SensorData.device_id.in_(shard_device_ids))
+        if since:
+            query = query.filter(SensorData.timestamp >= since)
+        if until:
+            query = query.filter(SensorData.timestamp <= until)
+        with sharding.use(shard):
+            per_shard.append(query.order_by(SensorData.timestamp.desc()).limit(limit).all())
+    if len(per_shard) == 1:
+        return per_shard[0]
+    return list(islice(heapq.merge(*per_shard, key=lambda row: row[1], reverse=True), limit))
+
+@app.route('/api/data/series', methods=['GET'])
+@token_required
+def api_get_data_series(user):
+    """Get time series for several devices in one request.
+    
+    Devices are selected with `device_ids=a,b,c` or with `room_id`,
+    `floor_id` or `home_id`. Takes the same days/from/to/limit/resolution
+    arguments as /api/devices/<id>/data (`limit` applies per device, up to
+    SERIES_MAX_POINTS) and returns its columnar format, with a series for
+    every selected device. Requested device_ids that don't exist or aren't
+    accessible are listed in `denied`; the request only fails (403) when
+    none of them is.
+    """
+    resolution = request.args.get('resolution', 'raw')
+    limit = request.args.get('limit', 100, type=int)
+    limit = max(1, min(limit, app.config.get('SERIES_MAX_POINTS', 1000)))
+    if resolution not in ('raw', 'hourly', 'daily'):
+        return api_response({
+            'success': False,
+            'message': f'Unsupported resolution: {resolution}'
+        }), 400
+    max_devices = app.config.get('SERIES_MAX_DEVICES', 200)
+    
+    with app.app_context():
+        query = accessible_devices_query(user)
+        requested_ids = None
+        if request.args.get('device_ids'):
+            requested_ids = list(dict.fromkeys(
+                part.strip() for part in request.args['device_ids'].split(',') if part.strip()
+            ))
+            if len(requested_ids) > max_devices:
+                return api_response({
+                    'success': False,
+                    'message': f'At most {max_devices} devices can be requested at once'
+                }), 400
+            query = query.filter(Device.device_id.in_(requested_ids))
+        elif request.args.get('room_id', type=int):
+            query = query.filter(Device.room_id == request.args.get('room_id', type=int))
+        elif request.args.get('floor_id', type=int):
+            query = query.filter(Room.floor_id == request.args.get('floor_id', type=int))
+        elif request.args.get('home_id', type=int):
+            query = query.filter(Floor.home_id == request.args.get('home_id', type=int))
+        else:
+            return api_response({
+                'success': False,
+                'message': 'Specify device_ids, room_id, floor_id or home_id'
+            }), 400
+        
+        devices = query.order_by(Device.id).limit(max_devices + 1).all()
+        denied = []
+        if requested_ids is not None:
+            found = {device.device_id for device in devices}
+            denied = [device_id for device_id in requested_ids if device_id not in found]
+            if not devices:
+                return api_response({
+                    'success': False,
+                    'message': f"Devices not found or access denied: {', '.join(denied)}"
+                }), 403
+            # Keep the order the client asked for
+            position = {device_id: index for index, device_id in enumerate(requested_ids)}
+            devices.sort(key=lambda device: position[device.device_id])
+        elif len(devices) > max_devices:
+            return api_response({
+                'success': False,
+                'message': f'Scope contains more than {max_devices} devices; use device_ids'
+            }), 400
+        
+        since, until = parse_time_window(1)
+        device_ids = [device.device_id for device in devices]
+        if not device_ids:
+            rows = {}
+        elif resolution == 'raw':
+            rows = latest_readings(device_ids, limit, since, until)
+        else:
+            rows = {
+                device_id: device_rows[:limit]
+                for device_id, device_rows in aggregate_sensor_data(device_ids, resolution, since, until).items()
             }
+        
+        return api_response({
+            'success': True,
+            'format': 'columnar',
+            'resolution': resolution,
+            'series': columnar_series(devices, rows, resolution != 'raw'),
+            'denied': denied
         })
 
 @app.route('/api/device_data/<sensor_type>', methods=['GET'])
@@ -882,75 +1542,49 @@ def api_get_sensor_data(sensor_type):
     days = request.args.get('days', 1, type=int)
     limit = request.args.get('limit', 100, type=int)
     if not device_id:
-        return jsonify({
+        return api_response({
             'success': False,
             'message': 'Device ID is required'
         }), 400
     with app.app_context():
-        # Create a mapping between frontend device IDs and database device IDs
-        known_mappings = {
-            'temp_living_room_f1': 'temperature_living_room_f1',
-            'humidity_living_room_f1': 'humidity_living_room_f1'
-        }
-        # Use the mapped ID if available
-        mapped_id = known_mappings.get(device_id, device_id)
-        device = Device.query.filter_by(device_id=mapped_id).first()
-        # If still not found, try additional fallback methods
-        if not device and device_id.startswith('temp_'):
-            # Try with 'temperature_' prefix
-            corrected_id = device_id.replace('temp_', 'temperature_')
-            device = Device.query.filter_by(device_id=corrected_id).first()
-        if not device:
-            # Try to find device by room name and sensor type
-            parts = device_id.split('_')
-            if len(parts) >= 3:
-                # Extract room name and floor number
-                if parts[0] in ['temp', 'temperature', 'humidity', 'light']:
-                    room_parts = parts[1:-1]  # Middle parts are room name
-                    floor_part = parts[-1]    # Last part is floor number
-                    room_name = ' '.join(word.capitalize() for word in room_parts)
-                    # Map sensor type if needed
-                    if parts[0] == 'temp':
-                        search_type = 'temperature'
-                    else:  # humidity
-                        search_type = parts[0]
-                    # Find the room
-                    room = Room.query.filter(Room.name.ilike(room_name)).first()
-                    if room:
-                        # Find device by room and type
-                        device = Device.query.filter_by(
-                            room_id=room.id, 
-                            type=search_type
-                        ).first()
-        # If still not found, create a dummy response to prevent errors
-        if not device:
+        # Frontend ids (e.g. 'temp_living_room_f1') are aliases resolved in memory
+        actual_device_id = device_aliases.index.resolve(db.session, device_id)
+        # If not found, create a dummy response to prevent errors
+        if not actual_device_id:
             logger.warning(f"Device not found for ID: {device_id}, sensor type: {sensor_type}. Returning empty data.")
-            return jsonify({
+            return api_response({
                 'success': True,
                 'device_id': device_id,
                 'sensor_type': sensor_type,
                 'data': []
             })
         # Log successful mapping if ID was different
-        if device_id != device.device_id:
-            logger.info(f"Mapped request {device_id} to device {device.device_id}")
+        if device_id != actual_device_id:
+            logger.info(f"Mapped request {device_id} to device {actual_device_id}")
         # Get sensor data for the specified time range
         since = datetime.utcnow() - timedelta(days=days)
-        data = SensorData.query.filter_by(device_id=device.device_id)\
-            .filter(SensorData.timestamp >= since)\
-            .order_by(SensorData.timestamp.desc())\
-            .limit(limit).all()
-        return jsonify({
+        with sharding.for_device(actual_device_id):
+            data = SensorData.query.filter_by(device_id=actual_device_id)\
+                .filter(SensorData.timestamp >= since)\
+                .order_by(SensorData.timestamp.desc())\
+                .limit(limit).all()
+        return api_response({
             'success': True,
             'device_id': device_id,
-            'actual_device_id': device.device_id,
+            'actual_device_id': actual_device_id,
             'sensor_type': sensor_type,
             'data': [item.to_dict() for item in data]
         })
 
 @app.route('/api/devices/<device_id>/control', methods=['POST'])
-def api_control_device(device_id):
-    """Control a device without MQTT or socketio. Supports both token and session auth."""
+@session_or_token_required
+def api_control_device(user, device_id):
+    """Send a command to a device. Supports both token and session auth.
+    
+    The command is published asynchronously; the response carries the id of
+    the pending UserAction, whose status becomes success, failed or timeout
+    once the device answers (see GET /api/actions/<id>).
+    """
     data = request.json
     if not data or 'action' not in data:
         return jsonify({
@@ -958,40 +1592,6 @@ def api_control_device(device_id):
             'message': 'Invalid request. Action required.'
         }), 400
     
-    # Check authentication - try both token and session auth
-    user = None
-    
-    # First check if user is logged in via Flask-Login session
-    if current_user.is_authenticated:
-        user = current_user
-    else:
-        # If not using session auth, check for token auth
-        token = None
-        # Check if token is in headers
-        if 'Authorization' in request.headers:
-            auth_header = request.headers['Authorization']
-            if auth_header.startswith('Bearer '):
-                token = auth_header[7:]  # Remove 'Bearer ' prefix
-        # Check if token is in query parameters
-        if not token and 'access_token' in request.args:
-            token = request.args.get('access_token')
-        
-        if token:
-            # Find user with this token
-            user = User.query.filter_by(access_token=token).first()
-            if not user or not user.token_expiry or user.token_expiry < datetime.now(timezone.utc):
-                return jsonify({
-                    'success': False,
-                    'message': 'Invalid or expired token'
-                }), 401
-    
-    # If no valid authentication found, return unauthorized
-    if not user:
-        return jsonify({
-            'success': False,
-            'message': 'Authentication required'
-        }), 401
-    
     with app.app_context():
         device = Device.query.filter_by(device_id=device_id).first()
         if not device:
@@ -1008,46 +1608,312 @@ def api_control_device(device_id):
         action = data['action']
         value = data.get('value')
         
-        # Record user action
-        user_action_data = {
-            'device_id': device.device_id,
-            'action': action,
-            'value': str(value) if value is not None else None,
-            'user_id': user.id
-        }
-        user_action = UserAction(**user_action_data)
-        db.session.add(user_action)
+        try:
+            user_action = device_commands.dispatcher.send(device, action, value, user_id=user.id)
+        except device_commands.CommandQueueFull:
+            return jsonify({
+                'success': False,
+                'message': 'Too many commands awaiting acknowledgement, try again shortly'
+            }), 503, {'Retry-After': '1'}
         
-        # Update device state directly based on the action
-        if action == 'toggle':
-            # Toggle the device state
-            device.state = not device.state
-        elif action == 'on':
-            device.state = True
-        elif action == 'off':
-            device.state = False
-        elif action == 'set':
-            # Set the device value (for dimmers, thermostats, etc.)
-            device.value = value
-            device.state = value > 0 if isinstance(value, (int, float)) else bool(value)
+        return jsonify({
+            'success': True,
+            'message': f'Command sent: {action}',
+            'action_id': user_action.id,
+            'status': 'pending'
+        }), 202
+
+def is_valid_command(action, value):
+    """Return True if a command has a non-empty action name and a scalar (or no) value."""
+    return (isinstance(action, str) and bool(action.strip())
+            and (value is None or isinstance(value, (str, int, float, bool))))
+
+@app.route('/api/commands', methods=['POST'])
+@session_or_token_required
+def api_batch_commands(user):
+    """Send commands to many devices in one request (scenes, "all lights off").
+    
+    The body is either a list of commands,
+    
+        {"commands": [{"device_id": "...", "action": "off", "value": null}, ...]}
+    
+    or one command for every device of a room, floor or home, optionally
+    restricted to a device type:
+    
+        {"home_id": 1, "type": "light", "action": "off"}
+    
+    Access is checked once for the whole set and all UserActions are written
+    in a single transaction. Every device gets an outcome: pending (with the
+    action_id to poll), denied (not found or no access), invalid (no action
+    name, or a value that is not a string, number or boolean) or rejected
+    (too many commands awaiting acknowledgement).
+    """
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        return jsonify({
+            'success': False,
+            'message': 'Invalid request. JSON body required.'
+        }), 400
+    max_devices = app.config.get('COMMAND_BATCH_MAX_DEVICES', 500)
+    
+    with app.app_context():
+        query = accessible_devices_query(user)
+        if 'commands' in data:
+            commands = data['commands']
+            if not isinstance(commands, list) or not all(isinstance(command, dict) for command in commands):
+                return jsonify({
+                    'success': False,
+                    'message': 'commands must be a list of objects'
+                }), 400
+            if len(commands) > max_devices:
+                return jsonify({
+                    'success': False,
+                    'message': f'At most {max_devices} commands can be sent at once'
+                }), 400
+            requested_ids = {str(command.get('device_id')) for command in commands}
+            devices = query.filter(Device.device_id.in_(requested_ids)).all()
+        else:
+            if 'action' not in data:
+                return jsonify({
+                    'success': False,
+                    'message': 'Invalid request. Action required.'
+                }), 400
+            if not is_valid_command(data['action'], data.get('value')):
+                return jsonify({
+                    'success': False,
+                    'message': 'action must be a non-empty string and value a string, number or boolean'
+                }), 400
+            if data.get('room_id') is not None:
+                query = query.filter(Device.room_id == data['room_id'])
+            elif data.get('floor_id') is not None:
+                query = query.filter(Room.floor_id == data['floor_id'])
+            elif data.get('home_id') is not None:
+                query = query.filter(Floor.home_id == data['home_id'])
+            else:
+                return jsonify({
+                    'success': False,
+                    'message': 'Specify commands, room_id, floor_id or home_id'
+                }), 400
+            if data.get('type'):
+                query = query.filter(Device.type == data['type'])
+            devices = query.order_by(Device.id).limit(max_devices + 1).all()
+            if len(devices) > max_devices:
+                return jsonify({
+                    'success': False,
+                    'message': f'Scope contains more than {max_devices} devices; use commands'
+                }), 400
+            commands = [
+                {'device_id': device.device_id, 'action': data['action'], 'value': data.get('value')}
+                for device in devices
+            ]
         
-        # Update device status to reflect the change
-        device.status = 'online'
-        device.last_updated = datetime.utcnow()
+        devices_by_id = {device.device_id: device for device in devices}
+        dispatcher = device_commands.dispatcher
+        capacity = dispatcher.max_in_flight - len(dispatcher)
+        results = []
+        accepted = []
+        for command in commands:
+            device_id = command.get('device_id')
+            action = command.get('action')
+            result = {'device_id': device_id, 'action': action}
+            device = devices_by_id.get(str(device_id))
+            if device is None:
+                result['status'] = 'denied'
+            elif not is_valid_command(action, command.get('value')):
+                result['status'] = 'invalid'
+            elif len(accepted) >= capacity:
+                metrics.device_commands.inc(action, 'rejected')
+                result['status'] = 'rejected'
+            else:
+                value = command.get('value')
+                user_action = UserAction(
+                    device_id=device.device_id,
+                    action=action,
+                    value=str(value) if value is not None else None,
+                    user_id=user.id,
+                    status='pending'
+                )
+                accepted.append((result, user_action, device, value))
+            results.append(result)
         
-        # Update user action status
-        user_action.status = 'success'
+        # One transaction for every command, then publish them all; publishing
+        # only queues the message, so devices receive their commands together
+        db.session.add_all([user_action for _, user_action, _, _ in accepted])
+        db.session.flush()
+        action_ids = {}
+        for _, user_action, device, _ in accepted:
+            action_ids.setdefault(sharding.device_shard(device.device_id), []).append(user_action.id)
         db.session.commit()
-            
+        topics = {}
+        if accepted:
+            # Reload what the commit expired in two queries (one per shard) rather than two per command
+            for shard, shard_action_ids in action_ids.items():
+                with sharding.use(shard):
+                    UserAction.query.filter(UserAction.id.in_(shard_action_ids)).all()
+            Device.query.filter(Device.device_id.in_(list(devices_by_id))).all()
+            topics = dispatcher.control_topics([device.device_id for _, _, device, _ in accepted])
+        failed = []
+        for result, user_action, device, value in accepted:
+            result['action_id'] = user_action.id
+            try:
+                dispatcher.submit(user_action, device, value, topic=topics[device.device_id])
+                result['status'] = 'pending'
+            except device_commands.CommandQueueFull:
+                user_action.status = 'failed'
+                failed.append(user_action)
+                result['status'] = 'rejected'
+        if failed:
+            db.session.commit()
+        
+        summary = {}
+        for result in results:
+            summary[result['status']] = summary.get(result['status'], 0) + 1
+        sent = summary.get('pending', 0)
+        return jsonify({
+            'success': sent > 0,
+            'message': f'{sent} of {len(results)} commands sent',
+            'summary': summary,
+            'results': results
+        }), 202 if sent else 200
+
+@app.route('/api/actions/<int:action_id>', methods=['GET'])
+@session_or_token_required
+def api_get_action(user, action_id):
+    """Get the status of a device command."""
+    with app.app_context():
+        user_action = sharding.find(db.session, UserAction, action_id)
+        if not user_action:
+            return jsonify({
+                'success': False,
+                'message': 'Action not found'
+            }), 404
+        if not user.is_admin and user_action.user_id != user.id:
+            device = Device.query.filter_by(device_id=user_action.device_id).first()
+            if not device or not user_has_access_to_device(user, device):
+                return jsonify({
+                    'success': False,
+                    'message': 'Access denied to this action'
+                }), 403
         return jsonify({
             'success': True,
-            'message': f'Command processed: {action}',
-            'action_id': user_action.id,
-            'new_state': {
-                'state': device.state,
-                'value': device.value,
-                'status': device.status
-            }
+            'action': user_action.to_dict()
+        })
+
+@app.route('/api/automations', methods=['GET'])
+@session_or_token_required
+def api_get_automations(user):
+    """List the automation rules of the user (every rule for admins)."""
+    with app.app_context():
+        query = AutomationRule.query
+        if not user.is_admin:
+            query = query.filter_by(user_id=user.id)
+        return jsonify({
+            'success': True,
+            'automations': [rule.to_dict() for rule in query.order_by(AutomationRule.id)]
+        })
+
+@app.route('/api/automations', methods=['POST'])
+@session_or_token_required
+def api_add_automation(user):
+    """Create an automation rule: a command sent to a device when readings cross a threshold.
+    
+        {"name": "Cool the living room", "trigger_room_id": 3, "trigger_type": "temperature",
+         "operator": ">", "threshold": 27, "target_device_id": "ac_living_room",
+         "action": "on", "debounce": 60, "cooldown": 900}
+    
+    The trigger is trigger_device_id, or trigger_room_id with an optional
+    trigger_type; the user needs access to the trigger and the target.
+    """
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        return jsonify({
+            'success': False,
+            'message': 'Invalid request. JSON body required.'
+        }), 400
+    missing = [field for field in ('name', 'threshold', 'target_device_id', 'action') if data.get(field) is None]
+    if missing or not (data.get('trigger_device_id') or data.get('trigger_room_id')):
+        return jsonify({
+            'success': False,
+            'message': 'name, threshold, target_device_id, action and trigger_device_id or trigger_room_id required'
+        }), 400
+    operator = data.get('operator', '>')
+    if operator not in automation.OPERATORS:
+        return jsonify({
+            'success': False,
+            'message': f"operator must be one of {', '.join(automation.OPERATORS)}"
+        }), 400
+    try:
+        threshold = float(data['threshold'])
+        debounce = int(data.get('debounce', 0))
+        cooldown = int(data.get('cooldown', 300))
+    except (TypeError, ValueError):
+        return jsonify({
+            'success': False,
+            'message': 'threshold, debounce and cooldown must be numbers'
+        }), 400
+    
+    with app.app_context():
+        target = Device.query.filter_by(device_id=data['target_device_id']).first()
+        if data.get('trigger_device_id'):
+            trigger = Device.query.filter_by(device_id=data['trigger_device_id']).first()
+            trigger_allowed = trigger is not None and user_has_access_to_device(user, trigger)
+        else:
+            trigger = db.session.get(Room, data['trigger_room_id'])
+            trigger_allowed = trigger is not None and user_has_access_to_room(user, trigger)
+        if not target or not trigger:
+            return jsonify({
+                'success': False,
+                'message': 'Trigger or target not found'
+            }), 404
+        if not trigger_allowed or not user_has_access_to_device(user, target):
+            return jsonify({
+                'success': False,
+                'message': 'Access denied to the trigger or target'
+            }), 403
+        value = data.get('value')
+        rule = AutomationRule(
+            name=data['name'],
+            user_id=user.id,
+            trigger_device_id=data.get('trigger_device_id') or None,
+            trigger_room_id=None if data.get('trigger_device_id') else trigger.id,
+            trigger_type=data.get('trigger_type') or None,
+            operator=operator,
+            threshold=threshold,
+            target_device_id=target.device_id,
+            action=data['action'],
+            value=str(value) if value is not None else None,
+            debounce=debounce,
+            cooldown=cooldown
+        )
+        db.session.add(rule)
+        db.session.commit()
+        return jsonify({
+            'success': True,
+            'message': 'Automation created',
+            'automation': rule.to_dict()
+        }), 201
+
+@app.route('/api/automations/<int:rule_id>', methods=['DELETE'])
+@session_or_token_required
+def api_delete_automation(user, rule_id):
+    """Delete an automation rule of the user."""
+    with app.app_context():
+        rule = db.session.get(AutomationRule, rule_id)
+        if not rule:
+            return jsonify({
+                'success': False,
+                'message': 'Automation not found'
+            }), 404
+        if not user.is_admin and rule.user_id != user.id:
+            return jsonify({
+                'success': False,
+                'message': 'Access denied to this automation'
+            }), 403
+        db.session.delete(rule)
+        db.session.commit()
+        return jsonify({
+            'success': True,
+            'message': 'Automation deleted'
         })
 
 @app.route('/api/homes', methods=['GET'])
@@ -1070,7 +1936,7 @@ def api_get_homes():
     # If token exists, look up the user
     if token:
         user = User.query.filter_by(access_token=token).first()
-        if not user or not user.token_expiry or user.token_expiry < datetime.now(timezone.utc):
+        if not user or not user.token_expiry or user.token_expiry < datetime.utcnow():
             return jsonify({
                 'success': False,
                 'message': 'Invalid or expired token'
@@ -1128,23 +1994,24 @@ def api_get_floors(user):
                 'success': False,
                 'message': 'Access denied to this home'
             }), 403
-        # Get floors for this home
-        floors = Floor.query.filter_by(home_id=home_id).order_by(Floor.floor_number).all()
+        # Get floors and their rooms in one query; device counts are denormalized
+        floors = Floor.query.options(joinedload(Floor.rooms))\
+            .filter_by(home_id=home_id).order_by(Floor.floor_number).all()
         floors_data = []
         for floor in floors:
             rooms_data = []
             for room in floor.rooms:
-                devices_count = Device.query.filter_by(room_id=room.id).count()
                 rooms_data.append({
                     'id': room.id,
                     'name': room.name,
                     'room_type': room.room_type,
-                    'device_count': devices_count
+                    **room.counters_to_dict()
                 })
             floors_data.append({
                 'id': floor.id,
                 'floor_number': floor.floor_number,
                 'name': floor.name,
+                **floor.counters_to_dict(),
                 'rooms': rooms_data
             })
         return jsonify({
@@ -1167,7 +2034,7 @@ def validate_token():
     # Find user with this token
     user = User.query.filter_by(access_token=token).first()
     # Check if token is valid
-    if not user or not user.token_expiry or user.token_expiry < datetime.now(timezone.utc):
+    if not user or not user.token_expiry or user.token_expiry < datetime.utcnow():
         return jsonify({
             'valid': False,
             'message': 'Invalid or expired token'
@@ -1201,25 +2068,29 @@ def get_floors_with_rooms():
                 (Home.owner_id == current_user.id) | 
                 (Home.id.in_([access.home_id for access in current_user.home_accesses]))
             ).all()
-        for home in homes:
-            for floor in home.floors:
-                rooms_data = []
-                for room in floor.rooms:
-                    device_count = Device.query.filter_by(room_id=room.id).count()
-                    rooms_data.append({
-                        "id": room.id,
-                        "name": room.name,
-                        "room_type": room.room_type,
-                        "device_count": device_count
-                    })
-                floors_data.append({
-                    "id": floor.id,
-                    "floor_number": floor.floor_number,
-                    "name": floor.name or f"Floor {floor.floor_number}",
-                    "home_name": home.name,
-                    "home_id": home.id,
-                    "rooms": rooms_data
+        # Load homes, floors and rooms together; device counts are denormalized
+        floors = Floor.query.join(Floor.home)\
+            .options(contains_eager(Floor.home), joinedload(Floor.rooms))\
+            .filter(Floor.home_id.in_([home.id for home in homes]))\
+            .order_by(Floor.home_id, Floor.floor_number).all()
+        for floor in floors:
+            rooms_data = []
+            for room in floor.rooms:
+                rooms_data.append({
+                    "id": room.id,
+                    "name": room.name,
+                    "room_type": room.room_type,
+                    **room.counters_to_dict()
                 })
+            floors_data.append({
+                "id": floor.id,
+                "floor_number": floor.floor_number,
+                "name": floor.name or f"Floor {floor.floor_number}",
+                "home_name": floor.home.name,
+                "home_id": floor.home_id,
+                **floor.counters_to_dict(),
+                "rooms": rooms_data
+            })
     return floors_data
 
 # Helper functions for access control
@@ -1316,7 +2187,7 @@ def api_get_user_homes():
             'homes': [home.to_dict() for home in homes]
         })
 
-# Run the application
+# Run the development server (use serve.py in production)
 if __name__ == '__main__':
     init_app()
     app.run(
@@ -0,0 +1,266 @@
+"""Home automation: device commands triggered by readings.
+
+An AutomationRule reads "when <trigger> <operator> <threshold>, send
+<action> to <target device>", e.g. living room temperature > 27 turns on
+the AC. The trigger is one device, or the devices of a room (optionally of
+one type); a room trigger compares each reading of any of those devices.
+
+Rules are compiled into a dependency index from trigger device id to the
+rules that read it (room triggers are expanded to the room's devices), so a
+committed reading only visits the rules that depend on it. A rule fires once
+its condition has held for `debounce` seconds, if at least `cooldown`
+seconds have passed since it last fired, and fires again only after the
+condition has cleared.
+
+Commands are sent on a background thread through CommandDispatcher.send(),
+the path of /api/devices/<id>/control, and recorded as UserActions of the
+AUTOMATION_USERNAME user. The time from committing the triggering reading to
+publishing the command is recorded in automation_reading_to_command_seconds.
+Rules are recompiled when rules or devices change in this process and every
+AUTOMATION_RULES_REFRESH seconds.
+"""
+import time
+import queue
+import secrets
+import logging
+import threading
+from datetime import datetime
+from operator import itemgetter
+
+from sqlalchemy import event, inspect, select, update
+from sqlalchemy.orm import Session
+
+import metrics
+import device_commands
+from alerts import OPERATORS
+from models import db, User, Device, SensorData, AutomationRule
+
+# Get logger
+logger = logging.getLogger('smart_home.automation')
+
+_EPOCH = datetime(1970, 1, 1)
+_READINGS_KEY = 'automation_readings'
+_CHANGED_KEY = 'automation_changed'
+
+
+def epoch_seconds(timestamp):
+    return (timestamp - _EPOCH).total_seconds()
+
+
+class CompiledAutomation:
+    """An AutomationRule reduced to what evaluating it needs, with its state."""
+    __slots__ = ('id', 'name', 'compare', 'threshold', 'target_device_id', 'action', 'value',
+                 'debounce', 'cooldown', 'signature', 'state')
+
+    def __init__(self, rule):
+        self.id = rule.id
+        self.name = rule.name
+        self.compare = OPERATORS[rule.operator]
+        self.threshold = rule.threshold
+        self.target_device_id = rule.target_device_id
+        self.action = rule.action
+        self.value = rule.value
+        self.debounce = rule.debounce or 0
+        self.cooldown = rule.cooldown or 0
+        self.signature = (rule.trigger_device_id, rule.trigger_room_id, rule.trigger_type, rule.operator,
+                          rule.threshold, rule.target_device_id, rule.action, rule.value,
+                          self.debounce, self.cooldown)
+        last_fired = epoch_seconds(rule.last_triggered_at) if rule.last_triggered_at else None
+        # [start of the current run of matching readings, fired, time it last fired]
+        self.state = [None, False, last_fired]
+
+    def check(self, value, at):
+        """Update the state with a reading at `at` (epoch seconds); return True if the rule fires."""
+        state = self.state
+        if self.compare(value, self.threshold):
+            if state[0] is None:
+                state[0] = at
+            if (not state[1] and at - state[0] >= self.debounce
+                    and (state[2] is None or at - state[2] >= self.cooldown)):
+                state[1] = True
+                state[2] = at
+                return True
+        else:
+            state[0] = None
+            state[1] = False
+        return False
+
+
+class AutomationEngine:
+    """Evaluates readings against the rules that depend on their device."""
+
+    def __init__(self, refresh=60.0):
+        self.enabled = False
+        self.refresh = refresh
+        self.stale = True
+        self.loaded_at = None
+        self.username = 'automation'
+        self._rules = {}
+        self._index = {}
+        self._user_id = None
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+
+    def load(self, rules, devices):
+        """Compile `rules` against the (device id, type, room id) of the devices in their rooms."""
+        devices_by_room = {}
+        for device_id, device_type, room_id in devices:
+            devices_by_room.setdefault(room_id, []).append((device_id, device_type))
+        compiled, index = {}, {}
+        for rule in rules:
+            if rule.operator not in OPERATORS:
+                logger.warning(f"Skipping automation rule {rule.id}: unsupported operator {rule.operator}")
+                continue
+            automation = CompiledAutomation(rule)
+            previous = self._rules.get(rule.id)
+            if previous is not None and previous.signature == automation.signature:
+                automation.state = previous.state
+            if rule.trigger_device_id:
+                triggers = [rule.trigger_device_id]
+            else:
+                triggers = [device_id for device_id, device_type in devices_by_room.get(rule.trigger_room_id, ())
+                            if rule.trigger_type in (None, device_type)]
+            compiled[rule.id] = automation
+            for device_id in triggers:
+                index.setdefault(device_id, []).append(automation)
+        with self._lock:
+            self._rules, self._index = compiled, index
+            self.loaded_at = time.monotonic()
+
+    def reload(self):
+        with db.engine.connect() as connection:
+            rules = connection.execute(
+                select(AutomationRule).where(AutomationRule.is_active.is_(True))
+            ).all()
+            room_ids = {rule.trigger_room_id for rule in rules if not rule.trigger_device_id}
+            devices = connection.execute(
+                select(Device.device_id, Device.type, Device.room_id).where(Device.room_id.in_(room_ids))
+            ).all() if room_ids else []
+        self.load(rules, devices)
+        self.stale = False
+        logger.info(f"Compiled {len(self._rules)} automation rule(s) over {len(self._index)} trigger device(s)")
+
+    def process(self, readings, committed_at=None):
+        """Evaluate (device id, value, timestamp) readings in order; queue the commands of fired rules."""
+        if self.stale or time.monotonic() - self.loaded_at >= self.refresh:
+            self.reload()
+        fired = []
+        with self._lock:
+            index = self._index
+            if not index:
+                return fired
+            for device_id, value, timestamp in readings:
+                automations = index.get(device_id)
+                if automations:
+                    at = epoch_seconds(timestamp)
+                    for automation in automations:
+                        if automation.check(value, at):
+                            fired.append(automation)
+        if fired:
+            self._queue.put((fired, committed_at or time.monotonic()))
+        return fired
+
+    def system_user_id(self):
+        """Return the id of the user automation commands are recorded as, creating it if missing."""
+        if self._user_id is None:
+            user = User.query.filter_by(username=self.username).first()
+            if user is None:
+                user = User(username=self.username, email=f'{self.username}@localhost',
+                            first_name='Automation')
+                user.set_password(secrets.token_urlsafe(32))
+                db.session.add(user)
+                db.session.commit()
+                logger.info(f"Created automation user {self.username}")
+            self._user_id = user.id
+        return self._user_id
+
+    def send(self, automations, committed_at):
+        """Send the commands of fired rules, as the automation user."""
+        user_id = self.system_user_id()
+        targets = {automation.target_device_id for automation in automations}
+        devices = {device.device_id: device for device in Device.query.filter(Device.device_id.in_(targets))}
+        for automation in automations:
+            device = devices.get(automation.target_device_id)
+            if device is None:
+                metrics.automation_commands.inc('missing_device')
+                logger.warning(f"Automation {automation.name}: device {automation.target_device_id} not found")
+                continue
+            try:
+                user_action = device_commands.dispatcher.send(device, automation.action, automation.value, user_id=user_id)
+            except device_commands.CommandQueueFull:
+                metrics.automation_commands.inc('rejected')
+                logger.warning(f"Automation {automation.name}: too many commands awaiting acknowledgement")
+                continue
+            metrics.automation_commands.inc('sent')
+            metrics.automation_latency.observe(time.monotonic() - committed_at)
+            logger.info(f"Automation {automation.name}: sent {automation.action} to {device.device_id} "
+                        f"(action {user_action.id})")
+        db.session.execute(
+            update(AutomationRule)
+            .where(AutomationRule.id.in_([automation.id for automation in automations]))
+            .values(last_triggered_at=datetime.utcnow())
+        )
+        db.session.commit()
+
+    def run(self, app):
+        while True:
+            automations, committed_at = self._queue.get()
+            try:
+                with app.app_context():
+                    self.send(automations, committed_at)
+            except Exception:
+                logger.exception('Sending automation commands failed')
+
+
+engine = AutomationEngine()
+
+
+@event.listens_for(Session, 'after_flush')
+def _collect_readings(session, flush_context):
+    if not engine.enabled:
+        return
+    readings = [
+        (instance.device_id, instance.value, instance.timestamp) for instance in session.new
+        if isinstance(instance, SensorData) and instance.timestamp is not None
+    ]
+    if readings:
+        session.info.setdefault(_READINGS_KEY, []).extend(readings)
+    new, deleted = session.new, session.deleted
+    for instance in list(new) + list(session.dirty) + list(deleted):
+        if isinstance(instance, AutomationRule):
+            session.info[_CHANGED_KEY] = True
+        elif isinstance(instance, Device):
+            state = inspect(instance)
+            if (instance in new or instance in deleted
+                    or state.attrs.type.history.has_changes() or state.attrs.room_id.history.has_changes()):
+                session.info[_CHANGED_KEY] = True
+
+
+@event.listens_for(Session, 'after_commit')
+def _evaluate_readings(session):
+    if session.info.pop(_CHANGED_KEY, False):
+        engine.stale = True
+    readings = session.info.pop(_READINGS_KEY, None)
+    if readings:
+        readings.sort(key=itemgetter(2))
+        try:
+            engine.process(readings, time.monotonic())
+        except Exception:
+            # Automation must never fail the write that stored the readings
+            logger.exception('Automation evaluation failed')
+
+
+@event.listens_for(Session, 'after_rollback')
+def _discard_readings(session):
+    session.info.pop(_READINGS_KEY, None)
+    session.info.pop(_CHANGED_KEY, None)
+
+
+def init_app(app):
+    """Evaluate automation rules on stored readings and send their commands."""
+    engine.enabled = app.config.get('AUTOMATION_ENABLED', True)
+    if not engine.enabled:
+        return
+    engine.username = app.config.get('AUTOMATION_USERNAME', 'automation')
+    engine.refresh = app.config.get('AUTOMATION_RULES_REFRESH', 60.0)
+    threading.Thread(target=engine.run, args=(app,), name='automation', daemon=True).start()
@@ -0,0 +1,11 @@
+"""Benchmark suite for the Smart Home Dashboard.
+
+Seed a database at one of the scale profiles and time every page and API
+endpoint with realistic access mixes:
+
+    python -m benchmarks.run --profile small
+    python -m benchmarks.compare baseline.json candidate.json
+    python -m benchmarks.serialization
+    python -m benchmarks.load --profile small
+    python -m benchmarks.concurrency --profile small
+"""
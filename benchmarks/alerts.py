@@ -0,0 +1,94 @@
+"""Measure alert rule evaluation throughput in readings per second.
+
+Usage:
+    python -m benchmarks.alerts
+    python -m benchmarks.alerts --devices 5000 --readings 1000000 --batch 500
+
+Rules and devices are synthetic: a humidity threshold held for 10 minutes, a
+windowed count and a 3 sigma deviation rule per device type, a temperature
+deviation rule against the room's baseline, plus a device rule for one device
+in ten. Readings arrive every few seconds per device and are fed to
+alerts.AlertEngine in batches, as the commit hook does; the time includes
+sorting each batch by timestamp. The target is 50,000 readings/s.
+"""
+import time
+import random
+import argparse
+from types import SimpleNamespace
+from datetime import datetime, timedelta
+from operator import itemgetter
+
+from alerts import AlertEngine
+
+TARGET = 50000
+DEVICE_TYPES = ('temperature', 'humidity', 'light')
+VALUE_RANGES = {'temperature': (18.0, 30.0), 'humidity': (40.0, 80.0), 'light': (0.0, 1000.0)}
+
+
+def rule(rule_id, name, kind, **fields):
+    values = {'device_id': None, 'device_type': None, 'room_id': None, 'operator': '>', 'threshold': None,
+              'duration': 0, 'window': 300, 'min_count': 1, 'sigma': 3.0, 'alpha': 0.1}
+    values.update(fields)
+    return SimpleNamespace(id=rule_id, name=name, kind=kind, **values)
+
+
+def build_rules(device_ids, rng):
+    rules = [
+        rule(1, 'Humid for 10 minutes', 'threshold', device_type='humidity', threshold=70.0, duration=600),
+        rule(2, 'Humidity spikes', 'count', device_type='humidity', threshold=78.0, min_count=5, window=300),
+        rule(3, 'Temperature anomaly', 'deviation', device_type='temperature', sigma=3.0, alpha=0.05),
+        rule(4, 'Too hot', 'threshold', device_type='temperature', threshold=29.5),
+        rule(5, 'Light anomaly', 'deviation', device_type='light', sigma=3.0),
+        rule(6, 'Room temperature anomaly', 'deviation', device_type='temperature', room_id=1, sigma=3.0),
+    ]
+    for device_id in device_ids[::10]:
+        rules.append(rule(len(rules) + 1, f'{device_id} low', 'threshold', device_id=device_id,
+                          operator='<', threshold=rng.uniform(0, 20), duration=300))
+    return rules
+
+
+def readings(device_types, count, rng):
+    """Yield (device id, value, timestamp) readings, a few seconds apart per device."""
+    device_ids = list(device_types)
+    now = datetime(2026, 1, 1)
+    step = timedelta(seconds=5.0 / len(device_ids))
+    for i in range(count):
+        device_id = device_ids[i % len(device_ids)]
+        low, high = VALUE_RANGES[device_types[device_id]]
+        yield device_id, round(rng.uniform(low, high), 2), now + step * i
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Alert rule evaluation throughput')
+    parser.add_argument('--devices', type=int, default=1000, help='Devices sending readings')
+    parser.add_argument('--readings', type=int, default=500000, help='Readings to evaluate')
+    parser.add_argument('--batch', type=int, default=200, help='Readings per committed batch')
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    device_types = {f'DEV-{i:06d}': DEVICE_TYPES[i % len(DEVICE_TYPES)] for i in range(args.devices)}
+    rules = build_rules(list(device_types), rng)
+    engine = AlertEngine()
+    engine.load(rules, ((device_id, (device_type, 1)) for device_id, device_type in device_types.items()))
+
+    data = list(readings(device_types, args.readings, rng))
+    batches = [data[i:i + args.batch] for i in range(0, len(data), args.batch)]
+    alerts = 0
+    start = time.perf_counter()
+    for batch in batches:
+        batch.sort(key=itemgetter(2))
+        alerts += len(engine.process(batch))
+    elapsed = time.perf_counter() - start
+
+    evaluations = sum(len(watch) for watch in engine._watches.values()) / max(len(engine._watches), 1)
+    rate = len(data) / elapsed
+    print(f"{'devices':>8} {'rules':>6} {'rules/reading':>14} {'readings':>9} {'alerts':>7} "
+          f"{'seconds':>8} {'readings/s':>11}")
+    print(f"{args.devices:>8} {len(rules):>6} {evaluations:>14.2f} {len(data):>9} {alerts:>7} "
+          f"{elapsed:>8.3f} {rate:>11.0f}")
+    print(f"Target {TARGET} readings/s: {'met' if rate >= TARGET else 'missed'}")
+
+
+if __name__ == '__main__':
+    main()
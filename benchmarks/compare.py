@@ -0,0 +1,81 @@
+"""Compare two benchmark reports produced by `python -m benchmarks.run`.
+
+Usage:
+    python -m benchmarks.compare baseline.json candidate.json --threshold 10
+
+Exits with status 1 when any benchmark's p95 regresses by more than the
+threshold (in percent) and by more than --min-ms milliseconds.
+"""
+import sys
+import json
+import argparse
+
+
+def load(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+def change(old, new):
+    if old in (None, 0) or new is None:
+        return None
+    return (new - old) / old * 100
+
+
+def compare(baseline, candidate, threshold, min_ms, metric='p95_ms'):
+    """Return (rows, regressions) for benchmarks present in both reports."""
+    rows = []
+    regressions = []
+    for key in sorted(set(baseline['results']) | set(candidate['results'])):
+        old = baseline['results'].get(key)
+        new = candidate['results'].get(key)
+        if not old or not new:
+            rows.append((key, old and old[metric], new and new[metric], None, 'added' if new else 'removed'))
+            continue
+        delta = change(old[metric], new[metric])
+        note = ''
+        if new['errors'] > old['errors']:
+            note = f"errors {old['errors']} -> {new['errors']}"
+        if delta is not None and delta > threshold and new[metric] - old[metric] > min_ms:
+            note = 'REGRESSION' + (f', {note}' if note else '')
+            regressions.append(key)
+        elif delta is not None and delta < -threshold and old[metric] - new[metric] > min_ms:
+            note = 'improved' + (f', {note}' if note else '')
+        rows.append((key, old[metric], new[metric], delta, note))
+    return rows, regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare two benchmark reports')
+    parser.add_argument('baseline', help='Report of the baseline commit')
+    parser.add_argument('candidate', help='Report of the candidate commit')
+    parser.add_argument('--metric', default='p95_ms',
+                        choices=['mean_ms', 'p50_ms', 'p95_ms', 'p99_ms', 'db_queries_mean'],
+                        help='Metric to compare')
+    parser.add_argument('--threshold', type=float, default=10.0,
+                        help='Relative change in percent considered significant')
+    parser.add_argument('--min-ms', type=float, default=0.5,
+                        help='Ignore absolute changes smaller than this')
+    args = parser.parse_args()
+
+    baseline = load(args.baseline)
+    candidate = load(args.candidate)
+    if baseline.get('dataset') != candidate.get('dataset'):
+        print('Warning: reports were produced on different datasets')
+
+    rows, regressions = compare(baseline, candidate, args.threshold, args.min_ms, args.metric)
+    print(f"{baseline['git']['commit'] or '?'} -> {candidate['git']['commit'] or '?'} ({args.metric})")
+    print(f"{'benchmark':<36} {'baseline':>10} {'candidate':>10} {'change':>9}")
+    for key, old, new, delta, note in rows:
+        old_text = f'{old:.2f}' if old is not None else '-'
+        new_text = f'{new:.2f}' if new is not None else '-'
+        delta_text = f'{delta:+.1f}%' if delta is not None else '-'
+        print(f'{key:<36} {old_text:>10} {new_text:>10} {delta_text:>9}  {note}')
+
+    if regressions:
+        print(f'{len(regressions)} regression(s) above {args.threshold}%')
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,186 @@
+"""Measure reader latency while writers insert sensor data, per SQLite profile.
+
+Usage:
+    python -m benchmarks.concurrency --profile small
+    python -m benchmarks.concurrency --readers 4 --writers 2 --duration 20
+
+The seeded database is copied first, so the writes do not change it. For
+each settings profile, reader processes time data API requests through the
+app (first alone, then while writer processes commit batches of readings
+through the ORM as fast as they can). The "previous" profile is SQLite's
+own defaults (rollback journal, synchronous=FULL, pysqlite's 5 s busy
+timeout); "tuned" is the Config defaults applied by database.py.
+"""
+import os
+import json
+import time
+import random
+import sqlite3
+import tempfile
+import argparse
+import multiprocessing
+from datetime import datetime
+
+from benchmarks.profiles import PROFILES
+from benchmarks.run import (
+    DATA_DIR, RESULTS_DIR, SCENARIOS, seed_database, load_app, prepare_roles,
+    issue, percentile, git_revision
+)
+
+SETTINGS = {
+    'previous': {
+        'SQLITE_JOURNAL_MODE': 'DELETE',
+        'SQLITE_SYNCHRONOUS': 'FULL',
+        'SQLITE_BUSY_TIMEOUT': '5000',
+        'SQLITE_MMAP_SIZE': '0',
+        'SQLITE_CACHE_SIZE': '-2000',
+    },
+    'tuned': {},
+}
+READ_SCENARIOS = ('data_single_raw', 'data_batch_charts', 'stats_single')
+
+
+def read_loop(database_url, settings, ctx, stop_at, seed):
+    """Issue data API requests until `stop_at`; return (ms, status) samples."""
+    os.environ.update(settings)
+    app_module = load_app(database_url)
+    client = app_module.app.test_client()
+    scenarios = [scenario for scenario in SCENARIOS if scenario.name in READ_SCENARIOS]
+    rng = random.Random(seed)
+    samples = []
+    while time.time() < stop_at:
+        scenario = rng.choice(scenarios)
+        elapsed, status, _, _ = issue(client, scenario, ctx)
+        samples.append((elapsed, status))
+    return samples
+
+
+def write_loop(database_url, settings, device_ids, batch, stop_at, seed):
+    """Commit batches of readings until `stop_at`; return (rows, errors, commit ms)."""
+    os.environ.update(settings)
+    app_module = load_app(database_url)
+    from models import db, SensorData
+
+    rng = random.Random(seed)
+    rows, errors, commits = 0, 0, []
+    with app_module.app.app_context():
+        while time.time() < stop_at:
+            now = datetime.utcnow()
+            db.session.add_all([
+                SensorData(device_id=rng.choice(device_ids), value=round(rng.uniform(15, 30), 2),
+                           unit='°C', timestamp=now)
+                for _ in range(batch)
+            ])
+            started = time.perf_counter()
+            try:
+                db.session.commit()
+                rows += batch
+            except Exception:
+                db.session.rollback()
+                errors += 1
+            commits.append((time.perf_counter() - started) * 1000)
+    return rows, errors, commits
+
+
+def summarize(samples):
+    times = sorted(sample[0] for sample in samples)
+    return {
+        'requests': len(times),
+        'errors': sum(1 for sample in samples if sample[1] >= 500),
+        'p50_ms': round(percentile(times, 0.50), 3) if times else None,
+        'p99_ms': round(percentile(times, 0.99), 3) if times else None,
+        'max_ms': round(times[-1], 3) if times else None,
+    }
+
+
+def run_phase(pool, database_url, settings, ctx, args, writers):
+    # Processes import the app before `stop_at` starts counting down
+    stop_at = time.time() + args.startup + args.duration
+    readers = [pool.apply_async(read_loop, (database_url, settings, ctx, stop_at, args.seed + i))
+               for i in range(args.readers)]
+    device_ids = ctx['sensor_ids'].split(',')
+    writes = [pool.apply_async(write_loop, (database_url, settings, device_ids, args.batch, stop_at, args.seed + i))
+              for i in range(writers)]
+    samples = [sample for reader in readers for sample in reader.get()]
+    result = {'readers': summarize(samples)}
+    if writes:
+        written = [write.get() for write in writes]
+        commits = sorted(ms for _, _, commit_ms in written for ms in commit_ms)
+        result['writers'] = {
+            'rows': sum(rows for rows, _, _ in written),
+            'errors': sum(errors for _, errors, _ in written),
+            'commit_p99_ms': round(percentile(commits, 0.99), 3) if commits else None,
+        }
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Reader latency during sustained writes')
+    parser.add_argument('--profile', choices=sorted(PROFILES), default='small',
+                        help='Scale profile to seed and copy')
+    parser.add_argument('--database', help='SQLite database file to copy instead of a seeded profile')
+    parser.add_argument('--readers', type=int, default=2, help='Reader processes')
+    parser.add_argument('--writers', type=int, default=1, help='Writer processes')
+    parser.add_argument('--batch', type=int, default=200, help='Readings per write transaction')
+    parser.add_argument('--duration', type=float, default=10, help='Seconds per phase')
+    parser.add_argument('--startup', type=float, default=3,
+                        help='Seconds allowed for the processes to import the app')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--output', help='Path of the JSON report')
+    args = parser.parse_args()
+
+    source = args.database
+    if not source:
+        source = os.path.join(DATA_DIR, f'{args.profile}.db')
+        seed_database(args.profile, source, seed=args.seed)
+
+    results = {}
+    context = multiprocessing.get_context('spawn')
+    with tempfile.TemporaryDirectory() as directory:
+        for name, settings in SETTINGS.items():
+            path = os.path.join(directory, f'{name}.db')
+            with sqlite3.connect(source) as src, sqlite3.connect(path) as dst:
+                src.backup(dst)
+            database_url = f'sqlite:///{path}'
+            os.environ.update(settings)
+            ctx = prepare_roles(load_app(database_url))['owner']
+            with context.Pool(args.readers + args.writers) as pool:
+                results[name] = {
+                    'idle': run_phase(pool, database_url, settings, ctx, args, 0),
+                    'writes': run_phase(pool, database_url, settings, ctx, args, args.writers),
+                }
+            for key in settings:
+                os.environ.pop(key, None)
+
+    report = {
+        'schema': 1,
+        'created_at': datetime.utcnow().isoformat() + 'Z',
+        'git': git_revision(),
+        'settings': SETTINGS,
+        'readers': args.readers,
+        'writers': args.writers,
+        'batch': args.batch,
+        'duration_s': args.duration,
+        'results': results,
+    }
+    output = args.output or os.path.join(
+        RESULTS_DIR, f"concurrency-{(report['git']['commit'] or 'unknown')[:10]}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+
+    print(f"{'settings':<10} {'phase':<7} {'reads':>7} {'p50 ms':>9} {'p99 ms':>9} {'max ms':>9} "
+          f"{'errors':>7} {'rows/s':>9} {'commit p99':>11}")
+    for name, phases in results.items():
+        for phase, result in phases.items():
+            readers, writers = result['readers'], result.get('writers')
+            rows_per_second = f"{writers['rows'] / args.duration:.0f}" if writers else '-'
+            commit_p99 = f"{writers['commit_p99_ms']:.2f}" if writers and writers['commit_p99_ms'] else '-'
+            print(f"{name:<10} {phase:<7} {readers['requests']:>7} {readers['p50_ms'] or 0:>9.2f} "
+                  f"{readers['p99_ms'] or 0:>9.2f} {readers['max_ms'] or 0:>9.2f} "
+                  f"{readers['errors']:>7} {rows_per_second:>9} {commit_p99:>11}")
+    print(f"Report written to {output}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,110 @@
+"""Measure device search latency.
+
+Usage:
+    python -m benchmarks.device_search
+    python -m benchmarks.device_search --homes 5000 --devices-per-room 4
+
+Fills a fresh SQLite database with HOMES homes of ROOMS rooms holding
+DEVICES_PER_ROOM devices each (100,000 devices by default), builds the
+device_search index and times typeahead queries, as typed one character at
+a time, for an admin (every home) and for a user with access to a few
+homes. The target is every query answered in under 5 ms.
+"""
+import os
+import time
+import random
+import logging
+import argparse
+import tempfile
+
+from sqlalchemy import insert
+
+from benchmarks.run import load_app
+
+TARGET_MS = 5.0
+ROOM_NAMES = ('Living Room', 'Bedroom', 'Kitchen', 'Bathroom', 'Garage', 'Garden', 'Office', 'Hallway')
+DEVICE_TYPES = ('temperature', 'humidity', 'light', 'switch', 'motion', 'speaker')
+QUERIES = ('kitchen light', 'temperature 42', 'light-1234', 'home 17', 'office', 'garage motion', 'zzz')
+
+
+def populate(db, homes, rooms, devices_per_room, owner_id):
+    from models import Home, Floor, Room, Device
+    db.session.execute(insert(Home), [
+        {'id': h + 1, 'name': f'Home {h + 1}', 'address': f'{h + 1} Example Street', 'owner_id': owner_id}
+        for h in range(homes)
+    ])
+    db.session.execute(insert(Floor), [
+        {'id': h + 1, 'home_id': h + 1, 'floor_number': 1, 'name': 'Ground floor'} for h in range(homes)
+    ])
+    db.session.execute(insert(Room), [
+        {'id': h * rooms + r + 1, 'floor_id': h + 1, 'name': ROOM_NAMES[r % len(ROOM_NAMES)],
+         'room_type': ROOM_NAMES[r % len(ROOM_NAMES)].lower().replace(' ', '_')}
+        for h in range(homes) for r in range(rooms)
+    ])
+    devices = []
+    for room_id in range(1, homes * rooms + 1):
+        for d in range(devices_per_room):
+            device_type = DEVICE_TYPES[(room_id + d) % len(DEVICE_TYPES)]
+            number = len(devices)
+            devices.append({'device_id': f'{device_type}-{number}', 'name': f'{device_type.title()} {number % 100}',
+                            'type': device_type, 'room_id': room_id})
+    db.session.execute(insert(Device), devices)
+    db.session.commit()
+    return len(devices)
+
+
+def timed(index, session, queries, home_ids):
+    timings = []
+    for query in queries:
+        # As typed: 'k', 'ki', 'kit', ...
+        for end in range(1, len(query) + 1):
+            start = time.perf_counter()
+            index.search(session, query[:end], home_ids, limit=20)
+            timings.append((time.perf_counter() - start) * 1000)
+    timings.sort()
+    return timings
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Device search latency')
+    parser.add_argument('--homes', type=int, default=2500, help='Homes')
+    parser.add_argument('--rooms', type=int, default=8, help='Rooms per home')
+    parser.add_argument('--devices-per-room', type=int, default=5, help='Devices per room')
+    parser.add_argument('--user-homes', type=int, default=3, help='Homes the regular user can access')
+    args = parser.parse_args()
+
+    path = os.path.join(tempfile.mkdtemp(), 'device_search.db')
+    os.environ.setdefault('LIVENESS_ENABLED', 'false')
+    os.environ.setdefault('TABLE_STATS_ENABLED', 'false')
+    os.environ.setdefault('DEVICE_SEARCH_REFRESH', '0')
+    app_module = load_app(f'sqlite:///{path}')
+    logging.getLogger('smart_home').setLevel(logging.WARNING)
+    app_module.init_app()
+
+    import device_search
+    from models import db, User
+
+    with app_module.app.app_context():
+        owner = User(username='search-owner', email='search-owner@localhost')
+        owner.set_password('search-owner')
+        db.session.add(owner)
+        db.session.commit()
+        devices = populate(db, args.homes, args.rooms, args.devices_per_room, owner.id)
+
+        start = time.perf_counter()
+        device_search.index.load(db.session)
+        print(f'Indexed {devices} devices in {time.perf_counter() - start:.2f}s')
+
+        user_homes = set(random.Random(0).sample(range(1, args.homes + 1), args.user_homes))
+        print(f"{'scope':<8} {'queries':>7} {'p50 ms':>8} {'p99 ms':>8} {'max ms':>8}")
+        worst = 0.0
+        for scope, home_ids in (('admin', None), ('user', user_homes)):
+            timings = timed(device_search.index, db.session, QUERIES, home_ids)
+            worst = max(worst, timings[-1])
+            print(f'{scope:<8} {len(timings):>7} {timings[len(timings) // 2]:>8.3f} '
+                  f'{timings[int(len(timings) * 0.99)]:>8.3f} {timings[-1]:>8.3f}')
+    print(f"Target {TARGET_MS:.0f} ms per query: {'met' if worst <= TARGET_MS else 'missed'} ({worst:.2f} ms worst)")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,99 @@
+"""Measure bulk inventory import and export time.
+
+Usage:
+    python -m benchmarks.inventory
+    python -m benchmarks.inventory --homes 500 --devices-per-room 5
+
+Builds a synthetic apartment block inventory (HOMES homes of FLOORS floors
+with ROOMS rooms each) and imports it into a fresh SQLite database through
+inventory.import_homes(), the path of `flask import-homes` and
+POST /admin/api/inventory/import. The same inventory is then imported again,
+which only validates and finds every row unchanged, and exported as JSON and
+CSV. The target is 10,000 devices imported in under 10 seconds.
+"""
+import os
+import time
+import logging
+import argparse
+import tempfile
+
+from benchmarks.run import load_app
+
+TARGET_SECONDS = 10.0
+ROOM_TYPES = ('living_room', 'bedroom', 'kitchen', 'bathroom')
+DEVICE_TYPES = ('temperature', 'humidity', 'light', 'switch')
+
+
+def build_inventory(homes, floors, rooms, devices_per_room, owner):
+    inventory = []
+    for h in range(homes):
+        home = {'name': f'Block A, apartment {h + 1}', 'address': f'{h + 1} Example Street', 'owner': owner,
+                'floors': []}
+        for f in range(1, floors + 1):
+            floor = {'floor_number': f, 'name': f'Floor {f}', 'rooms': []}
+            for r in range(rooms):
+                room = {'name': f'Room {r + 1}', 'room_type': ROOM_TYPES[r % len(ROOM_TYPES)], 'devices': []}
+                for d in range(devices_per_room):
+                    device_type = DEVICE_TYPES[d % len(DEVICE_TYPES)]
+                    room['devices'].append({'device_id': f'{device_type}-{h}-{f}-{r}-{d}',
+                                            'name': f'{device_type.title()} {d + 1}', 'type': device_type})
+                floor['rooms'].append(room)
+            home['floors'].append(floor)
+        inventory.append(home)
+    return inventory
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Bulk inventory import and export time')
+    parser.add_argument('--homes', type=int, default=250, help='Homes to import')
+    parser.add_argument('--floors', type=int, default=2, help='Floors per home')
+    parser.add_argument('--rooms', type=int, default=5, help='Rooms per floor')
+    parser.add_argument('--devices-per-room', type=int, default=4, help='Devices per room')
+    args = parser.parse_args()
+
+    path = os.path.join(tempfile.mkdtemp(), 'inventory.db')
+    os.environ.setdefault('LIVENESS_ENABLED', 'false')
+    os.environ.setdefault('TABLE_STATS_ENABLED', 'false')
+    app_module = load_app(f'sqlite:///{path}')
+    logging.getLogger('smart_home').setLevel(logging.WARNING)
+    app_module.init_app()
+
+    import inventory
+    from models import db, User
+
+    with app_module.app.app_context():
+        owner = User(username='inventory-owner', email='inventory-owner@localhost')
+        owner.set_password('inventory-owner')
+        db.session.add(owner)
+        db.session.commit()
+
+        homes = build_inventory(args.homes, args.floors, args.rooms, args.devices_per_room, owner.username)
+        devices = args.homes * args.floors * args.rooms * args.devices_per_room
+
+        timings = []
+        start = time.perf_counter()
+        summary = inventory.import_homes(homes)
+        timings.append(('import', time.perf_counter() - start, summary['devices']['created']))
+        db.session.remove()
+
+        start = time.perf_counter()
+        summary = inventory.import_homes(homes)
+        timings.append(('re-import', time.perf_counter() - start, summary['devices']['unchanged']))
+        db.session.remove()
+
+        for name, export in (('export json', inventory.export_json), ('export csv', inventory.export_csv)):
+            start = time.perf_counter()
+            size = sum(len(chunk) for chunk in export())
+            timings.append((name, time.perf_counter() - start, size))
+
+    print(f"{'step':<12} {'seconds':>8} {'devices/s':>10}  result")
+    for name, elapsed, result in timings:
+        unit = 'bytes' if name.startswith('export') else 'devices'
+        print(f"{name:<12} {elapsed:>8.3f} {devices / elapsed:>10.0f}  {result} {unit}")
+    elapsed = timings[0][1] * 10000 / devices
+    print(f"Target 10000 devices in {TARGET_SECONDS:.0f}s: {'met' if elapsed <= TARGET_SECONDS else 'missed'} "
+          f"({elapsed:.2f}s per 10000 devices)")
+
+
+if __name__ == '__main__':
+    main()
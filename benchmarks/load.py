@@ -0,0 +1,224 @@
+"""Load-test the development server against the production server over HTTP.
+
+Usage:
+    python -m benchmarks.load --profile small
+    python -m benchmarks.load --concurrency 1 16 64 --duration 15 --workers 4
+
+Each server is started as a subprocess on a seeded database: `python app.py`
+(the Flask development server) and `python serve.py` (eventlet workers).
+Client processes then keep `--concurrency` keep-alive connections busy with
+a mix of dashboard page and data API requests for `--duration` seconds, and
+the report gives requests/s and latency percentiles per server and level.
+"""
+import os
+import sys
+import json
+import time
+import random
+import signal
+import argparse
+import http.client
+import subprocess
+import multiprocessing
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+
+from benchmarks.profiles import PROFILES
+from benchmarks.run import (
+    ROOT, DATA_DIR, RESULTS_DIR, SCENARIOS, seed_database, load_app, prepare_roles,
+    percentile, git_revision
+)
+
+# Dashboard page and the data APIs its charts call
+LOAD_SCENARIOS = ('page_dashboard', 'api_devices', 'data_single_raw', 'data_batch_charts', 'stats_single')
+
+
+def server_command(name, port, args):
+    if name == 'dev':
+        # app.py runs on a fixed port
+        return [sys.executable, os.path.join(ROOT, 'app.py')]
+    return [sys.executable, os.path.join(ROOT, 'serve.py'), '--port', str(port),
+            '--workers', str(args.workers), '--connections', str(args.connections)]
+
+
+def start_server(name, port, database_url, args):
+    """Start a server in its own process group and wait until /health answers."""
+    env = dict(os.environ, DATABASE_URL=database_url, PYTHONWARNINGS='ignore')
+    process = subprocess.Popen(
+        server_command(name, port, args), cwd=ROOT, env=env,
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, start_new_session=True
+    )
+    deadline = time.monotonic() + 60
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            sys.exit(f"{name} server exited with status {process.returncode}")
+        try:
+            connection = http.client.HTTPConnection('127.0.0.1', port, timeout=1)
+            connection.request('GET', '/health')
+            if connection.getresponse().status == 200:
+                return process
+        except OSError:
+            time.sleep(0.2)
+    stop_server(process)
+    sys.exit(f"{name} server did not start on port {port}")
+
+
+def stop_server(process):
+    try:
+        os.killpg(process.pid, signal.SIGTERM)
+        process.wait(timeout=10)
+    except ProcessLookupError:
+        pass
+    except subprocess.TimeoutExpired:
+        os.killpg(process.pid, signal.SIGKILL)
+        process.wait()
+
+
+def build_requests(ctx, session_cookie, names):
+    """Return (method, path, headers, weight) for the scenarios in `names`."""
+    requests = []
+    for scenario in SCENARIOS:
+        if scenario.name not in names or scenario.body is not None:
+            continue
+        headers = {}
+        if scenario.auth == 'token':
+            headers['Authorization'] = f"Bearer {ctx['token']}"
+        elif scenario.auth == 'session':
+            headers['Cookie'] = f'session={session_cookie}'
+        requests.append((scenario.method, scenario.path.format(**ctx), headers, scenario.weight))
+    return requests
+
+
+def client_connection(port, requests, stop_at, seed):
+    """Issue requests on one keep-alive connection until `stop_at`."""
+    rng = random.Random(seed)
+    weights = [request[3] for request in requests]
+    connection = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+    samples = []
+    while time.time() < stop_at:
+        method, path, headers, _ = rng.choices(requests, weights)[0]
+        started = time.perf_counter()
+        try:
+            connection.request(method, path, headers=headers)
+            response = connection.getresponse()
+            response.read()
+            status = response.status
+            if response.will_close:
+                connection.close()
+        except (OSError, http.client.HTTPException):
+            connection.close()
+            status = 599
+        samples.append(((time.perf_counter() - started) * 1000, status))
+    connection.close()
+    return samples
+
+
+def client_process(port, requests, stop_at, connections, seed):
+    """Run `connections` concurrent connections in one client process."""
+    with ThreadPoolExecutor(connections) as pool:
+        futures = [pool.submit(client_connection, port, requests, stop_at, seed * 1000 + i)
+                   for i in range(connections)]
+        return [sample for future in futures for sample in future.result()]
+
+
+def run_level(port, requests, concurrency, duration, seed):
+    """Keep `concurrency` connections busy for `duration` seconds."""
+    processes = max(1, min(concurrency, os.cpu_count() or 1))
+    shares = [concurrency // processes + (1 if i < concurrency % processes else 0) for i in range(processes)]
+    stop_at = time.time() + duration
+    with multiprocessing.Pool(processes) as pool:
+        results = pool.starmap(client_process, [
+            (port, requests, stop_at, share, seed + i) for i, share in enumerate(shares) if share
+        ])
+    samples = [sample for result in results for sample in result]
+    times = sorted(sample[0] for sample in samples)
+    errors = sum(1 for sample in samples if sample[1] >= 500)
+    return {
+        'concurrency': concurrency,
+        'requests': len(samples),
+        'errors': errors,
+        'requests_per_second': round(len(samples) / duration, 1),
+        'p50_ms': round(percentile(times, 0.50), 3) if times else None,
+        'p95_ms': round(percentile(times, 0.95), 3) if times else None,
+        'p99_ms': round(percentile(times, 0.99), 3) if times else None,
+        'max_ms': round(times[-1], 3) if times else None,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare the development and production servers under load')
+    parser.add_argument('--profile', choices=sorted(PROFILES), default='small',
+                        help='Scale profile to seed and benchmark')
+    parser.add_argument('--database-url',
+                        help='Benchmark an existing database instead of seeding a profile')
+    parser.add_argument('--servers', nargs='+', choices=('dev', 'eventlet'), default=['dev', 'eventlet'],
+                        help='Servers to compare')
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 16, 64],
+                        help='Concurrent client connections')
+    parser.add_argument('--duration', type=float, default=10,
+                        help='Seconds per concurrency level')
+    parser.add_argument('--port', type=int, default=8000,
+                        help='Port of the eventlet server (the development server uses 5000)')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1,
+                        help='Eventlet worker processes')
+    parser.add_argument('--connections', type=int, default=1000,
+                        help='Concurrent connections per eventlet worker')
+    parser.add_argument('--seed', type=int, default=42, help='Random seed for the request mix')
+    parser.add_argument('--output', help='Path of the JSON report')
+    args = parser.parse_args()
+
+    database_url = args.database_url
+    if not database_url:
+        path = os.path.join(DATA_DIR, f'{args.profile}.db')
+        seed_database(args.profile, path, seed=args.seed)
+        database_url = f'sqlite:///{path}'
+
+    # Tokens and a session cookie for a home owner, written to the database
+    # before the servers start
+    app_module = load_app(database_url)
+    roles = prepare_roles(app_module)
+    if 'owner' not in roles:
+        sys.exit('No home owner with devices in the database')
+    ctx = roles['owner']
+    session_cookie = app_module.app.session_interface.get_signing_serializer(app_module.app).dumps(
+        {'_user_id': str(ctx['user_id']), '_fresh': True})
+    requests = build_requests(ctx, session_cookie, LOAD_SCENARIOS)
+
+    results = {}
+    for name in args.servers:
+        port = 5000 if name == 'dev' else args.port
+        process = start_server(name, port, database_url, args)
+        try:
+            # Warm up every request once
+            client_connection(port, requests, time.time() + 1, args.seed)
+            results[name] = [run_level(port, requests, level, args.duration, args.seed)
+                             for level in args.concurrency]
+        finally:
+            stop_server(process)
+
+    report = {
+        'schema': 1,
+        'created_at': datetime.utcnow().isoformat() + 'Z',
+        'git': git_revision(),
+        'database': database_url.split(':', 1)[0],
+        'scenarios': list(LOAD_SCENARIOS),
+        'duration_s': args.duration,
+        'eventlet': {'workers': args.workers, 'connections': args.connections},
+        'results': results,
+    }
+    output = args.output or os.path.join(
+        RESULTS_DIR, f"load-{args.profile}-{(report['git']['commit'] or 'unknown')[:10]}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+
+    print(f"{'server':<10} {'clients':>8} {'requests':>9} {'req/s':>9} {'p50 ms':>9} {'p99 ms':>9} {'errors':>7}")
+    for name, levels in results.items():
+        for level in levels:
+            print(f"{name:<10} {level['concurrency']:>8} {level['requests']:>9} {level['requests_per_second']:>9.1f} "
+                  f"{level['p50_ms'] or 0:>9.2f} {level['p99_ms'] or 0:>9.2f} {level['errors']:>7}")
+    print(f"Report written to {output}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,31 @@
+"""Scale profiles used to seed benchmark databases with fake_data_generator."""
+
+# Expected sizes with the generator's distributions: 1-3 floors per home,
+# 2-5 rooms per floor, 1-4 devices per room (~17 devices per home, about a
+# third of them sensors) and 4-max_readings_per_day readings per sensor per day.
+PROFILES = {
+    'small': {
+        'description': '5 homes, ~90 devices, ~12k readings',
+        'users': 10,
+        'homes': 5,
+        'days': 30,
+        'actions': 200,
+        'max_readings_per_day': 24,
+    },
+    'medium': {
+        'description': '100 homes, ~1.7k devices, ~1.5M readings',
+        'users': 150,
+        'homes': 100,
+        'days': 90,
+        'actions': 5000,
+        'max_readings_per_day': 48,
+    },
+    'large': {
+        'description': '1k homes, ~20k devices, ~100M readings',
+        'users': 1200,
+        'homes': 1000,
+        'days': 365,
+        'actions': 100000,
+        'max_readings_per_day': 88,
+    },
+}
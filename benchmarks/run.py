@@ -0,0 +1,369 @@
+"""Seed a benchmark database and time every page and API endpoint.
+
+Usage:
+    python -m benchmarks.run --profile small
+    python -m benchmarks.run --profile large --requests 20000 --output large.json
+
+The report is a JSON document keyed by "<role>:<scenario>" so that reports
+from different commits can be compared with `python -m benchmarks.compare`.
+"""
+import os
+import sys
+import json
+import time
+import random
+import secrets
+import logging
+import argparse
+import platform
+import subprocess
+import importlib.util
+from collections import namedtuple
+from datetime import datetime, timedelta
+
+from benchmarks.profiles import PROFILES
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DATA_DIR = os.path.join(ROOT, 'benchmarks', 'data')
+RESULTS_DIR = os.path.join(ROOT, 'benchmarks', 'results')
+
+# auth is 'token' (Bearer header), 'session' (Flask-Login cookie) or None
+Scenario = namedtuple('Scenario', 'name method path weight auth roles body')
+
+ALL_ROLES = ('admin', 'owner', 'guest')
+
+SCENARIOS = [
+    # Pages
+    Scenario('page_dashboard', 'GET', '/dashboard/{home_id}', 3, 'session', ALL_ROLES, None),
+    Scenario('page_devices', 'GET', '/devices', 1, 'session', ALL_ROLES, None),
+    Scenario('page_history', 'GET', '/history', 1, 'session', ALL_ROLES, None),
+    Scenario('page_admin_devices', 'GET', '/admin/devices', 1, 'session', ('admin',), None),
+    # Hierarchy and device lists
+    Scenario('api_homes', 'GET', '/api/homes', 2, 'token', ALL_ROLES, None),
+    Scenario('api_floors', 'GET', '/api/floors?home_id={home_id}', 2, 'token', ALL_ROLES, None),
+    Scenario('api_devices', 'GET', '/api/devices', 3, 'token', ALL_ROLES, None),
+    Scenario('api_device', 'GET', '/api/devices/{device_id}', 2, 'token', ALL_ROLES, None),
+    Scenario('api_user_devices', 'GET', '/api/user/devices', 3, 'session', ALL_ROLES, None),
+    Scenario('api_user_homes', 'GET', '/api/user/homes', 1, 'session', ALL_ROLES, None),
+    Scenario('api_validate_token', 'GET', '/api/validate-token', 1, 'token', ALL_ROLES, None),
+    # Time series: chart cards, sparklines, history page
+    Scenario('data_single_raw', 'GET', '/api/devices/{sensor_id}/data?days=1&limit=100', 8, 'token', ALL_ROLES, None),
+    Scenario('data_single_sparkline', 'GET', '/api/devices/{sensor_id}/data?days=1&limit=24', 6, 'token', ALL_ROLES, None),
+    Scenario('data_single_hourly', 'GET', '/api/devices/{sensor_id}/data?resolution=hourly&days=7&limit=168', 3, 'token', ALL_ROLES, None),
+    Scenario('data_single_daily', 'GET', '/api/devices/{sensor_id}/data?resolution=daily&days=30&limit=30', 1, 'token', ALL_ROLES, None),
+    Scenario('data_batch_charts', 'GET', '/api/data/series?device_ids={sensor_ids}&days=1&limit=100', 2, 'token', ALL_ROLES, None),
+    Scenario('data_batch_home', 'GET', '/api/data/series?home_id={home_id}&days=1&limit=24', 1, 'token', ALL_ROLES, None),
+    Scenario('data_all_raw', 'GET', '/api/devices/all/data?days=1&limit=500', 2, 'token', ALL_ROLES, None),
+    Scenario('data_all_hourly', 'GET', '/api/devices/all/data?resolution=hourly&days=1&limit=500', 1, 'token', ALL_ROLES, None),
+    Scenario('stats_single', 'GET', '/api/data/statistics?device_id={sensor_id}&days=7', 2, 'token', ALL_ROLES, None),
+    Scenario('stats_all', 'GET', '/api/data/statistics?days=7', 1, 'token', ALL_ROLES, None),
+    Scenario('legacy_sensor_data', 'GET', '/api/device_data/temperature?device_id={sensor_id}&days=1', 1, None, ALL_ROLES, None),
+    # Commands
+    Scenario('control', 'POST', '/api/devices/{device_id}/control', 1, 'token', ALL_ROLES, {'action': 'toggle'}),
+    # Admin
+    Scenario('admin_debug_info', 'GET', '/admin/api/debug-info', 1, 'session', ('admin',), None),
+    Scenario('admin_model_devices', 'GET', '/admin/api/Device', 1, 'session', ('admin',), None),
+    Scenario('health', 'GET', '/health', 1, None, ALL_ROLES, None),
+]
+
+# Share of requests issued by each role
+ROLE_WEIGHTS = {'owner': 7, 'guest': 2, 'admin': 1}
+
+
+def seed_database(profile_name, path, reseed=False, seed=42, workers=1):
+    """Seed a SQLite database for a profile with fake_data_generator.py."""
+    if os.path.exists(path) and not reseed:
+        print(f"Reusing seeded database {path}")
+        return
+    profile = PROFILES[profile_name]
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    print(f"Seeding '{profile_name}' profile ({profile['description']}) into {path}...")
+    command = [
+        sys.executable, os.path.join(ROOT, 'fake_data_generator.py'), '--clear',
+        '--users', str(profile['users']),
+        '--homes', str(profile['homes']),
+        '--days', str(profile['days']),
+        '--actions', str(profile['actions']),
+        '--max-readings-per-day', str(profile['max_readings_per_day']),
+        '--bulk', '--seed', str(seed), '--workers', str(workers),
+    ]
+    env = dict(os.environ, DATABASE_URL=f'sqlite:///{path}')
+    started = time.perf_counter()
+    subprocess.run(command, cwd=ROOT, env=env, check=True)
+    print(f"Seeded in {time.perf_counter() - started:.1f}s")
+
+
+def load_app(database_url):
+    """Import app.py against the given database (the app/ package shadows `import app`)."""
+    os.environ['DATABASE_URL'] = database_url
+    # No broker: device commands are acknowledged in-process
+    os.environ.setdefault('COMMAND_TRANSPORT', 'loopback')
+    sys.path.insert(0, ROOT)
+    spec = importlib.util.spec_from_file_location('smart_home_app', os.path.join(ROOT, 'app.py'))
+    module = importlib.util.module_from_spec(spec)
+    sys.modules['smart_home_app'] = module
+    spec.loader.exec_module(module)
+    # Failing endpoints are recorded as 500s instead of aborting the run
+    module.app.config.update(DEBUG=False, PROPAGATE_EXCEPTIONS=False)
+    # Per-request logging would dominate the timings; failures show up as
+    # errors in the report
+    logging.getLogger('smart_home').setLevel(logging.WARNING)
+    module.app.logger.setLevel(logging.CRITICAL)
+    return module
+
+
+def prepare_roles(app_module):
+    """Pick an admin, a home owner and a guest, and give each an API token."""
+    from sqlalchemy import select
+    import sharding
+    from models import db, User, Home, Floor, Room, Device, SensorData, HomeAccess
+
+    def home_devices(home_id):
+        devices = Device.query.join(Room).join(Floor).filter(Floor.home_id == home_id).all()
+        with sharding.for_home(home_id):
+            with_data = db.session.scalars(
+                select(SensorData.device_id).where(
+                    SensorData.device_id.in_([d.device_id for d in devices])
+                ).distinct()
+            ).all()
+        sensors = [d for d in devices if d.device_id in set(with_data)]
+        return devices, sensors
+
+    def context(user, home):
+        devices, sensors = home_devices(home.id)
+        if not devices:
+            return None
+        return {
+            'user_id': user.id,
+            'username': user.username,
+            'home_id': home.id,
+            'device_id': devices[0].device_id,
+            'sensor_id': (sensors[0] if sensors else devices[0]).device_id,
+            # Up to 20 chart cards on one dashboard
+            'sensor_ids': ','.join(d.device_id for d in (sensors or devices)[:20]),
+        }
+
+    with app_module.app.app_context():
+        roles = {}
+        admin = User.query.filter_by(is_admin=True).first()
+        homes = Home.query.order_by(Home.id).all()
+        owned = [home for home in homes if home.owner_id != (admin.id if admin else None)]
+        if admin and homes:
+            roles['admin'] = context(admin, homes[0])
+        for home in owned:
+            roles['owner'] = context(db.session.get(User, home.owner_id), home)
+            if roles['owner']:
+                break
+        for level in ('guest', 'user'):
+            access = HomeAccess.query.join(Home).filter(
+                HomeAccess.access_level == level,
+                HomeAccess.user_id != Home.owner_id
+            ).first()
+            if access:
+                roles['guest'] = context(db.session.get(User, access.user_id), db.session.get(Home, access.home_id))
+                break
+        roles = {role: ctx for role, ctx in roles.items() if ctx}
+
+        for ctx in roles.values():
+            user = db.session.get(User, ctx['user_id'])
+            user.access_token = secrets.token_hex(16)
+            user.token_expiry = datetime.utcnow() + timedelta(days=1)
+            ctx['token'] = user.access_token
+        db.session.commit()
+        return roles
+
+
+def dataset_size(app_module):
+    import models
+    import sharding
+    with app_module.app.app_context():
+        sizes = {}
+        for name in ('User', 'Home', 'Floor', 'Room', 'Device', 'SensorData', 'UserAction'):
+            model = getattr(models, name)
+            shards = sharding.shards() if model.__tablename__ in sharding.SHARDED_TABLES else [None]
+            sizes[name] = 0
+            for shard in shards:
+                with sharding.use(shard):
+                    sizes[name] += model.query.count()
+        return sizes
+
+
+def make_client(app_module, ctx):
+    client = app_module.app.test_client()
+    with client.session_transaction() as session:
+        session['_user_id'] = str(ctx['user_id'])
+        session['_fresh'] = True
+    return client
+
+
+def parse_server_timing(header):
+    """Extract (statement count, DB milliseconds) from the Server-Timing header."""
+    queries, db_ms = None, None
+    for metric in (header or '').split(','):
+        parts = [part.strip() for part in metric.split(';')]
+        if parts[0] != 'db':
+            continue
+        for part in parts[1:]:
+            if part.startswith('dur='):
+                db_ms = float(part[4:])
+            elif part.startswith('desc='):
+                queries = int(part[5:].strip('"').split()[0])
+    return queries, db_ms
+
+
+def issue(client, scenario, ctx):
+    path = scenario.path.format(**ctx)
+    headers = {}
+    if scenario.auth == 'token':
+        headers['Authorization'] = f"Bearer {ctx['token']}"
+    started = time.perf_counter()
+    response = client.open(path, method=scenario.method, headers=headers, json=scenario.body)
+    response.get_data()
+    elapsed = (time.perf_counter() - started) * 1000
+    queries, db_ms = parse_server_timing(response.headers.get('Server-Timing'))
+    return elapsed, response.status_code, queries, db_ms
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, max(0, int(round(fraction * len(sorted_values) + 0.5)) - 1))
+    return sorted_values[index]
+
+
+def summarize(samples):
+    times = sorted(sample[0] for sample in samples)
+    statuses = {}
+    for sample in samples:
+        statuses[str(sample[1])] = statuses.get(str(sample[1]), 0) + 1
+    queries = [sample[2] for sample in samples if sample[2] is not None]
+    db_times = [sample[3] for sample in samples if sample[3] is not None]
+    return {
+        'count': len(times),
+        'errors': sum(1 for sample in samples if sample[1] >= 500),
+        'status_codes': statuses,
+        'mean_ms': round(sum(times) / len(times), 3),
+        'min_ms': round(times[0], 3),
+        'p50_ms': round(percentile(times, 0.50), 3),
+        'p95_ms': round(percentile(times, 0.95), 3),
+        'p99_ms': round(percentile(times, 0.99), 3),
+        'max_ms': round(times[-1], 3),
+        'db_queries_mean': round(sum(queries) / len(queries), 2) if queries else None,
+        'db_time_ms_mean': round(sum(db_times) / len(db_times), 3) if db_times else None,
+    }
+
+
+def git_revision():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=ROOT, capture_output=True,
+                                text=True, check=True).stdout.strip()
+        dirty = bool(subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=ROOT,
+                                    capture_output=True, text=True).stdout.strip())
+        return {'commit': commit, 'dirty': dirty}
+    except (OSError, subprocess.CalledProcessError):
+        return {'commit': None, 'dirty': None}
+
+
+def run(args):
+    database_url = args.database_url
+    if not database_url:
+        path = os.path.join(DATA_DIR, f'{args.profile}.db')
+        seed_database(args.profile, path, args.reseed, args.seed, args.workers)
+        database_url = f'sqlite:///{path}'
+
+    app_module = load_app(database_url)
+    roles = prepare_roles(app_module)
+    if not roles:
+        sys.exit('No usable users/homes/devices in the database')
+    clients = {role: make_client(app_module, ctx) for role, ctx in roles.items()}
+    plan = [(role, scenario) for role in roles for scenario in SCENARIOS if role in scenario.roles]
+
+    # Warm up every (role, scenario) pair once so that imports, template
+    # compilation and connection setup are not measured
+    for role, scenario in plan:
+        issue(clients[role], scenario, roles[role])
+
+    rng = random.Random(args.seed)
+    role_names = list(roles)
+    role_weights = [ROLE_WEIGHTS[role] for role in role_names]
+    by_role = {role: [s for r, s in plan if r == role] for role in role_names}
+    samples = {}
+    started = time.perf_counter()
+    for _ in range(args.requests):
+        role = rng.choices(role_names, role_weights)[0]
+        scenario = rng.choices(by_role[role], [s.weight for s in by_role[role]])[0]
+        sample = issue(clients[role], scenario, roles[role])
+        samples.setdefault((role, scenario.name), []).append(sample)
+    wall_time = time.perf_counter() - started
+
+    results = {}
+    scenarios = {scenario.name: scenario for scenario in SCENARIOS}
+    for (role, name), role_samples in sorted(samples.items()):
+        scenario = scenarios[name]
+        results[f'{role}:{name}'] = {
+            'role': role,
+            'scenario': scenario.name,
+            'method': scenario.method,
+            'path': scenario.path,
+            **summarize(role_samples),
+        }
+    all_samples = [sample for role_samples in samples.values() for sample in role_samples]
+
+    report = {
+        'schema': 1,
+        'created_at': datetime.utcnow().isoformat() + 'Z',
+        'git': git_revision(),
+        'environment': {
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'database': database_url.split(':', 1)[0],
+        },
+        'profile': args.profile if not args.database_url else None,
+        'profile_config': PROFILES.get(args.profile) if not args.database_url else None,
+        'dataset': dataset_size(app_module),
+        'requests': args.requests,
+        'seed': args.seed,
+        'overall': {
+            'wall_time_s': round(wall_time, 3),
+            'requests_per_second': round(len(all_samples) / wall_time, 1) if wall_time else None,
+            **summarize(all_samples),
+        },
+        'results': results,
+    }
+
+    output = args.output or os.path.join(
+        RESULTS_DIR, f"{args.profile}-{(report['git']['commit'] or 'unknown')[:10]}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+
+    print(f"{'benchmark':<36} {'n':>6} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'queries':>8} {'errors':>6}")
+    for key, result in results.items():
+        print(f"{key:<36} {result['count']:>6} {result['p50_ms']:>9.2f} {result['p95_ms']:>9.2f} "
+              f"{result['p99_ms']:>9.2f} {result['db_queries_mean'] or 0:>8.1f} {result['errors']:>6}")
+    print(f"Overall: {report['overall']['requests_per_second']} req/s, "
+          f"p50 {report['overall']['p50_ms']} ms, p99 {report['overall']['p99_ms']} ms")
+    print(f"Report written to {output}")
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the Smart Home Dashboard')
+    parser.add_argument('--profile', choices=sorted(PROFILES), default='small',
+                        help='Scale profile to seed and benchmark')
+    parser.add_argument('--database-url',
+                        help='Benchmark an existing database instead of seeding a profile')
+    parser.add_argument('--reseed', action='store_true',
+                        help='Re-seed the profile database even if it already exists')
+    parser.add_argument('--requests', type=int, default=2000,
+                        help='Number of timed requests in the access mix')
+    parser.add_argument('--seed', type=int, default=42,
+                        help='Random seed for the seeded data and the access mix')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='Worker processes used to generate sensor data when seeding')
+    parser.add_argument('--output', help='Path of the JSON report')
+    run(parser.parse_args())
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,106 @@
+"""Compare response encodings by bytes and CPU time per response.
+
+Usage:
+    python -m benchmarks.serialization
+    python -m benchmarks.serialization --rows 100 1000 10000 --repeat 20
+
+Payloads are shaped like the /api/devices/<id>/data (raw readings) and
+/admin/api/Device responses. Each encoding is timed as stdlib json (what
+jsonify used before), orjson and MessagePack, uncompressed and with the
+gzip/brotli levels used by serialization.compress_response. Encoders whose
+package is not installed are skipped.
+"""
+import gzip
+import json
+import time
+import random
+import argparse
+from datetime import datetime, timedelta
+
+from serialization import orjson, msgpack, brotli, _default
+
+
+def readings_payload(rows):
+    """Build a payload like api_get_device_data returns for `rows` raw readings."""
+    rng = random.Random(rows)
+    now = datetime(2026, 1, 1)
+    data = []
+    for i in range(rows):
+        data.append({
+            'timestamp': (now - timedelta(minutes=5 * i)).isoformat(),
+            'device_id': 'DEV-%08x' % rng.randrange(16 ** 8),
+            'device_name': f'Temperature Sensor {i % 40}',
+            'type': 'temperature',
+            'value': round(rng.uniform(18, 30), 2),
+            'unit': '°C'
+        })
+    return {'success': True, 'device_id': 'all', 'data': data}
+
+
+def devices_payload(rows):
+    """Build a payload like /admin/api/Device returns for `rows` devices."""
+    rng = random.Random(rows)
+    return [{
+        'id': i,
+        'device_id': 'DEV-%08x' % rng.randrange(16 ** 8),
+        'name': f'Device {i}',
+        'type': rng.choice(['temperature', 'humidity', 'light', 'switch', 'motion_sensor']),
+        'location': f'Room {i % 50}',
+        'status': rng.choice(['online', 'offline']),
+        'is_active': rng.random() < 0.5,
+        'room_id': i % 50,
+        'last_seen': datetime(2026, 1, 1).isoformat()
+    } for i in range(rows)]
+
+
+def encoders():
+    yield 'json', lambda payload: json.dumps(payload, sort_keys=True, ensure_ascii=True).encode()
+    if orjson is not None:
+        yield 'orjson', lambda payload: orjson.dumps(payload, default=_default)
+    if msgpack is not None:
+        yield 'msgpack', lambda payload: msgpack.packb(payload, default=_default)
+
+
+def compressors():
+    yield 'identity', lambda data: data
+    yield 'gzip-6', lambda data: gzip.compress(data, compresslevel=6, mtime=0)
+    if brotli is not None:
+        yield 'br-6', lambda data: brotli.compress(data, quality=6)
+
+
+def cpu_time(function, argument, repeat):
+    """Return the median CPU time of `function(argument)` in milliseconds."""
+    timings = []
+    for _ in range(repeat):
+        start = time.process_time()
+        function(argument)
+        timings.append(time.process_time() - start)
+    timings.sort()
+    return timings[len(timings) // 2] * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare response encodings')
+    parser.add_argument('--rows', type=int, nargs='+', default=[100, 1000, 10000],
+                        help='Payload sizes (rows) to measure')
+    parser.add_argument('--repeat', type=int, default=15,
+                        help='Repetitions per measurement (median is reported)')
+    args = parser.parse_args()
+
+    print(f"{'payload':<18} {'encoding':<18} {'bytes':>10} {'encode ms':>10} {'compress ms':>12} {'total ms':>9}")
+    for name, build in (('readings', readings_payload), ('admin_devices', devices_payload)):
+        for rows in args.rows:
+            payload = build(rows)
+            for encoder_name, encode in encoders():
+                encoded = encode(payload)
+                encode_ms = cpu_time(encode, payload, args.repeat)
+                for compressor_name, compress in compressors():
+                    body = compress(encoded)
+                    compress_ms = cpu_time(compress, encoded, args.repeat)
+                    print(f"{f'{name}[{rows}]':<18} {f'{encoder_name}+{compressor_name}':<18} "
+                          f"{len(body):>10} {encode_ms:>10.3f} {compress_ms:>12.3f} "
+                          f"{encode_ms + compress_ms:>9.3f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -13,12 +13,146 @@ class Config:
     SQLALCHEMY_DATABASE_URI = os.environ.get('DATABASE_URL') or 'sqlite:///smart_home.db'
     SQLALCHEMY_TRACK_MODIFICATIONS = False
     
+    # Read replica for the reads of GET pages and APIs (see replica.py), e.g. a
+    # read-only connection: sqlite:///file:smart_home.db?mode=ro&uri=true
+    REPLICA_DATABASE_URL = os.environ.get('REPLICA_DATABASE_URL')
+    # Reads fall back to the primary when the replica is further behind (seconds)
+    REPLICA_MAX_LAG = float(os.environ.get('REPLICA_MAX_LAG', 5.0))
+    # Seconds between the heartbeats that measure the lag
+    REPLICA_HEARTBEAT_INTERVAL = float(os.environ.get('REPLICA_HEARTBEAT_INTERVAL', 1.0))
+    
+    # Sensor data and user action shards (see sharding.py): comma-separated
+    # database URLs; each home's rows live on one of them
+    SHARD_DATABASE_URLS = [url.strip() for url in os.environ.get('SHARD_DATABASE_URLS', '').split(',') if url.strip()]
+    SHARD_BINDS = {f'shard{index}': url for index, url in enumerate(SHARD_DATABASE_URLS)}
+    # Seconds a process keeps its home -> shard map before reloading it
+    SHARD_MAP_TTL = float(os.environ.get('SHARD_MAP_TTL', 30.0))
+    SQLALCHEMY_BINDS = {**({'replica': REPLICA_DATABASE_URL} if REPLICA_DATABASE_URL else {}), **SHARD_BINDS}
+    
+    # Connection pool (see database.py); recycle and pre-ping only apply to
+    # server databases such as PostgreSQL or MySQL
+    DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', 10))
+    DB_MAX_OVERFLOW = int(os.environ.get('DB_MAX_OVERFLOW', 20))
+    DB_POOL_TIMEOUT = int(os.environ.get('DB_POOL_TIMEOUT', 30))
+    DB_POOL_RECYCLE = int(os.environ.get('DB_POOL_RECYCLE', 1800))
+    DB_POOL_PRE_PING = os.environ.get('DB_POOL_PRE_PING', 'true').lower() == 'true'
+    
+    # Pragmas for every SQLite connection (WAL lets readers run during writes)
+    SQLITE_JOURNAL_MODE = os.environ.get('SQLITE_JOURNAL_MODE', 'WAL')
+    SQLITE_SYNCHRONOUS = os.environ.get('SQLITE_SYNCHRONOUS', 'NORMAL')
+    SQLITE_BUSY_TIMEOUT = int(os.environ.get('SQLITE_BUSY_TIMEOUT', 5000))  # milliseconds
+    SQLITE_MMAP_SIZE = int(os.environ.get('SQLITE_MMAP_SIZE', 256 * 1024 * 1024))  # bytes
+    SQLITE_CACHE_SIZE = int(os.environ.get('SQLITE_CACHE_SIZE', -64 * 1024))  # negative: KiB
+    
+    # SQL instrumentation (Server-Timing headers and per-request query logging)
+    SQL_INSTRUMENTATION = os.environ.get('SQL_INSTRUMENTATION', 'true').lower() == 'true'
+    # Requests with more database time than this are logged at INFO, the rest at DEBUG
+    SQL_LOG_THRESHOLD_MS = float(os.environ.get('SQL_LOG_THRESHOLD_MS', 100))
+    # Strict mode for tests: fail a request that repeats the same statement shape
+    # more than this many times (N+1 detection). None disables the check.
+    SQL_STRICT_REPEAT_LIMIT = int(os.environ['SQL_STRICT_REPEAT_LIMIT']) if os.environ.get('SQL_STRICT_REPEAT_LIMIT') else None
+    
+    # Prometheus metrics exposed on /metrics
+    METRICS_ENABLED = os.environ.get('METRICS_ENABLED', 'true').lower() == 'true'
+    
+    # Result cache for statistics/aggregates over closed (past) days
+    RESULT_CACHE_ENABLED = os.environ.get('RESULT_CACHE_ENABLED', 'true').lower() == 'true'
+    RESULT_CACHE_MAX_ENTRIES = int(os.environ.get('RESULT_CACHE_MAX_ENTRIES', 10000))
+    # Seconds after midnight (UTC) before the previous day is considered closed
+    RESULT_CACHE_CLOSE_GRACE = int(os.environ.get('RESULT_CACHE_CLOSE_GRACE', 300))
+    # Seconds late data events are kept for other processes to read
+    RESULT_CACHE_EVENT_RETENTION = int(os.environ.get('RESULT_CACHE_EVENT_RETENTION', 86400))
+    
+    # Response encoding (orjson if installed) and compression of large bodies
+    FAST_JSON = os.environ.get('FAST_JSON', 'true').lower() == 'true'
+    COMPRESS_MIN_SIZE = int(os.environ.get('COMPRESS_MIN_SIZE', 1024))
+    COMPRESS_LEVEL = int(os.environ.get('COMPRESS_LEVEL', 6))
+    
+    # Maximum number of devices in one /api/data/series request, and of
+    # readings (or buckets) per device
+    SERIES_MAX_DEVICES = int(os.environ.get('SERIES_MAX_DEVICES', 200))
+    SERIES_MAX_POINTS = int(os.environ.get('SERIES_MAX_POINTS', 1000))
+    
+    # Production server (serve.py): worker processes, each serving up to
+    # SERVER_WORKER_CONNECTIONS concurrent connections with green threads
+    SERVER_HOST = os.environ.get('SERVER_HOST', '0.0.0.0')
+    SERVER_PORT = int(os.environ.get('SERVER_PORT', 8000))
+    SERVER_WORKERS = int(os.environ.get('SERVER_WORKERS', os.cpu_count() or 1))
+    SERVER_WORKER_CONNECTIONS = int(os.environ.get('SERVER_WORKER_CONNECTIONS', 1000))
+    SERVER_BACKLOG = int(os.environ.get('SERVER_BACKLOG', 2048))
+    # Seconds an idle keep-alive connection is kept open (0 disables keep-alive)
+    SERVER_KEEPALIVE = int(os.environ.get('SERVER_KEEPALIVE', 75))
+    SERVER_SOCKET_TIMEOUT = int(os.environ.get('SERVER_SOCKET_TIMEOUT', 60))
+    SERVER_ACCESS_LOG = os.environ.get('SERVER_ACCESS_LOG', 'false').lower() == 'true'
+    
     # MQTT configuration
     MQTT_BROKER_URL = os.environ.get('MQTT_BROKER_URL') or 'broker.shiftr.io'
     MQTT_BROKER_PORT = int(os.environ.get('MQTT_BROKER_PORT') or 1883)
     MQTT_USERNAME = os.environ.get('MQTT_USERNAME') or 'YOUR_SHIFTR_KEY'
     MQTT_PASSWORD = os.environ.get('MQTT_PASSWORD') or 'YOUR_SHIFTR_SECRET'
     MQTT_CLIENT_ID = os.environ.get('MQTT_CLIENT_ID') or 'smart_home_dashboard'
+    MQTT_ENABLED = os.environ.get('MQTT_ENABLED', 'false').lower() == 'true'
+    # How device commands are sent: 'mqtt' (the default with MQTT_ENABLED),
+    # 'loopback' (acknowledges every command itself, for development and
+    # benchmarks only) or 'none' (commands time out as unacknowledged)
+    COMMAND_TRANSPORT = os.environ.get('COMMAND_TRANSPORT', 'mqtt' if MQTT_ENABLED else 'none').lower()
+    
+    # Device commands
+    MQTT_COMMAND_QOS = int(os.environ.get('MQTT_COMMAND_QOS', 1))
+    MQTT_COMMAND_ACK_TIMEOUT = float(os.environ.get('MQTT_COMMAND_ACK_TIMEOUT', 5.0))
+    MQTT_COMMAND_RETRIES = int(os.environ.get('MQTT_COMMAND_RETRIES', 2))
+    MQTT_COMMAND_MAX_IN_FLIGHT = int(os.environ.get('MQTT_COMMAND_MAX_IN_FLIGHT', 1000))
+    
+    # Maximum number of devices in one /api/commands request
+    COMMAND_BATCH_MAX_DEVICES = int(os.environ.get('COMMAND_BATCH_MAX_DEVICES', 500))
+    
+    # Alert rules evaluated on readings as they are stored (see alerts.py)
+    ALERTS_ENABLED = os.environ.get('ALERTS_ENABLED', 'true').lower() == 'true'
+    # Comma-separated notifiers alerts are delivered to ('log', 'database')
+    ALERT_NOTIFIERS = os.environ.get('ALERT_NOTIFIERS', 'log,database')
+    # Seconds between reloads of the rules, picking up changes made by other processes
+    ALERT_RULES_REFRESH = float(os.environ.get('ALERT_RULES_REFRESH', 60.0))
+    ALERT_QUEUE_SIZE = int(os.environ.get('ALERT_QUEUE_SIZE', 10000))
+    
+    # Automation rules sending device commands on readings (see automation.py)
+    AUTOMATION_ENABLED = os.environ.get('AUTOMATION_ENABLED', 'true').lower() == 'true'
+    # User the commands of automation rules are recorded as (created if missing)
+    AUTOMATION_USERNAME = os.environ.get('AUTOMATION_USERNAME', 'automation')
+    AUTOMATION_RULES_REFRESH = float(os.environ.get('AUTOMATION_RULES_REFRESH', 60.0))
+    
+    # Device liveness: seconds without a reading or acknowledgement before a
+    # device is marked offline, with per-type overrides ("switch=3600,light=600")
+    LIVENESS_ENABLED = os.environ.get('LIVENESS_ENABLED', 'true').lower() == 'true'
+    DEVICE_OFFLINE_TIMEOUT = float(os.environ.get('DEVICE_OFFLINE_TIMEOUT', 300))
+    DEVICE_OFFLINE_TIMEOUTS = os.environ.get('DEVICE_OFFLINE_TIMEOUTS', '')
+    # Seconds per timer wheel tick (status changes are applied once per tick)
+    LIVENESS_TICK = float(os.environ.get('LIVENESS_TICK', 1.0))
+    LIVENESS_WHEEL_SLOTS = int(os.environ.get('LIVENESS_WHEEL_SLOTS', 512))
+    
+    # Admin listings: rows per page, the largest page a request can ask for,
+    # and how many matching rows are counted before the total is estimated
+    ADMIN_PAGE_SIZE = int(os.environ.get('ADMIN_PAGE_SIZE', 100))
+    ADMIN_MAX_PAGE_SIZE = int(os.environ.get('ADMIN_MAX_PAGE_SIZE', 1000))
+    ADMIN_COUNT_LIMIT = int(os.environ.get('ADMIN_COUNT_LIMIT', 10000))
+    
+    # Table statistics for the admin dashboard, refreshed in the background.
+    # Tables up to TABLE_STATS_EXACT_LIMIT rows are counted exactly; SQLite
+    # table sizes scan the table, so they have their own (longer) interval
+    TABLE_STATS_ENABLED = os.environ.get('TABLE_STATS_ENABLED', 'true').lower() == 'true'
+    TABLE_STATS_REFRESH = float(os.environ.get('TABLE_STATS_REFRESH', 300))
+    TABLE_STATS_SIZE_REFRESH = float(os.environ.get('TABLE_STATS_SIZE_REFRESH', 3600))
+    TABLE_STATS_EXACT_LIMIT = int(os.environ.get('TABLE_STATS_EXACT_LIMIT', 10000))
+    TABLE_STATS_RATE_WINDOW = int(os.environ.get('TABLE_STATS_RATE_WINDOW', 60))
+    # Rows SQLite's ANALYZE reads per index (PRAGMA analysis_limit; 0 never analyzes)
+    TABLE_STATS_ANALYZE_LIMIT = int(os.environ.get('TABLE_STATS_ANALYZE_LIMIT', 1000))
+    
+    # In-memory device search (GET /api/devices/search and the device pickers).
+    # The index follows this process's commits and is rebuilt every
+    # DEVICE_SEARCH_REFRESH seconds (0 never) for changes made elsewhere
+    DEVICE_SEARCH_REFRESH = float(os.environ.get('DEVICE_SEARCH_REFRESH', 300))
+    DEVICE_SEARCH_PAGE_SIZE = int(os.environ.get('DEVICE_SEARCH_PAGE_SIZE', 20))
+    DEVICE_SEARCH_MAX_PAGE_SIZE = int(os.environ.get('DEVICE_SEARCH_MAX_PAGE_SIZE', 200))
+    DEVICES_PAGE_SIZE = int(os.environ.get('DEVICES_PAGE_SIZE', 50))
     
     # MQTT topics
     MQTT_TOPIC_TEMPERATURE = 'home/+/+/temperature'  # Updated for floor: home/floorX/room/temperature
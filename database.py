@@ -0,0 +1,85 @@
+"""Engine configuration: connection pool options and SQLite pragmas.
+
+`init_app(app, db)` replaces `db.init_app(app)`. Before the engines are
+created it fills SQLALCHEMY_ENGINE_OPTIONS from the DB_POOL_* settings
+(options set explicitly in SQLALCHEMY_ENGINE_OPTIONS win), and afterwards it
+applies the SQLITE_* pragmas to every new connection of each SQLite engine:
+
+- journal_mode=WAL lets readers run while a writer commits,
+- synchronous=NORMAL only syncs at WAL checkpoints (safe in WAL mode),
+- busy_timeout makes a writer wait for the lock instead of failing,
+- mmap_size and cache_size keep hot pages of large tables in memory.
+"""
+from sqlalchemy import event
+from sqlalchemy.engine import make_url
+
+JOURNAL_MODES = {'DELETE', 'TRUNCATE', 'PERSIST', 'MEMORY', 'WAL', 'OFF'}
+SYNCHRONOUS_MODES = {'OFF', 'NORMAL', 'FULL', 'EXTRA'}
+
+
+def _is_memory_sqlite(url):
+    return url.database in (None, '', ':memory:') or url.query.get('mode') == 'memory'
+
+
+def engine_options(config, uri=None):
+    """Return the pool options for the engine of `uri` (the default database)."""
+    url = make_url(uri or config['SQLALCHEMY_DATABASE_URI'])
+    options = {}
+    if url.get_backend_name() == 'sqlite' and _is_memory_sqlite(url):
+        # Flask-SQLAlchemy keeps in-memory databases on a single static connection
+        return options
+    options['pool_size'] = config.get('DB_POOL_SIZE', 10)
+    options['max_overflow'] = config.get('DB_MAX_OVERFLOW', 20)
+    options['pool_timeout'] = config.get('DB_POOL_TIMEOUT', 30)
+    if url.get_backend_name() != 'sqlite':
+        # Server connections are dropped by the server or network when idle
+        options['pool_recycle'] = config.get('DB_POOL_RECYCLE', 1800)
+        options['pool_pre_ping'] = config.get('DB_POOL_PRE_PING', True)
+    return options
+
+
+def sqlite_pragmas(config):
+    """Return the (name, value) pragmas to run on each new SQLite connection."""
+    journal_mode = str(config.get('SQLITE_JOURNAL_MODE', 'WAL')).upper()
+    synchronous = str(config.get('SQLITE_SYNCHRONOUS', 'NORMAL')).upper()
+    if journal_mode not in JOURNAL_MODES:
+        raise ValueError(f'Unsupported SQLITE_JOURNAL_MODE: {journal_mode}')
+    if synchronous not in SYNCHRONOUS_MODES:
+        raise ValueError(f'Unsupported SQLITE_SYNCHRONOUS: {synchronous}')
+    return [
+        ('journal_mode', journal_mode),
+        ('synchronous', synchronous),
+        ('busy_timeout', int(config.get('SQLITE_BUSY_TIMEOUT', 5000))),
+        ('mmap_size', int(config.get('SQLITE_MMAP_SIZE', 256 * 1024 * 1024))),
+        ('cache_size', int(config.get('SQLITE_CACHE_SIZE', -64 * 1024))),
+    ]
+
+
+def apply_pragmas(engine, pragmas):
+    """Run `pragmas` on every new connection of a SQLite engine."""
+    @event.listens_for(engine, 'connect')
+    def set_sqlite_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        try:
+            for name, value in pragmas:
+                cursor.execute(f'PRAGMA {name}={value}')
+        finally:
+            cursor.close()
+
+
+def init_app(app, db):
+    """Initialize `db` for the app with the configured pool options and pragmas."""
+    options = engine_options(app.config)
+    options.update(app.config.get('SQLALCHEMY_ENGINE_OPTIONS') or {})
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = options
+    db.init_app(app)
+
+    pragmas = sqlite_pragmas(app.config)
+    with app.app_context():
+        for engine in db.engines.values():
+            if engine.dialect.name == 'sqlite':
+                if engine.url.query.get('mode') == 'ro':
+                    # Read-only connections cannot change the journal mode
+                    apply_pragmas(engine, [pragma for pragma in pragmas if pragma[0] != 'journal_mode'])
+                else:
+                    apply_pragmas(engine, pragmas)
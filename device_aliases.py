@@ -0,0 +1,165 @@
+"""Alternate device ids, resolved from memory.
+
+Older dashboards address sensors by ids such as 'temp_living_room_f1'. Such
+aliases are rows of the device_aliases table; each process keeps a dict of
+every alias and canonical device id, loaded on first use and kept current
+by ORM events (applied when the session commits), so resolving an id is a
+single dict lookup. An id the dict does not know, e.g. one added by another
+worker process, costs up to two indexed queries before it is cached.
+
+The aliases the legacy endpoint used to guess are generated by
+`legacy_aliases()`: 'temp_<rest>' for a 'temperature_<rest>' device id, and
+'<type>_<room name>_f<floor number>' for temperature, humidity and light
+sensors. `add_legacy_aliases()` registers them for every device.
+"""
+import logging
+import threading
+
+from sqlalchemy import event, inspect, select
+from sqlalchemy.orm import Session
+
+from models import db, Device, DeviceAlias, Room, Floor
+
+# Get logger
+logger = logging.getLogger('smart_home.aliases')
+
+# Id prefixes of the legacy sensor ids, per device type
+LEGACY_TYPE_PREFIXES = {
+    'temperature': ('temp', 'temperature'),
+    'humidity': ('humidity',),
+    'light': ('light',),
+}
+
+_CHANGES_KEY = 'device_alias_changes'
+
+
+def legacy_aliases(device_id, device_type, room_name, floor_number):
+    """Return the ids older dashboards used for a device."""
+    aliases = []
+    if device_id.startswith('temperature_'):
+        aliases.append('temp_' + device_id[len('temperature_'):])
+    room_slug = '_'.join(room_name.lower().split())
+    aliases.extend(
+        f'{prefix}_{room_slug}_f{floor_number}' for prefix in LEGACY_TYPE_PREFIXES.get(device_type, ())
+    )
+    return [alias for alias in dict.fromkeys(aliases) if alias != device_id]
+
+
+class AliasIndex:
+    """In-memory map of aliases and device ids to device ids."""
+
+    def __init__(self):
+        self._ids = None
+        self._lock = threading.Lock()
+
+    def load(self, session):
+        ids = dict(session.execute(select(DeviceAlias.alias, DeviceAlias.device_id)).all())
+        ids.update((device_id, device_id) for device_id in session.scalars(select(Device.device_id)))
+        self._ids = ids
+        logger.info(f"Device alias index loaded with {len(ids)} id(s)")
+
+    def _ensure_loaded(self, session):
+        if self._ids is None:
+            with self._lock:
+                if self._ids is None:
+                    self.load(session)
+
+    def known(self, session, name):
+        """Return True if `name` is a device id or an alias."""
+        self._ensure_loaded(session)
+        return name in self._ids
+
+    def resolve(self, session, name):
+        """Return the device id that `name` (a device id or alias) stands for, or None."""
+        self._ensure_loaded(session)
+        device_id = self._ids.get(name)
+        if device_id is None:
+            device_id = self._ids.get(name.lower())
+        if device_id is None:
+            device_id = session.scalar(select(Device.device_id).where(Device.device_id == name))
+            if device_id is None:
+                device_id = session.scalar(select(DeviceAlias.device_id).where(DeviceAlias.alias == name))
+            if device_id is not None:
+                self._ids[name] = device_id
+        return device_id
+
+    def apply(self, changes):
+        if self._ids is None:
+            return
+        for operation, name, device_id in changes:
+            if operation == 'set':
+                self._ids[name] = device_id
+            elif operation == 'drop':
+                self._ids.pop(name, None)
+            else:
+                # A device was deleted or renamed: drop its id and aliases
+                self._ids = {key: value for key, value in self._ids.items() if value != name}
+
+
+index = AliasIndex()
+
+
+def add_legacy_aliases(session=None):
+    """Register the legacy ids of every device that are not taken yet.
+
+    Where several devices produce the same alias (rooms of the same name in
+    different homes) the device of the lowest room id wins, as in the lookup
+    this replaces. Returns the number of aliases added.
+    """
+    session = session or db.session
+    taken = set(session.scalars(select(DeviceAlias.alias)))
+    taken.update(session.scalars(select(Device.device_id)))
+    rows = session.execute(
+        select(Device.device_id, Device.type, Room.name, Floor.floor_number)
+        .join(Room, Device.room_id == Room.id).join(Floor, Room.floor_id == Floor.id)
+        .order_by(Room.id, Device.id)
+    )
+    added = []
+    for device_id, device_type, room_name, floor_number in rows:
+        for alias in legacy_aliases(device_id, device_type, room_name, floor_number):
+            if alias not in taken:
+                taken.add(alias)
+                added.append(DeviceAlias(alias=alias, device_id=device_id))
+    session.add_all(added)
+    session.commit()
+    return len(added)
+
+
+@event.listens_for(Session, 'after_flush')
+def _collect_alias_changes(session, flush_context):
+    changes = []
+    for instance in session.new:
+        if isinstance(instance, Device):
+            changes.append(('set', instance.device_id, instance.device_id))
+        elif isinstance(instance, DeviceAlias):
+            changes.append(('set', instance.alias, instance.device_id))
+    for instance in session.dirty:
+        if isinstance(instance, Device):
+            history = inspect(instance).attrs.device_id.history
+            if history.deleted:
+                changes.extend(('drop_device', old, None) for old in history.deleted)
+                changes.append(('set', instance.device_id, instance.device_id))
+        elif isinstance(instance, DeviceAlias):
+            state = inspect(instance)
+            if state.attrs.alias.history.deleted or state.attrs.device_id.history.deleted:
+                changes.extend(('drop', old, None) for old in state.attrs.alias.history.deleted)
+                changes.append(('set', instance.alias, instance.device_id))
+    for instance in session.deleted:
+        if isinstance(instance, Device):
+            changes.append(('drop_device', instance.device_id, None))
+        elif isinstance(instance, DeviceAlias):
+            changes.append(('drop', instance.alias, None))
+    if changes:
+        session.info.setdefault(_CHANGES_KEY, []).extend(changes)
+
+
+@event.listens_for(Session, 'after_commit')
+def _apply_alias_changes(session):
+    changes = session.info.pop(_CHANGES_KEY, None)
+    if changes:
+        index.apply(changes)
+
+
+@event.listens_for(Session, 'after_rollback')
+def _discard_alias_changes(session):
+    session.info.pop(_CHANGES_KEY, None)
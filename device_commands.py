@@ -0,0 +1,297 @@
+"""Asynchronous device commands over MQTT.
+
+A command is stored as a pending UserAction, published to the control topic
+of the device's room and tracked in memory until the device acknowledges it
+on its status topic:
+
+    {"command_id": 42, "status": "success", "state": true}
+
+Commands that are not acknowledged within MQTT_COMMAND_ACK_TIMEOUT seconds
+are published again, up to MQTT_COMMAND_RETRIES times, and then marked
+'timeout'. At most MQTT_COMMAND_MAX_IN_FLIGHT commands are tracked at once.
+
+COMMAND_TRANSPORT selects how commands are sent: 'mqtt', 'loopback' (which
+acknowledges every command itself, for development and benchmarks without
+a broker) or 'none', where nothing is published and every command ends as
+'timeout'. Without MQTT_ENABLED it defaults to 'none', so a command is
+never reported successful unless a device acknowledged it.
+"""
+import re
+import json
+import time
+import queue
+import logging
+import threading
+from datetime import datetime
+
+import metrics
+import sharding
+from models import db, Device, Room, Floor, UserAction
+
+# Get logger
+logger = logging.getLogger('smart_home.commands')
+
+SUCCESS_STATUSES = {'success', 'ok', 'done'}
+FAILURE_STATUSES = {'failed', 'error', 'rejected'}
+
+
+class CommandQueueFull(Exception):
+    """Raised when too many commands are waiting for an acknowledgement."""
+
+
+def topic_for(pattern, floor, room):
+    """Fill the '+' wildcards of a topic pattern with the floor and room of a device."""
+    room_slug = re.sub(r'[^a-z0-9]+', '_', room.name.lower()).strip('_') or f'room{room.id}'
+    segments = iter([f'floor{floor.floor_number}', room_slug])
+    return '/'.join(next(segments, part) if part == '+' else part for part in pattern.split('/'))
+
+
+class PendingCommand:
+    """A published command waiting for its acknowledgement."""
+    __slots__ = ('action_id', 'device_id', 'action', 'topic', 'payload', 'attempts', 'sent_at', 'deadline')
+
+    def __init__(self, action_id, device_id, action, topic, payload):
+        self.action_id = action_id
+        self.device_id = device_id
+        self.action = action
+        self.topic = topic
+        self.payload = payload
+        self.attempts = 0
+        self.sent_at = None
+        self.deadline = None
+
+
+class MqttTransport:
+    """Publishes commands and receives acknowledgements through paho-mqtt."""
+
+    def __init__(self, config, on_message):
+        import paho.mqtt.client as mqtt
+
+        self.qos = config.get('MQTT_COMMAND_QOS', 1)
+        self.status_topics = [config['MQTT_TOPIC_DEVICE_STATUS'], config['MQTT_LEGACY_TOPIC_DEVICE_STATUS']]
+        self.client = mqtt.Client(
+            mqtt.CallbackAPIVersion.VERSION2,
+            client_id=f"{config['MQTT_CLIENT_ID']}-commands-{id(self):x}"
+        )
+        if config.get('MQTT_USERNAME'):
+            self.client.username_pw_set(config['MQTT_USERNAME'], config.get('MQTT_PASSWORD'))
+        self.client.on_connect = self._on_connect
+        self.client.on_message = lambda client, userdata, message: on_message(message.payload)
+        # Connect in the background; publishes are queued until connected
+        self.client.connect_async(config['MQTT_BROKER_URL'], config['MQTT_BROKER_PORT'])
+        self.client.loop_start()
+
+    def _on_connect(self, client, userdata, flags, reason_code, properties):
+        if reason_code.is_failure:
+            logger.error(f"MQTT connection failed: {reason_code}")
+            return
+        for topic in self.status_topics:
+            client.subscribe(topic, qos=self.qos)
+
+    def publish(self, topic, payload):
+        self.client.publish(topic, json.dumps(payload), qos=self.qos)
+
+
+class LoopbackTransport:
+    """Acknowledges every command itself, for development without a broker."""
+
+    def __init__(self, on_message):
+        self.on_message = on_message
+        self._queue = queue.Queue()
+        threading.Thread(target=self._run, name='command-loopback', daemon=True).start()
+
+    def publish(self, topic, payload):
+        self._queue.put(payload)
+
+    def _run(self):
+        while True:
+            payload = self._queue.get()
+            ack = {'command_id': payload['command_id'], 'status': 'success'}
+            try:
+                self.on_message(json.dumps(ack).encode())
+            except Exception:
+                logger.exception('Loopback acknowledgement failed')
+
+
+class NullTransport:
+    """Publishes nothing; commands time out unacknowledged."""
+
+    def publish(self, topic, payload):
+        pass
+
+
+class CommandDispatcher:
+    """Publishes device commands and tracks them until acknowledged."""
+
+    def __init__(self, app, max_in_flight=1000, ack_timeout=5.0, retries=2):
+        self.app = app
+        self.max_in_flight = max_in_flight
+        self.ack_timeout = ack_timeout
+        self.retries = retries
+        self.transport = None
+        self._in_flight = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._in_flight)
+
+    def start(self, transport):
+        self.transport = transport
+        threading.Thread(target=self._sweep, name='command-sweeper', daemon=True).start()
+
+    def has_capacity(self):
+        return len(self._in_flight) < self.max_in_flight
+
+    def control_topics(self, device_ids):
+        """Return {device_id: control topic} with a single query."""
+        rows = db.session.query(Device.device_id, Room, Floor).join(
+            Room, Device.room_id == Room.id
+        ).join(Floor, Room.floor_id == Floor.id).filter(Device.device_id.in_(device_ids))
+        pattern = self.app.config['MQTT_TOPIC_DEVICE_CONTROL']
+        return {device_id: topic_for(pattern, floor, room) for device_id, room, floor in rows}
+
+    def submit(self, user_action, device, value=None, topic=None):
+        """Publish the command recorded by a (committed) pending UserAction."""
+        if topic is None:
+            topic = self.control_topics([device.device_id])[device.device_id]
+        command = PendingCommand(
+            user_action.id, device.device_id, user_action.action, topic,
+            {
+                'command_id': user_action.id,
+                'device_id': device.device_id,
+                'action': user_action.action,
+                'value': value,
+                'issued_at': user_action.timestamp.isoformat() if user_action.timestamp else None
+            }
+        )
+        with self._lock:
+            if len(self._in_flight) >= self.max_in_flight:
+                metrics.device_commands.inc(command.action, 'rejected')
+                raise CommandQueueFull(f'{len(self._in_flight)} commands awaiting acknowledgement')
+            self._in_flight[command.action_id] = command
+        self._publish(command)
+        return command
+
+    def send(self, device, action, value=None, user_id=None):
+        """Record a command as a pending UserAction of `user_id` and publish it.
+
+        Raises CommandQueueFull (marking the action failed if it was already
+        recorded) when too many commands are awaiting acknowledgement.
+        """
+        if not self.has_capacity():
+            metrics.device_commands.inc(action, 'rejected')
+            raise CommandQueueFull(f'{len(self._in_flight)} commands awaiting acknowledgement')
+        # Refreshing the committed action reads it back from its shard
+        with sharding.for_device(device.device_id):
+            user_action = UserAction(
+                device_id=device.device_id,
+                action=action,
+                value=str(value) if value is not None else None,
+                user_id=user_id,
+                status='pending'
+            )
+            db.session.add(user_action)
+            db.session.commit()
+            try:
+                self.submit(user_action, device, value)
+            except CommandQueueFull:
+                user_action.status = 'failed'
+                db.session.commit()
+                raise
+        return user_action
+
+    def _publish(self, command):
+        now = time.monotonic()
+        command.attempts += 1
+        command.sent_at = command.sent_at or now
+        command.deadline = now + self.ack_timeout
+        self.transport.publish(command.topic, dict(command.payload, attempt=command.attempts))
+
+    def handle_message(self, payload):
+        """Handle a message from a status topic; ignores anything but command acks."""
+        try:
+            message = json.loads(payload)
+            action_id = int(message['command_id'])
+        except (ValueError, TypeError, KeyError):
+            return
+        with self._lock:
+            command = self._in_flight.pop(action_id, None)
+        if command is None:
+            # Already finished, or tracked by another process
+            return
+        status = str(message.get('status', 'success')).lower()
+        if status in SUCCESS_STATUSES:
+            self._finish(command, 'success', message.get('state'))
+        elif status in FAILURE_STATUSES:
+            self._finish(command, 'failed')
+        else:
+            logger.warning(f"Unknown acknowledgement status {status!r} for command {action_id}")
+            self._finish(command, 'failed')
+
+    def _sweep(self):
+        interval = min(self.ack_timeout / 4, 0.5)
+        while True:
+            time.sleep(interval)
+            now = time.monotonic()
+            with self._lock:
+                expired = [command for command in self._in_flight.values() if command.deadline <= now]
+                timed_out = [command for command in expired if command.attempts > self.retries]
+                for command in timed_out:
+                    del self._in_flight[command.action_id]
+            for command in expired:
+                if command.attempts > self.retries:
+                    self._finish(command, 'timeout')
+                else:
+                    metrics.device_command_retries.inc(command.action)
+                    self._publish(command)
+
+    def _finish(self, command, status, state=None):
+        latency = time.monotonic() - command.sent_at
+        metrics.device_commands.inc(command.action, status)
+        metrics.device_command_latency.observe(latency, command.action, status)
+        try:
+            with self.app.app_context(), sharding.for_device(command.device_id):
+                user_action = db.session.get(UserAction, command.action_id)
+                if user_action:
+                    user_action.status = status
+                if status == 'success':
+                    device = Device.query.filter_by(device_id=command.device_id).first()
+                    if device:
+                        if state is None and command.action in ('on', 'off', 'toggle'):
+                            state = {'on': True, 'off': False}.get(command.action, not device.is_active)
+                        if state is not None:
+                            device.is_active = bool(state)
+                        device.status = 'online'
+                        device.last_seen = datetime.utcnow()
+                db.session.commit()
+        except Exception:
+            logger.exception(f"Could not record result of command {command.action_id}")
+
+
+dispatcher = None
+
+
+def init_app(app):
+    """Start the command dispatcher and its transport (see COMMAND_TRANSPORT)."""
+    global dispatcher
+    dispatcher = CommandDispatcher(
+        app,
+        max_in_flight=app.config.get('MQTT_COMMAND_MAX_IN_FLIGHT', 1000),
+        ack_timeout=app.config.get('MQTT_COMMAND_ACK_TIMEOUT', 5.0),
+        retries=app.config.get('MQTT_COMMAND_RETRIES', 2)
+    )
+    transport_name = app.config.get('COMMAND_TRANSPORT', 'none')
+    if transport_name == 'mqtt':
+        transport = MqttTransport(app.config, dispatcher.handle_message)
+    elif transport_name == 'loopback':
+        logger.warning('Device commands are acknowledged by the loopback transport, not by devices')
+        transport = LoopbackTransport(dispatcher.handle_message)
+    else:
+        if transport_name != 'none':
+            logger.error(f"Unknown COMMAND_TRANSPORT {transport_name!r}; device commands will not be sent")
+        else:
+            logger.warning('No command transport (COMMAND_TRANSPORT=none); device commands will time out')
+        transport = NullTransport()
+    dispatcher.start(transport)
+    metrics.device_commands_in_flight.callback = lambda: {(): len(dispatcher)}
+    return dispatcher
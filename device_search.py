@@ -0,0 +1,464 @@
+"""Device search, answered from memory.
+
+Devices are found by their name, device id, type, room name and home name.
+Each process keeps an index of every device, loaded on first use, kept
+current by ORM events (applied when the session commits) and rebuilt every
+DEVICE_SEARCH_REFRESH seconds for changes made by other processes.
+
+A query is split into terms and a device matches when every term matches
+one of its strings: the term starts a word of the string (word prefix) or,
+for terms of three or more characters, occurs anywhere in the name, type,
+room or home. Device ids only match on word prefixes ('temp' and '0042'
+find 'temp-0042', 'mp-0' does not).
+
+Word prefixes are looked up in a sorted list of every word, each mapped to
+the devices having it. Substrings are found through trigrams of the
+distinct names, types, rooms and homes (only those inside words, as word
+starts are covered by the word list), so a room or home name shared by
+thousands of devices is indexed once. Terms are resolved smallest first:
+the first gives the candidate devices, which the next ones narrow by set
+intersection or, when a term matches far more devices than are left, by
+checking each candidate. A term matching too many words (e.g. a single
+digit) is checked device by device while walking the devices in id order,
+which stops as soon as the page is full. Up to MAX_RANKED matches are
+ranked (exact, then prefix matches of the device id or name, then by name);
+larger results are paged in id order. Results are limited to the homes a
+user can access.
+"""
+import time
+import logging
+import threading
+from bisect import bisect_left, insort
+from heapq import nsmallest
+from operator import attrgetter
+
+from sqlalchemy import event, inspect, select
+from sqlalchemy.orm import Session
+
+from models import db, Home, Floor, Room, Device, HomeAccess
+
+# Get logger
+logger = logging.getLogger('smart_home.device_search')
+
+_CHANGES_KEY = 'device_search_changes'
+# A term starting more words than this is checked device by device
+MAX_TERM_WORDS = 2000
+# A term matching more devices than this is checked device by device
+MAX_TERM_DEVICES = 50000
+# Candidates are checked one by one against the remaining terms up to this many
+MAX_CHECKED = 1000
+# Matches beyond this many are paged in id order instead of by relevance
+MAX_RANKED = 1000
+
+
+def normalize(value):
+    return (value or '').strip().lower()
+
+
+def words(value):
+    """Split a normalized string into its words (runs of letters and digits)."""
+    return ''.join(c if c.isalnum() else ' ' for c in value).split()
+
+
+def trigrams(value):
+    return {value[i:i + 3] for i in range(len(value) - 2)}
+
+
+def inner_trigrams(value):
+    """Return the trigrams of `value` that do not start a word."""
+    return {value[i:i + 3] for i in range(1, len(value) - 2) if value[i - 1].isalnum()}
+
+
+def occurs_inside_word(term, value):
+    i = value.find(term, 1)
+    while i > 0:
+        if value[i - 1].isalnum():
+            return True
+        i = value.find(term, i + 1)
+    return False
+
+
+class SearchDoc:
+    """A device as the index sees it."""
+    __slots__ = ('id', 'device_id', 'name', 'type', 'status', 'room_id', 'home_id', 'key', 'strings', 'words')
+
+    def __init__(self, id, device_id, name, type, status, room_id):
+        self.id = id
+        self.device_id = device_id
+        self.name = name
+        self.type = type
+        self.status = status
+        self.room_id = room_id
+        self.home_id = None
+        self.key = (normalize(name), id)
+        # (device id, name, type, room name, home name), normalized
+        self.strings = ()
+        self.words = ()
+
+    def matches(self, term):
+        for word in self.words:
+            if word.startswith(term):
+                return True
+        return len(term) >= 3 and any(term in value for value in self.strings[1:])
+
+
+class DeviceSearchIndex:
+    """In-memory search index of every device."""
+
+    def __init__(self, refresh=300.0):
+        self.refresh = refresh
+        self.loaded_at = None
+        self._lock = threading.RLock()
+        self._clear()
+
+    def _clear(self):
+        self._docs = {}
+        # Every device id, sorted
+        self._ids = []
+        self._homes = {}
+        self._floors = {}
+        self._rooms = {}
+        self._room_docs = {}
+        self._home_docs = {}
+        # word -> ids of the devices having it, and every word, sorted
+        self._word_docs = {}
+        self._words = []
+        # name, type, room or home -> ids of the devices having it
+        self._postings = {}
+        # trigram -> names, types, rooms and homes containing it inside a word
+        self._grams = {}
+
+    def __len__(self):
+        return len(self._docs)
+
+    # Maintenance
+
+    def _index(self, doc, sort=True):
+        room = self._rooms.get(doc.room_id)
+        floor = self._floors.get(room[1]) if room else None
+        doc.home_id = floor[1] if floor else None
+        doc.strings = (normalize(doc.device_id), normalize(doc.name), normalize(doc.type),
+                       normalize(room[0]) if room else '', normalize(self._homes.get(doc.home_id)))
+        doc.words = tuple({word for value in doc.strings for word in words(value)})
+        for word in doc.words:
+            ids = self._word_docs.get(word)
+            if ids is None:
+                ids = self._word_docs[word] = set()
+                if sort:
+                    insort(self._words, word)
+            ids.add(doc.id)
+        for value in set(doc.strings[1:]):
+            if not value:
+                continue
+            ids = self._postings.get(value)
+            if ids is None:
+                ids = self._postings[value] = set()
+                for gram in inner_trigrams(value):
+                    self._grams.setdefault(gram, set()).add(value)
+            ids.add(doc.id)
+        self._room_docs.setdefault(doc.room_id, set()).add(doc.id)
+        self._home_docs.setdefault(doc.home_id, set()).add(doc.id)
+
+    def _unindex(self, doc):
+        for word in doc.words:
+            ids = self._word_docs.get(word)
+            if ids is None:
+                continue
+            ids.discard(doc.id)
+            if not ids:
+                del self._word_docs[word]
+                i = bisect_left(self._words, word)
+                if i < len(self._words) and self._words[i] == word:
+                    del self._words[i]
+        for value in set(doc.strings[1:]):
+            ids = self._postings.get(value)
+            if ids is None:
+                continue
+            ids.discard(doc.id)
+            if not ids:
+                del self._postings[value]
+                for gram in inner_trigrams(value):
+                    strings = self._grams.get(gram)
+                    if strings is not None:
+                        strings.discard(value)
+                        if not strings:
+                            del self._grams[gram]
+        self._room_docs.get(doc.room_id, set()).discard(doc.id)
+        self._home_docs.get(doc.home_id, set()).discard(doc.id)
+
+    def _put_device(self, id, device_id, name, type, status, room_id):
+        previous = self._docs.get(id)
+        if previous is None:
+            insort(self._ids, id)
+        else:
+            self._unindex(previous)
+        doc = self._docs[id] = SearchDoc(id, device_id, name, type, status, room_id)
+        self._index(doc)
+
+    def _drop_device(self, id):
+        doc = self._docs.pop(id, None)
+        if doc is None:
+            return
+        self._unindex(doc)
+        i = bisect_left(self._ids, id)
+        if i < len(self._ids) and self._ids[i] == id:
+            del self._ids[i]
+
+    def _reindex(self, doc_ids):
+        for doc_id in list(doc_ids):
+            doc = self._docs.get(doc_id)
+            if doc is not None:
+                self._unindex(doc)
+                self._index(doc)
+
+    def load(self, session):
+        """Index every device, with its room, floor and home."""
+        homes = session.execute(select(Home.id, Home.name)).all()
+        floors = session.execute(select(Floor.id, Floor.floor_number, Floor.home_id)).all()
+        rooms = session.execute(select(Room.id, Room.name, Room.floor_id)).all()
+        devices = session.execute(
+            select(Device.id, Device.device_id, Device.name, Device.type, Device.status, Device.room_id)
+        ).all()
+        with self._lock:
+            self._clear()
+            self._homes = dict(homes)
+            self._floors = {floor_id: [floor_number, home_id] for floor_id, floor_number, home_id in floors}
+            self._rooms = {room_id: [name, floor_id] for room_id, name, floor_id in rooms}
+            docs = [SearchDoc(*row) for row in devices]
+            for doc in docs:
+                self._docs[doc.id] = doc
+                self._index(doc, sort=False)
+            self._words = sorted(self._word_docs)
+            self._ids = sorted(self._docs)
+            self.loaded_at = time.monotonic()
+        logger.info(f"Indexed {len(docs)} device(s) for search")
+
+    def _ensure_loaded(self, session):
+        if self.loaded_at is None:
+            with self._lock:
+                if self.loaded_at is None:
+                    self.load(session)
+
+    def apply(self, changes):
+        """Apply committed (kind, id, values) changes; kinds are home, floor, room, device and status."""
+        if self.loaded_at is None:
+            return
+        with self._lock:
+            for kind, ident, values in changes:
+                if kind == 'home':
+                    if values is None:
+                        self._homes.pop(ident, None)
+                    elif self._homes.get(ident) != values[0]:
+                        self._homes[ident] = values[0]
+                        self._reindex(self._home_docs.get(ident, ()))
+                elif kind == 'floor':
+                    if values is None:
+                        self._floors.pop(ident, None)
+                    elif self._floors.get(ident) != list(values):
+                        self._floors[ident] = list(values)
+                        self._reindex([doc_id for room_id, room in self._rooms.items() if room[1] == ident
+                                       for doc_id in self._room_docs.get(room_id, ())])
+                elif kind == 'room':
+                    if values is None:
+                        self._rooms.pop(ident, None)
+                    elif self._rooms.get(ident) != list(values):
+                        self._rooms[ident] = list(values)
+                        self._reindex(self._room_docs.get(ident, ()))
+                elif values is None:
+                    self._drop_device(ident)
+                elif kind == 'status':
+                    doc = self._docs.get(ident)
+                    if doc is not None:
+                        doc.status = values
+                else:
+                    self._put_device(ident, *values)
+
+    # Queries
+
+    def _term_sets(self, term):
+        """Return the device id sets whose union matches `term`, or None if it starts too many words."""
+        lo = bisect_left(self._words, term)
+        hi = bisect_left(self._words, term + '\uffff', lo)
+        if hi - lo > MAX_TERM_WORDS:
+            return None
+        word_docs = self._word_docs
+        sets = [word_docs[word] for word in self._words[lo:hi]]
+        if len(term) >= 3:
+            grams = [self._grams.get(gram) for gram in trigrams(term)]
+            if all(grams):
+                grams.sort(key=len)
+                for value in grams[0].intersection(*grams[1:]):
+                    if occurs_inside_word(term, value):
+                        sets.append(self._postings[value])
+        return sets
+
+    def _walk(self, candidates, checked, offset, limit):
+        """Page through the devices in id order, keeping candidates matching every checked term."""
+        docs = self._docs
+        page = []
+        for doc_id in self._ids:
+            if candidates is not None and doc_id not in candidates:
+                continue
+            doc = docs[doc_id]
+            if all(doc.matches(term) for term in checked):
+                page.append(doc)
+                if len(page) > offset + limit:
+                    break
+        return page[offset:offset + limit], len(page) > offset + limit
+
+    def search(self, session, query='', home_ids=None, offset=0, limit=20):
+        """Return (devices, total, has_more) for a page of the devices matching `query`.
+
+        `home_ids` limits the results to those homes (None: every home).
+        `total` is None when the matches were paged without counting them.
+        """
+        self._ensure_loaded(session)
+        query = normalize(query)
+        with self._lock:
+            candidates = None
+            if home_ids is not None:
+                candidates = set().union(*(self._home_docs.get(home_id, ()) for home_id in home_ids))
+            checked = []
+            resolved = []
+            for term in set(words(query)):
+                sets = self._term_sets(term)
+                if sets is None:
+                    checked.append(term)
+                else:
+                    resolved.append((sum(map(len, sets)), term, sets))
+            resolved.sort(key=lambda item: item[0])
+            for size, term, sets in resolved:
+                if candidates is not None and len(candidates) <= MAX_CHECKED and size > 8 * len(candidates):
+                    checked.append(term)
+                elif size > MAX_TERM_DEVICES and len(sets) > 1:
+                    checked.append(term)
+                elif candidates is None:
+                    candidates = sets[0] if len(sets) == 1 else set().union(*sets)
+                else:
+                    candidates = set().union(*(candidates.intersection(ids) for ids in sets))
+
+            if checked:
+                if candidates is None or len(candidates) > MAX_CHECKED:
+                    # Broad terms: their matches are dense, so walking fills a page quickly
+                    page, has_more = self._walk(candidates, checked, offset, limit)
+                    return page, None, has_more
+                docs = self._docs
+                candidates = {doc_id for doc_id in candidates
+                              if all(docs[doc_id].matches(term) for term in checked)}
+            docs = self._docs
+            if candidates is None:
+                page = [docs[doc_id] for doc_id in self._ids[offset:offset + limit]]
+                return page, len(docs), len(docs) > offset + limit
+            if len(candidates) > MAX_RANKED:
+                if len(candidates) * 2 >= len(docs):
+                    page, has_more = self._walk(candidates, (), offset, limit)
+                else:
+                    page = [docs[doc_id] for doc_id in nsmallest(offset + limit, candidates)[offset:]]
+                    has_more = len(candidates) > offset + limit
+                return page, len(candidates), has_more
+
+            def rank(doc):
+                device_id, name = doc.strings[0], doc.strings[1]
+                if device_id == query or name == query:
+                    return 0, doc.key
+                if device_id.startswith(query) or name.startswith(query):
+                    return 1, doc.key
+                return 2, doc.key
+
+            page = nsmallest(offset + limit, (docs[doc_id] for doc_id in candidates),
+                             key=rank if query else attrgetter('key'))
+            return page[offset:], len(candidates), len(candidates) > offset + limit
+
+    def describe(self, doc):
+        """Return a search result as a dict."""
+        room = self._rooms.get(doc.room_id)
+        floor = self._floors.get(room[1]) if room else None
+        return {
+            'id': doc.id,
+            'device_id': doc.device_id,
+            'name': doc.name,
+            'type': doc.type,
+            'status': doc.status,
+            'room_id': doc.room_id,
+            'room': room[0] if room else None,
+            'floor_number': floor[0] if floor else None,
+            'home_id': doc.home_id,
+            'home': self._homes.get(doc.home_id),
+        }
+
+    def run(self, app):
+        while True:
+            time.sleep(self.refresh)
+            if self.loaded_at is None:
+                # Never searched in this process
+                continue
+            try:
+                with app.app_context():
+                    self.load(db.session)
+                    db.session.rollback()
+            except Exception:
+                logger.exception('Rebuilding the device search index failed')
+
+
+index = DeviceSearchIndex()
+
+
+def user_home_ids(session, user):
+    """Return the ids of the homes `user` owns or was given access to, or None for admins (every home)."""
+    if user.is_admin:
+        return None
+    shared = select(HomeAccess.home_id).where(HomeAccess.user_id == user.id)
+    return set(session.scalars(select(Home.id).where((Home.owner_id == user.id) | Home.id.in_(shared))))
+
+
+@event.listens_for(Session, 'after_flush')
+def _collect_search_changes(session, flush_context):
+    if index.loaded_at is None:
+        return
+    changes = []
+    new, deleted = session.new, session.deleted
+    for instance in list(new) + list(session.dirty):
+        if instance in deleted:
+            continue
+        if isinstance(instance, Device):
+            if instance in new or any(
+                inspect(instance).attrs[name].history.has_changes() for name in ('device_id', 'name', 'type', 'room_id')
+            ):
+                changes.append(('device', instance.id, (instance.device_id, instance.name, instance.type,
+                                                        instance.status, instance.room_id)))
+            elif inspect(instance).attrs.status.history.has_changes():
+                changes.append(('status', instance.id, instance.status))
+        elif isinstance(instance, Room):
+            changes.append(('room', instance.id, (instance.name, instance.floor_id)))
+        elif isinstance(instance, Floor):
+            changes.append(('floor', instance.id, (instance.floor_number, instance.home_id)))
+        elif isinstance(instance, Home):
+            changes.append(('home', instance.id, (instance.name,)))
+    for instance in deleted:
+        for kind, model in (('device', Device), ('room', Room), ('floor', Floor), ('home', Home)):
+            if isinstance(instance, model):
+                changes.append((kind, instance.id, None))
+    if changes:
+        # Parents first, so new devices find their room, floor and home
+        order = {'home': 0, 'floor': 1, 'room': 2, 'device': 3, 'status': 3}
+        changes.sort(key=lambda change: order[change[0]])
+        session.info.setdefault(_CHANGES_KEY, []).extend(changes)
+
+
+@event.listens_for(Session, 'after_commit')
+def _apply_search_changes(session):
+    changes = session.info.pop(_CHANGES_KEY, None)
+    if changes:
+        index.apply(changes)
+
+
+@event.listens_for(Session, 'after_rollback')
+def _discard_search_changes(session):
+    session.info.pop(_CHANGES_KEY, None)
+
+
+def init_app(app):
+    """Rebuild the device search index periodically for changes made by other processes."""
+    index.refresh = app.config.get('DEVICE_SEARCH_REFRESH', 300.0)
+    if index.refresh:
+        threading.Thread(target=index.run, args=(app,), name='device-search', daemon=True).start()
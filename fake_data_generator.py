@@ -1,15 +1,27 @@
 import os
+import time
 import random
 from datetime import datetime, timedelta
+from itertools import repeat
+from multiprocessing import Pool
 from faker import Faker
 import argparse
+
+# NumPy is only needed for --bulk sensor data generation
+try:
+    import numpy as np
+except ImportError:
+    np = None
 from flask import Flask
 from flask_sqlalchemy import SQLAlchemy
+import database
+import sharding
+from config import Config
 
 # Import models
 from models import (
     db, User, UserRole, UserRoleMapping, Home, Floor, Room,
-    Device, SensorData, UserAction, HomeAccess
+    Device, SensorData, UserAction, HomeAccess, rebuild_sensor_sketches, record_late_data
 )
 
 # Initialize Faker
@@ -17,9 +29,14 @@ fake = Faker()
 
 # Configure Flask app
 app = Flask(__name__)
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///smart_home.db'  # Change as needed
+app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get('DATABASE_URL') or 'sqlite:///smart_home.db'  # Change as needed
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-db.init_app(app)
+# Sensor data and user actions go to the app's shards, if it has any
+app.config['SHARD_DATABASE_URLS'] = Config.SHARD_DATABASE_URLS
+app.config['SQLALCHEMY_BINDS'] = dict(Config.SHARD_BINDS)
+# WAL and a busy timeout, so that the dashboard keeps reading during imports
+database.init_app(app, db)
+sharding.init_app(app, db)
 
 # Common device types per room
 DEVICE_TYPES = {
@@ -37,6 +54,7 @@ ROOM_TYPES = ['kitchen', 'living_room', 'bedroom', 'bathroom', 'garage', 'garden
 ACCESS_LEVELS = ['owner', 'admin', 'user', 'guest']
 DEVICE_STATUSES = ['online', 'offline', 'maintenance', 'error']
 ACTION_STATUSES = ['pending', 'completed', 'failed', 'cancelled']
+SENSOR_KEYWORDS = ['sensor', 'detector', 'meter', 'temperature', 'humidity']
 
 def create_users(count=10):
     """Create fake users"""
@@ -233,35 +251,37 @@ def create_devices(rooms):
     db.session.commit()
     return devices
 
-def create_sensor_data(devices, days=30):
+def is_sensor_device(device_type):
+    """Only actual sensors produce readings"""
+    return any(sensor_type in device_type for sensor_type in SENSOR_KEYWORDS)
+
+def sensor_value_range(device_type):
+    """Return (min_val, max_val, unit) for a sensor device type"""
+    if 'temperature' in device_type:
+        return 18.0, 28.0, '°C'
+    elif 'humidity' in device_type:
+        return 30.0, 70.0, '%'
+    elif 'light' in device_type or 'motion' in device_type:
+        return 0.0, 1.0, 'bool'
+    return 0.0, 100.0, 'unit'
+
+def create_sensor_data(devices, days=30, max_readings_per_day=24, end_date=None):
     """Create historical sensor data for devices"""
     print(f"Creating sensor data for the past {days} days...")
     sensor_data = []
     
     # Only generate sensor data for actual sensors
-    sensor_devices = [d for d in devices if any(sensor_type in d.type for sensor_type in 
-                                             ['sensor', 'detector', 'meter', 'temperature', 'humidity'])]
+    sensor_devices = [d for d in devices if is_sensor_device(d.type)]
     
     for device in sensor_devices:
         # Generate data points for each day
-        start_date = datetime.utcnow() - timedelta(days=days)
+        start_date = (end_date or datetime.utcnow()) - timedelta(days=days)
         
         # Determine appropriate value range and unit based on device type
-        if 'temperature' in device.type:
-            min_val, max_val = 18.0, 28.0
-            unit = '°C'
-        elif 'humidity' in device.type:
-            min_val, max_val = 30.0, 70.0
-            unit = '%'
-        elif 'light' in device.type or 'motion' in device.type:
-            min_val, max_val = 0.0, 1.0
-            unit = 'bool'
-        else:
-            min_val, max_val = 0.0, 100.0
-            unit = 'unit'
+        min_val, max_val, unit = sensor_value_range(device.type)
             
-        # Create multiple readings per day (1-24)
-        readings_per_day = random.randint(4, 24)
+        # Create multiple readings per day (4-max_readings_per_day)
+        readings_per_day = random.randint(4, max(4, max_readings_per_day))
         for day in range(days):
             for _ in range(readings_per_day):
                 timestamp = start_date + timedelta(days=day, 
@@ -303,6 +323,140 @@ def create_sensor_data(devices, days=30):
         db.session.add_all(sensor_data)
         db.session.commit()
 
+def generate_device_readings(task):
+    """Generate one device's readings with NumPy (runs in worker processes).
+    
+    Follows the same patterns as create_sensor_data. Each device gets its own
+    random stream derived from (seed, device index), so the output does not
+    depend on the number of workers.
+    """
+    index, device_id, device_type, start, days, max_readings_per_day, seed = task
+    rng = np.random.default_rng([seed, index])
+    min_val, max_val, unit = sensor_value_range(device_type)
+    
+    readings_per_day = int(rng.integers(4, max(4, max_readings_per_day) + 1))
+    count = days * readings_per_day
+    day_offsets = np.repeat(np.arange(days, dtype=np.int64), readings_per_day)
+    minute_offsets = day_offsets * 1440 + rng.integers(0, 1440, count)
+    timestamps = np.datetime64(start, 'us') + minute_offsets.astype('timedelta64[m]')
+    
+    # Create some patterns in the data
+    start_minute = start.hour * 60 + start.minute
+    hour = ((start_minute + minute_offsets) // 60) % 24
+    uniform = rng.random(count)
+    if 'temperature' in device_type:
+        # Temperature is lower at night, higher during day
+        night = (hour < 6) | (hour > 20)
+        low = np.where(night, min_val - 3, min_val + 2)
+        high = np.where(night, min_val + 2, max_val)
+    elif 'light' in device_type:
+        # Light sensors detect light during the day
+        day = (hour >= 7) & (hour <= 19)
+        low = np.where(day, 0.7, 0.0)
+        high = np.where(day, 1.0, 0.3)
+    else:
+        low, high = min_val, max_val
+    values = np.round(low + (high - low) * uniform, 2)
+    
+    # Same text format SQLAlchemy uses for DateTime columns on SQLite
+    timestamp_text = np.char.replace(np.datetime_as_string(timestamps, unit='us'), 'T', ' ')
+    return device_id, unit, values, timestamps, timestamp_text
+
+def create_sensor_data_bulk(devices, days=30, max_readings_per_day=24, seed=None,
+                            workers=1, end_date=None):
+    """Create historical sensor data with vectorized generation and bulk inserts.
+    
+    Readings are generated per device in `workers` processes while the main
+    process inserts them: through the raw sqlite3 cursor's executemany on
+    SQLite (index rebuilt after loading), or Core executemany elsewhere.
+    """
+    if np is None:
+        raise SystemExit("--bulk requires NumPy (pip install numpy)")
+    if seed is None:
+        seed = int(np.random.SeedSequence().entropy % (2 ** 32))
+    print(f"Creating sensor data for the past {days} days (bulk, seed={seed}, workers={workers})...")
+    
+    start = (end_date or datetime.utcnow()) - timedelta(days=days)
+    sensor_devices = [d for d in devices if is_sensor_device(d.type)]
+    tasks = [
+        (index, device.device_id, device.type, start, days, max_readings_per_day, seed)
+        for index, device in enumerate(sensor_devices)
+    ]
+    
+    table = SensorData.__table__
+    # Sharded rows get ids reserved across shards
+    sharded = sharding.shard_map.enabled
+    columns = (('id',) if sharded else ()) + ('device_id', 'value', 'unit', 'timestamp')
+    insert_sql = f"INSERT INTO sensor_data ({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))})"
+    started = time.perf_counter()
+    total = 0
+    
+    # (connection, sqlite3 cursor or None) per shard, opened on first use
+    connections = {}
+    
+    def connection_for(device_id):
+        shard = sharding.device_shard(device_id)
+        if shard not in connections:
+            engine = sharding.shard_map.engines[shard] if shard is not None else db.engine
+            if engine.dialect.name == 'sqlite':
+                connection = engine.raw_connection()
+                cursor = connection.cursor()
+                cursor.execute("PRAGMA synchronous=OFF")
+                cursor.execute("DROP INDEX IF EXISTS idx_device_timestamp")
+                connections[shard] = (connection, cursor)
+            else:
+                connections[shard] = (engine.connect(), None)
+        return connections[shard]
+    
+    try:
+        pool = Pool(workers) if workers > 1 else None
+        results = pool.imap(generate_device_readings, tasks, chunksize=4) if pool \
+            else map(generate_device_readings, tasks)
+        try:
+            for device_id, unit, values, timestamps, timestamp_text in results:
+                connection, cursor = connection_for(device_id)
+                ids = [sharding.id_allocator.allocate('sensor_data', len(values))] if sharded else []
+                if cursor is not None:
+                    cursor.executemany(insert_sql, zip(
+                        *ids, repeat(device_id), values.tolist(), repeat(unit), timestamp_text.tolist()))
+                else:
+                    connection.execute(table.insert(), [
+                        dict(zip(columns, row)) for row in zip(
+                            *ids, repeat(device_id), values.tolist(), repeat(unit), timestamps.tolist())
+                    ])
+                total += len(values)
+                # Commit in batches to bound transaction size
+                if total % 1_000_000 < len(values):
+                    for connection, _ in connections.values():
+                        connection.commit()
+        finally:
+            if pool:
+                pool.close()
+                pool.join()
+        
+        for connection, _ in connections.values():
+            connection.commit()
+    finally:
+        # Restore the index even when loading failed part way
+        for connection, cursor in connections.values():
+            try:
+                if cursor is not None:
+                    connection.rollback()
+                    print("Rebuilding sensor data index...")
+                    cursor.execute("CREATE INDEX IF NOT EXISTS idx_device_timestamp "
+                                   "ON sensor_data (device_id, timestamp)")
+                    connection.commit()
+            finally:
+                connection.close()
+    
+    # Drop cached results for the loaded days in running app processes
+    with db.engine.begin() as connection:
+        record_late_data(connection, None, start)
+    
+    elapsed = time.perf_counter() - started
+    print(f"Inserted {total} readings in {elapsed:.1f}s ({total / max(elapsed, 1e-9) * 60:,.0f} rows/min)")
+    return total
+
 def create_user_actions(users, devices, count=200):
     """Create user actions for devices"""
     print(f"Creating {count} user actions...")
@@ -393,15 +547,24 @@ def create_home_access(users, homes):
     db.session.commit()
 
 def main(args):
+    # Seed every source of randomness for reproducible datasets
+    if args.seed is not None:
+        random.seed(args.seed)
+        Faker.seed(args.seed)
+    end_date = datetime.strptime(args.end_date, '%Y-%m-%d') if args.end_date else None
+    
     with app.app_context():
         # Create tables if they don't exist
         db.create_all()
+        sharding.create_tables()
         
         # Check if we should clear existing data
         if args.clear:
             print("Clearing existing data...")
             db.drop_all()
+            sharding.drop_tables()
             db.create_all()
+            sharding.create_tables()
         
         # Generate data
         users = create_users(args.users)
@@ -414,7 +577,14 @@ def main(args):
         
         devices = create_devices(rooms)
         
-        create_sensor_data(devices, args.days)
+        if args.bulk:
+            create_sensor_data_bulk(devices, args.days, args.max_readings_per_day,
+                                    seed=args.seed, workers=args.workers, end_date=end_date)
+            # Bulk inserts bypass the ORM, so summarize the readings afterwards
+            print("Building hourly sensor data sketches...")
+            rebuild_sensor_sketches()
+        else:
+            create_sensor_data(devices, args.days, args.max_readings_per_day, end_date=end_date)
         create_user_actions(users, devices, args.actions)
         create_home_access(users, homes)
         
@@ -435,6 +605,16 @@ if __name__ == "__main__":
                         help='Number of days of historical sensor data to generate')
     parser.add_argument('--actions', type=int, default=200, 
                         help='Number of user actions to generate')
+    parser.add_argument('--max-readings-per-day', type=int, default=24,
+                        help='Upper bound of sensor readings per device per day')
+    parser.add_argument('--seed', type=int,
+                        help='Random seed for reproducible data')
+    parser.add_argument('--end-date',
+                        help='Generate sensor data up to this date (YYYY-MM-DD) instead of now')
+    parser.add_argument('--bulk', action='store_true',
+                        help='Generate sensor data with NumPy and bulk inserts (much faster)')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='Worker processes generating sensor data in --bulk mode')
     
     args = parser.parse_args()
     main(args)
\ No newline at end of file
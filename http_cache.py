@@ -0,0 +1,104 @@
+"""HTTP cache policy per route class.
+
+- Static files get a content hash in their URL (`?v=<hash>`, added by
+  url_for) and are served as immutable for a year. Requests without the
+  current hash are revalidated with the ETag/Last-Modified of send_file.
+- Successful GET pages and API responses are `private, no-cache` with an
+  ETag, so browsers revalidate and get a bodyless 304 when nothing changed.
+  Shared caches never store them.
+- Everything else (writes, errors, login pages that embed tokens, metrics)
+  keeps `no-store`.
+"""
+import os
+import hashlib
+from flask import request
+
+STATIC_MAX_AGE = 365 * 24 * 3600
+# Endpoints whose responses must never be stored, even privately
+NO_STORE_ENDPOINTS = {'login', 'register', 'logout', 'validate_token', 'metrics_endpoint'}
+
+
+def _is_static(endpoint):
+    return endpoint == 'static' or (endpoint or '').endswith('.static')
+
+
+class StaticVersions:
+    """Content hashes of static files, recomputed when a file changes."""
+
+    def __init__(self):
+        self._hashes = {}
+
+    def get(self, path):
+        try:
+            mtime = os.stat(path).st_mtime_ns
+        except OSError:
+            return None
+        cached = self._hashes.get(path)
+        if cached and cached[0] == mtime:
+            return cached[1]
+        digest = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(65536), b''):
+                digest.update(chunk)
+        version = digest.hexdigest()[:12]
+        self._hashes[path] = (mtime, version)
+        return version
+
+
+def _static_path(app, endpoint, filename):
+    if endpoint == 'static':
+        folder = app.static_folder
+    else:
+        blueprint = app.blueprints.get(endpoint.rsplit('.', 1)[0])
+        folder = blueprint.static_folder if blueprint else None
+    if not folder:
+        return None
+    path = os.path.normpath(os.path.join(folder, filename))
+    return path if path.startswith(os.path.normpath(folder) + os.sep) else None
+
+
+def _no_store(response):
+    response.headers['Cache-Control'] = 'no-store, no-cache, must-revalidate, max-age=0'
+    response.headers['Pragma'] = 'no-cache'
+    response.headers['Expires'] = '-1'
+    return response
+
+
+def init_app(app):
+    """Version static URLs and apply the cache policy to every response."""
+    versions = StaticVersions()
+
+    @app.url_defaults
+    def add_static_version(endpoint, values):
+        if _is_static(endpoint) and 'v' not in values and values.get('filename'):
+            path = _static_path(app, endpoint, values['filename'])
+            version = versions.get(path) if path else None
+            if version:
+                values['v'] = version
+
+    @app.after_request
+    def apply_cache_policy(response):
+        if _is_static(request.endpoint):
+            path = _static_path(app, request.endpoint, request.view_args.get('filename', ''))
+            version = request.args.get('v')
+            if response.status_code == 200 and version and path and version == versions.get(path):
+                response.cache_control.no_cache = None
+                response.cache_control.public = True
+                response.cache_control.max_age = STATIC_MAX_AGE
+                response.cache_control.immutable = True
+            else:
+                response.cache_control.public = True
+                response.cache_control.no_cache = True
+            return response
+
+        if (request.method not in ('GET', 'HEAD') or response.status_code != 200
+                or request.endpoint in NO_STORE_ENDPOINTS
+                or response.is_streamed or 'Set-Cookie' in response.headers):
+            return _no_store(response)
+
+        # Authenticated data: only the user's browser may keep it, and must
+        # revalidate it on every use
+        response.headers['Cache-Control'] = 'private, no-cache'
+        response.vary.update(('Authorization', 'Cookie'))
+        response.add_etag()
+        return response.make_conditional(request)
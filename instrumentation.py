@@ -0,0 +1,139 @@
+import re
+import json
+import time
+import logging
+from collections import Counter
+from flask import request, has_request_context
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# Get logger
+logger = logging.getLogger('smart_home.sql')
+
+# Patterns used to reduce a statement to its shape
+_IN_LIST = re.compile(r'\(\s*(?:\?|%s|:\w+)(?:\s*,\s*(?:\?|%s|:\w+))*\s*\)')
+_STRING_LITERAL = re.compile(r"'(?:[^']|'')*'")
+_NUMBER_LITERAL = re.compile(r'\b\d+(?:\.\d+)?\b')
+_WHITESPACE = re.compile(r'\s+')
+
+
+class RepeatedStatementError(AssertionError):
+    """Raised in strict mode when a request repeats a statement shape too often."""
+
+
+def statement_shape(statement):
+    """Normalize a SQL statement so that N+1 repetitions compare equal."""
+    shape = _STRING_LITERAL.sub('?', statement)
+    shape = _NUMBER_LITERAL.sub('?', shape)
+    shape = _IN_LIST.sub('(...)', shape)
+    return _WHITESPACE.sub(' ', shape).strip()
+
+
+class RequestSqlStats:
+    """SQL statistics collected during a single request."""
+
+    def __init__(self):
+        self.count = 0
+        self.total_time = 0.0
+        self.slowest_time = 0.0
+        self.slowest_statement = None
+        self.shapes = Counter()
+
+    def record(self, statement, duration):
+        shape = statement_shape(statement)
+        self.count += 1
+        self.total_time += duration
+        self.shapes[shape] += 1
+        if duration >= self.slowest_time:
+            self.slowest_time = duration
+            self.slowest_statement = shape
+        return shape, self.shapes[shape]
+
+    def repeated(self, minimum=2):
+        """Return statement shapes executed at least `minimum` times."""
+        return {shape: count for shape, count in self.shapes.most_common() if count >= minimum}
+
+    def server_timing(self):
+        """Format the statistics as a Server-Timing header value."""
+        return (
+            f'db;dur={self.total_time * 1000:.2f};desc="{self.count} queries", '
+            f'db-slowest;dur={self.slowest_time * 1000:.2f}'
+        )
+
+    def to_dict(self):
+        return {
+            'statement_count': self.count,
+            'db_time_ms': round(self.total_time * 1000, 2),
+            'slowest_ms': round(self.slowest_time * 1000, 2),
+            'slowest_statement': self.slowest_statement,
+            'repeated_statements': self.repeated()
+        }
+
+
+# Views push their own app context (and therefore a fresh `g`), so the
+# statistics live in the WSGI environ of the request instead
+_STATS_KEY = 'smart_home.sql_stats'
+_LIMIT_KEY = 'smart_home.sql_strict_repeat_limit'
+
+
+def current_sql_stats():
+    """Return the statistics of the current request, or None outside requests."""
+    if not has_request_context():
+        return None
+    return request.environ.get(_STATS_KEY)
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    # Kept on the execution context, so a failed statement leaves nothing behind
+    if context is not None:
+        context._query_start = time.perf_counter()
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    started = getattr(context, '_query_start', None)
+    if started is None:
+        return
+    duration = time.perf_counter() - started
+    stats = current_sql_stats()
+    if stats is None:
+        return
+    shape, repeats = stats.record(statement, duration)
+    limit = request.environ.get(_LIMIT_KEY)
+    if limit is not None and repeats > limit:
+        raise RepeatedStatementError(
+            f"Statement executed {repeats} times in {request.method} {request.path} "
+            f"(limit {limit}), likely an N+1 query: {shape}"
+        )
+
+
+def init_app(app):
+    """Collect per-request SQL statistics and report them on each response."""
+    if not app.config.get('SQL_INSTRUMENTATION', True):
+        return
+    log_threshold = app.config.get('SQL_LOG_THRESHOLD_MS', 100) / 1000
+
+    @app.before_request
+    def start_sql_stats():
+        request.environ[_STATS_KEY] = RequestSqlStats()
+        request.environ[_LIMIT_KEY] = app.config.get('SQL_STRICT_REPEAT_LIMIT')
+
+    @app.after_request
+    def report_sql_stats(response):
+        stats = current_sql_stats()
+        if stats is None:
+            return response
+        response.headers.add('Server-Timing', stats.server_timing())
+        # Only requests that spent long in the database are logged at INFO
+        level = logging.INFO if stats.total_time >= log_threshold else logging.DEBUG
+        if stats.count and logger.isEnabledFor(level):
+            logger.log(level, json.dumps({
+                'event': 'request_sql',
+                'method': request.method,
+                'path': request.path,
+                'endpoint': request.endpoint,
+                'status': response.status_code,
+                **stats.to_dict()
+            }))
+        return response
@@ -0,0 +1,505 @@
+"""Bulk import and export of homes, floors, rooms and devices.
+
+An inventory is a list of homes, each with nested floors, rooms and devices:
+
+    {"homes": [{"name": "Block A, 1", "address": "...", "owner": "alice",
+                "floors": [{"floor_number": 1, "name": "Ground",
+                            "rooms": [{"name": "Kitchen", "room_type": "kitchen",
+                                       "devices": [{"device_id": "temp-a1-k",
+                                                    "name": "Kitchen temperature",
+                                                    "type": "temperature"}]}]}]}]}
+
+or the same as CSV, one row per device (CSV_FIELDS; a row without device_id
+only declares its room, one without room_name only its floor).
+
+Rows are upserted by their natural keys: a home by "id", or else by owner
+and name; a floor by floor number in its home (unique_floor_in_home); a room
+by name on its floor; a device by device_id. The whole inventory is checked
+in memory first, against itself and the rows already stored (required
+fields, column lengths, duplicate floor numbers, room names and device ids,
+devices registered to another home), and nothing is written if any check
+fails. Everything is then written in one transaction and a single flush, so
+the inserts and updates of each table go out as batched statements (on
+PostgreSQL; SQLite cannot return the ids of a multi-row insert, so rows are
+inserted one statement at a time) and the device counters, legacy aliases
+and other ORM hooks stay current.
+"""
+import csv
+import json
+import logging
+
+from sqlalchemy import select
+
+import device_aliases
+from models import db, User, Home, Floor, Room, Device, DeviceAlias
+
+# Get logger
+logger = logging.getLogger('smart_home.inventory')
+
+CSV_FIELDS = ('home_id', 'home_name', 'home_address', 'owner', 'floor_number', 'floor_name',
+              'room_name', 'room_type', 'device_id', 'device_name', 'device_type', 'is_active')
+# Columns of each level an inventory can set, and the fields that name them
+HOME_FIELDS = {'name': 'name', 'address': 'address'}
+FLOOR_FIELDS = {'name': 'name'}
+ROOM_FIELDS = {'room_type': 'room_type'}
+DEVICE_FIELDS = {'name': 'name', 'type': 'type', 'is_active': 'is_active'}
+# IN lists are split so queries stay under the bound parameter limits
+LOOKUP_CHUNK = 500
+
+
+class InventoryError(ValueError):
+    """Raised when an inventory fails validation; `errors` lists every problem."""
+
+    def __init__(self, errors):
+        super().__init__(f"{len(errors)} error(s) in inventory: {errors[0]}" if errors else 'Invalid inventory')
+        self.errors = errors
+
+
+def parse_bool(value):
+    if isinstance(value, bool) or value is None:
+        return value
+    return str(value).strip().lower() in ('1', 'true', 'yes', 'on')
+
+
+def parse_json(data):
+    """Return the homes of a JSON inventory (an object with "homes", or a list)."""
+    if isinstance(data, (str, bytes)):
+        data = json.loads(data)
+    homes = data.get('homes') if isinstance(data, dict) else data
+    if not isinstance(homes, list):
+        raise InventoryError(['Expected a list of homes or an object with a "homes" list'])
+    return homes
+
+
+def parse_csv(lines):
+    """Return the homes of a CSV inventory, given an iterable of lines."""
+    homes = {}
+    for line, row in enumerate(csv.DictReader(lines), start=2):
+        row = {key: (value or '').strip() for key, value in row.items() if key}
+        if not row.get('home_name') and not row.get('home_id'):
+            raise InventoryError([f'line {line}: home_name or home_id is required'])
+        key = row.get('home_id') or (row.get('owner'), row.get('home_name'))
+        home = homes.get(key)
+        if home is None:
+            home = homes[key] = {'name': row.get('home_name') or None, 'address': row.get('home_address') or None,
+                                 'owner': row.get('owner') or None, 'floors': {}}
+            if row.get('home_id'):
+                home['id'] = row['home_id']
+        if not row.get('floor_number'):
+            continue
+        floor = home['floors'].setdefault(row['floor_number'], {
+            'floor_number': row['floor_number'], 'name': row.get('floor_name') or None, 'rooms': {}
+        })
+        if not row.get('room_name'):
+            continue
+        room = floor['rooms'].setdefault(row['room_name'], {
+            'name': row['room_name'], 'room_type': row.get('room_type') or None, 'devices': []
+        })
+        if row.get('device_id'):
+            room['devices'].append({
+                'device_id': row['device_id'], 'name': row.get('device_name') or None,
+                'type': row.get('device_type') or None,
+                'is_active': parse_bool(row['is_active']) if row.get('is_active') else None,
+            })
+    for home in homes.values():
+        home['floors'] = list(home['floors'].values())
+        for floor in home['floors']:
+            floor['rooms'] = list(floor['rooms'].values())
+    return list(homes.values())
+
+
+def _chunks(values):
+    values = list(values)
+    for start in range(0, len(values), LOOKUP_CHUNK):
+        yield values[start:start + LOOKUP_CHUNK]
+
+
+def _listed(item, key):
+    """Return the list `item[key]`, or () if it is missing or not a list (reported by apply)."""
+    value = item.get(key)
+    return value if isinstance(value, list) else ()
+
+
+def _is_user_id(owner):
+    """Return True if an owner is given as a user id rather than a username."""
+    return isinstance(owner, int) or (isinstance(owner, str) and owner.isdigit())
+
+
+class Importer:
+    """Validates an inventory against the stored rows and applies it to a session."""
+
+    def __init__(self, session, owner=None):
+        self.session = session
+        self.default_owner = owner
+        self.errors = []
+        self.summary = {level: {'created': 0, 'updated': 0, 'unchanged': 0}
+                        for level in ('homes', 'floors', 'rooms', 'devices')}
+
+    def error(self, path, message):
+        self.errors.append(f'{path}: {message}')
+
+    def check(self, path, model, item, fields, required):
+        """Validate `item`'s values for `fields` of `model`; return {column: value} of those given."""
+        if not isinstance(item, dict):
+            self.error(path, 'expected an object')
+            return None
+        values = {}
+        for field, column_name in fields.items():
+            value = item.get(field)
+            if value is None or value == '':
+                if column_name in required:
+                    self.error(path, f'{field} is required')
+                continue
+            column = model.__table__.columns[column_name]
+            if column.type.python_type is bool:
+                value = parse_bool(value)
+            elif column.type.python_type is str:
+                value = str(value)
+                if column.type.length and len(value) > column.type.length:
+                    self.error(path, f'{field} is longer than {column.type.length} characters')
+            values[column_name] = value
+        return values
+
+    def load(self, homes):
+        """Read the stored rows the inventory can refer to."""
+        session = self.session
+        owners = [home.get('owner', home.get('owner_id')) for home in homes if isinstance(home, dict)]
+        owners.append(self.default_owner)
+        # Other values are reported by owner_id()
+        owners = {owner for owner in owners if isinstance(owner, (str, int))}
+        usernames = {owner for owner in owners if isinstance(owner, str)}
+        self.users = dict(session.execute(
+            select(User.username, User.id).where(User.username.in_(usernames))
+        ).all()) if usernames else {}
+        owner_ids = {int(owner) for owner in owners if _is_user_id(owner)}
+        self.user_ids = set()
+        for chunk in _chunks(owner_ids):
+            self.user_ids.update(session.scalars(select(User.id).where(User.id.in_(chunk))))
+
+        home_ids, names = set(), set()
+        for home in homes:
+            if isinstance(home, dict):
+                if home.get('id') is not None:
+                    try:
+                        home_ids.add(int(home['id']))
+                    except (TypeError, ValueError):
+                        pass
+                elif home.get('name'):
+                    names.add(str(home['name']))
+        stored = []
+        for chunk in _chunks(home_ids):
+            stored.extend(session.scalars(select(Home).where(Home.id.in_(chunk))))
+        for chunk in _chunks(names):
+            stored.extend(session.scalars(select(Home).where(Home.name.in_(chunk))))
+        self.homes_by_id = {home.id: home for home in stored}
+        self.homes_by_name = {(home.owner_id, home.name): home for home in stored}
+
+        self.floors = {}
+        for chunk in _chunks(self.homes_by_id):
+            for floor in session.scalars(select(Floor).where(Floor.home_id.in_(chunk))):
+                self.floors[(floor.home_id, floor.floor_number)] = floor
+        floor_ids = [floor.id for floor in self.floors.values()]
+        self.rooms = {}
+        for chunk in _chunks(floor_ids):
+            for room in session.scalars(select(Room).where(Room.floor_id.in_(chunk)).order_by(Room.id)):
+                self.rooms.setdefault((room.floor_id, room.name), room)
+
+        device_ids = {
+            str(device['device_id'])
+            for home in homes if isinstance(home, dict)
+            for floor in _listed(home, 'floors') if isinstance(floor, dict)
+            for room in _listed(floor, 'rooms') if isinstance(room, dict)
+            for device in _listed(room, 'devices') if isinstance(device, dict) and device.get('device_id')
+        }
+        self.devices = {}
+        for chunk in _chunks(device_ids):
+            rows = session.execute(
+                select(Device, Floor.home_id)
+                .join(Room, Device.room_id == Room.id).join(Floor, Room.floor_id == Floor.id)
+                .where(Device.device_id.in_(chunk))
+            )
+            for device, home_id in rows:
+                self.devices[device.device_id] = (device, home_id)
+
+    def owner_id(self, path, home):
+        owner = home.get('owner', home.get('owner_id'))
+        if owner is None:
+            owner = self.default_owner
+        if owner is None:
+            self.error(path, 'owner is required')
+            return None
+        if not isinstance(owner, (str, int)) or isinstance(owner, bool):
+            self.error(path, 'owner must be a username or user id')
+            return None
+        if _is_user_id(owner):
+            if int(owner) not in self.user_ids:
+                self.error(path, f'unknown owner {owner}')
+                return None
+            return int(owner)
+        owner_id = self.users.get(owner)
+        if owner_id is None:
+            self.error(path, f'unknown owner {owner}')
+        return owner_id
+
+    def children(self, path, item, key):
+        """Return the list `item[key]` (empty if missing), reporting any other value."""
+        value = item.get(key)
+        if value is None:
+            return ()
+        if not isinstance(value, list):
+            self.error(path, f'{key} must be a list')
+            return ()
+        return value
+
+    def update(self, level, instance, values):
+        changed = {column: value for column, value in values.items() if getattr(instance, column) != value}
+        for column, value in changed.items():
+            setattr(instance, column, value)
+        self.summary[level]['updated' if changed else 'unchanged'] += 1
+
+    def apply(self, homes):
+        """Validate `homes` and add their changes to the session; raise InventoryError on any problem."""
+        self.load(homes)
+        session = self.session
+        seen_homes, seen_devices = set(), {}
+        new_aliases, taken = [], set()
+        with session.no_autoflush:
+            for h, item in enumerate(homes):
+                path = f'homes[{h}]'
+                values = self.check(path, Home, item, HOME_FIELDS, ())
+                if values is None:
+                    continue
+                home = None
+                if item.get('id') is not None:
+                    try:
+                        home = self.homes_by_id.get(int(item['id']))
+                    except (TypeError, ValueError):
+                        pass
+                    if home is None:
+                        self.error(path, f"home {item['id']} not found")
+                        continue
+                    if 'owner' in item or 'owner_id' in item:
+                        owner_id = self.owner_id(path, item)
+                        if owner_id is not None:
+                            values['owner_id'] = owner_id
+                else:
+                    owner_id = self.owner_id(path, item)
+                    if not values.get('name'):
+                        self.error(path, 'name is required')
+                        continue
+                    home = self.homes_by_name.get((owner_id, values['name']))
+                    if home is None:
+                        if not values.get('address'):
+                            self.error(path, 'address is required')
+                        home = Home(owner_id=owner_id, **values)
+                        session.add(home)
+                        self.homes_by_name[(owner_id, values['name'])] = home
+                        self.summary['homes']['created'] += 1
+                        values = None
+                if values is not None:
+                    if id(home) in seen_homes:
+                        self.error(path, 'home is listed twice')
+                        continue
+                    self.update('homes', home, values)
+                seen_homes.add(id(home))
+                home_id = home.id
+
+                seen_floors = set()
+                for f, floor_item in enumerate(self.children(path, item, 'floors')):
+                    floor_path = f'{path}.floors[{f}]'
+                    values = self.check(floor_path, Floor, floor_item, FLOOR_FIELDS, ())
+                    if values is None:
+                        continue
+                    try:
+                        floor_number = int(floor_item.get('floor_number'))
+                    except (TypeError, ValueError):
+                        self.error(floor_path, 'floor_number must be an integer')
+                        continue
+                    if floor_number in seen_floors:
+                        self.error(floor_path, f'floor {floor_number} is listed twice (unique_floor_in_home)')
+                        continue
+                    seen_floors.add(floor_number)
+                    floor = self.floors.get((home_id, floor_number)) if home_id is not None else None
+                    if floor is None:
+                        floor = Floor(floor_number=floor_number, **values)
+                        # Existing parents are set by id: assigning the
+                        # relationship would load their child collections
+                        if home_id is not None:
+                            floor.home_id = home_id
+                        else:
+                            floor.home = home
+                        session.add(floor)
+                        self.summary['floors']['created'] += 1
+                    else:
+                        self.update('floors', floor, values)
+                    floor_id = floor.id
+
+                    seen_rooms = set()
+                    for r, room_item in enumerate(self.children(floor_path, floor_item, 'rooms')):
+                        room_path = f'{floor_path}.rooms[{r}]'
+                        values = self.check(room_path, Room, room_item, {'name': 'name', **ROOM_FIELDS}, ('name',))
+                        if not values or 'name' not in values:
+                            continue
+                        if values['name'] in seen_rooms:
+                            self.error(room_path, f"room {values['name']} is listed twice")
+                            continue
+                        seen_rooms.add(values['name'])
+                        room = self.rooms.get((floor_id, values['name'])) if floor_id is not None else None
+                        if room is None:
+                            if not values.get('room_type'):
+                                self.error(room_path, 'room_type is required')
+                            room = Room(**values)
+                            if floor_id is not None:
+                                room.floor_id = floor_id
+                            else:
+                                room.floor = floor
+                            session.add(room)
+                            self.summary['rooms']['created'] += 1
+                        else:
+                            self.update('rooms', room, values)
+
+                        for d, device_item in enumerate(self.children(room_path, room_item, 'devices')):
+                            device_path = f'{room_path}.devices[{d}]'
+                            values = self.check(device_path, Device, device_item,
+                                                {'device_id': 'device_id', **DEVICE_FIELDS}, ('device_id',))
+                            if not values or 'device_id' not in values:
+                                continue
+                            device_id = values.pop('device_id')
+                            if device_id in seen_devices:
+                                self.error(device_path, f'device {device_id} is already listed at {seen_devices[device_id]}')
+                                continue
+                            seen_devices[device_id] = device_path
+                            stored = self.devices.get(device_id)
+                            if stored is None:
+                                for field in ('name', 'type'):
+                                    if not values.get(field):
+                                        self.error(device_path, f'{field} is required')
+                                device = Device(device_id=device_id, status='offline', **values)
+                                if room.id is not None:
+                                    device.room_id = room.id
+                                else:
+                                    device.room = room
+                                session.add(device)
+                                self.summary['devices']['created'] += 1
+                                for alias in device_aliases.legacy_aliases(device_id, values.get('type'), room.name,
+                                                                           floor_number):
+                                    new_aliases.append((alias, device_id))
+                                taken.add(device_id)
+                                continue
+                            device, device_home_id = stored
+                            if device_home_id != home_id:
+                                self.error(device_path, f'device {device_id} belongs to home {device_home_id}')
+                                continue
+                            if room.id is None:
+                                device.room = room
+                            elif device.room_id != room.id:
+                                device.room_id = room.id
+                            self.update('devices', device, values)
+            if not self.errors:
+                # Register the ids older dashboards would use, as POST /api/devices does
+                for alias, device_id in new_aliases:
+                    if alias not in taken and not device_aliases.index.known(session, alias):
+                        taken.add(alias)
+                        session.add(DeviceAlias(alias=alias, device_id=device_id))
+        if self.errors:
+            raise InventoryError(self.errors)
+        return self.summary
+
+
+def import_homes(homes, session=None, owner=None, dry_run=False):
+    """Validate and upsert an inventory in one transaction; return created/updated/unchanged counts.
+
+    `owner` (a username or user id) owns the homes that do not name one.
+    With `dry_run` the changes are validated and counted but not written.
+    """
+    session = session or db.session
+    importer = Importer(session, owner)
+    try:
+        summary = importer.apply(homes)
+        if dry_run:
+            session.rollback()
+        else:
+            session.commit()
+    except Exception:
+        session.rollback()
+        raise
+    if not dry_run:
+        logger.info(f"Imported inventory: {summary}")
+    return summary
+
+
+def export_rows(session=None, home_ids=None, batch_size=1000):
+    """Yield one (home, owner, floor, room, device) row per device; missing levels are None.
+
+    Homes, floors and rooms without devices are yielded with None below them.
+    """
+    session = session or db.session
+    statement = (
+        select(Home.id, Home.name, Home.address, User.username,
+               Floor.floor_number, Floor.name,
+               Room.name, Room.room_type,
+               Device.device_id, Device.name, Device.type, Device.is_active)
+        .join(User, Home.owner_id == User.id, isouter=True)
+        .join(Floor, Floor.home_id == Home.id, isouter=True)
+        .join(Room, Room.floor_id == Floor.id, isouter=True)
+        .join(Device, Device.room_id == Room.id, isouter=True)
+        .order_by(Home.id, Floor.floor_number, Room.id, Device.id)
+        .execution_options(yield_per=batch_size)
+    )
+    if home_ids:
+        statement = statement.where(Home.id.in_(home_ids))
+    yield from session.execute(statement)
+
+
+def export_homes(session=None, home_ids=None):
+    """Yield the nested inventory of each home in turn."""
+    home = floor = room = None
+    for (home_id, home_name, address, owner, floor_number, floor_name, room_name, room_type,
+         device_id, device_name, device_type, is_active) in export_rows(session, home_ids):
+        if home is None or home['id'] != home_id:
+            if home is not None:
+                yield home
+            home = {'id': home_id, 'name': home_name, 'address': address, 'owner': owner, 'floors': []}
+            floor = room = None
+        if floor_number is None:
+            continue
+        if floor is None or floor['floor_number'] != floor_number:
+            floor = {'floor_number': floor_number, 'name': floor_name, 'rooms': []}
+            home['floors'].append(floor)
+            room = None
+        if room_name is None:
+            continue
+        if room is None or room['name'] != room_name:
+            room = {'name': room_name, 'room_type': room_type, 'devices': []}
+            floor['rooms'].append(room)
+        if device_id is not None:
+            room['devices'].append({'device_id': device_id, 'name': device_name, 'type': device_type,
+                                    'is_active': is_active})
+    if home is not None:
+        yield home
+
+
+def export_json(session=None, home_ids=None):
+    """Yield an inventory as chunks of JSON text, one home at a time."""
+    yield '{"homes": ['
+    for i, home in enumerate(export_homes(session, home_ids)):
+        yield (',\n' if i else '\n') + json.dumps(home)
+    yield '\n]}\n'
+
+
+class _Line:
+    """File-like object that hands back what csv.writer writes."""
+
+    def write(self, value):
+        return value
+
+
+def export_csv(session=None, home_ids=None):
+    """Yield an inventory as CSV lines, one row per device."""
+    writer = csv.writer(_Line())
+    yield writer.writerow(CSV_FIELDS)
+    for row in export_rows(session, home_ids):
+        row = list(row)
+        if row[-1] is not None:
+            row[-1] = 'true' if row[-1] else 'false'
+        yield writer.writerow(['' if value is None else value for value in row])
@@ -0,0 +1,341 @@
+"""Device liveness: devices that go silent are marked offline.
+
+A device is alive while it sends readings (or acknowledges commands, which
+updates Device.last_seen). Each device has a deadline, its last heartbeat
+plus the offline timeout of its type (DEVICE_OFFLINE_TIMEOUT, overridden per
+type by DEVICE_OFFLINE_TIMEOUTS, e.g. "switch=3600,motion_sensor=900").
+
+Deadlines are kept in a hashed timer wheel: one slot per tick (LIVENESS_TICK
+seconds), a timer goes into the slot of its deadline tick, and each tick only
+looks at the timers of one slot. A heartbeat just records the time; a timer
+that comes due for a device heard from since is moved to its new deadline,
+so every device has a single timer and heartbeats cost a dict update.
+
+Status changes are applied in batches by a background thread once per tick:
+expired devices become 'offline' and offline devices that send a heartbeat
+become 'online', through the ORM so the device counters stay right. Before
+marking a device offline, its last_seen is re-read: heartbeats are written
+back to last_seen (at most every half timeout per device), so a device that
+another worker process heard from is not marked offline.
+"""
+import time
+import logging
+import threading
+from datetime import datetime
+
+from sqlalchemy import event, inspect, select, update
+from sqlalchemy.orm import Session
+
+from models import db, Device, SensorData
+
+# Get logger
+logger = logging.getLogger('smart_home.liveness')
+
+_EPOCH = datetime(1970, 1, 1)
+_CHANGES_KEY = 'liveness_changes'
+
+
+def epoch_seconds(timestamp):
+    return (timestamp - _EPOCH).total_seconds()
+
+
+def parse_timeouts(value):
+    """Parse "type=seconds,..." into {type: seconds}."""
+    timeouts = {}
+    for item in (value or '').split(','):
+        if item.strip():
+            device_type, _, seconds = item.partition('=')
+            timeouts[device_type.strip()] = float(seconds)
+    return timeouts
+
+
+class TimerWheel:
+    """Hashed timer wheel of keys and their deadlines (in seconds)."""
+
+    def __init__(self, slots=512, tick=1.0, now=0.0):
+        self.tick = tick
+        self.current = int(now // tick)
+        self._slots = [{} for _ in range(slots)]
+        self._ticks = {}
+
+    def __len__(self):
+        return len(self._ticks)
+
+    def schedule(self, key, deadline):
+        """Set the deadline of `key`, replacing its previous one."""
+        tick = max(int(deadline // self.tick), self.current + 1)
+        previous = self._ticks.get(key)
+        if previous is not None:
+            self._slots[previous % len(self._slots)].pop(key, None)
+        self._ticks[key] = tick
+        self._slots[tick % len(self._slots)][key] = tick
+
+    def cancel(self, key):
+        tick = self._ticks.pop(key, None)
+        if tick is not None:
+            self._slots[tick % len(self._slots)].pop(key, None)
+
+    def advance(self, now):
+        """Move the wheel to `now`; return the keys whose deadline has passed."""
+        target = int(now // self.tick)
+        if target <= self.current:
+            return []
+        if target - self.current >= len(self._slots):
+            slots = self._slots
+        else:
+            slots = [self._slots[tick % len(self._slots)] for tick in range(self.current + 1, target + 1)]
+        self.current = target
+        expired = []
+        for slot in slots:
+            # Timers more than one turn ahead stay in the slot
+            due = [key for key, tick in slot.items() if tick <= target]
+            for key in due:
+                del slot[key]
+                del self._ticks[key]
+            expired.extend(due)
+        return expired
+
+
+class LivenessTracker:
+    """Tracks device heartbeats and collects status changes to apply."""
+
+    def __init__(self, default_timeout=300.0, timeouts=None, slots=512, tick=1.0, now=None):
+        self.enabled = False
+        self.default_timeout = default_timeout
+        self.timeouts = timeouts or {}
+        self.batch_size = 500
+        self._wheel = TimerWheel(slots, tick, time.time() if now is None else now)
+        # device id -> [timeout, status, last heartbeat, last_seen written]
+        self._devices = {}
+        self._went_offline = set()
+        self._came_online = set()
+        self._touched = set()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._devices)
+
+    def configure(self, default_timeout, timeouts, slots=512, tick=1.0):
+        self.default_timeout = default_timeout
+        self.timeouts = timeouts
+        self._wheel = TimerWheel(slots, tick, time.time())
+
+    def timeout(self, device_type):
+        return self.timeouts.get(device_type, self.default_timeout)
+
+    def track(self, device_id, device_type, status, last_seen, now=None):
+        """Start (or restart) tracking a device last seen at `last_seen` (epoch seconds or None)."""
+        now = time.time() if now is None else now
+        timeout = self.timeout(device_type)
+        # Without a last_seen, a device gets a full timeout to report
+        seen = last_seen if last_seen is not None else now
+        with self._lock:
+            self._devices[device_id] = [timeout, status, seen, seen]
+            if status == 'offline':
+                self._wheel.cancel(device_id)
+            else:
+                self._wheel.schedule(device_id, seen + timeout)
+
+    def forget(self, device_id):
+        with self._lock:
+            self._devices.pop(device_id, None)
+            self._wheel.cancel(device_id)
+
+    def set_status(self, device_id, status):
+        """Record a status written by someone else (e.g. a command acknowledgement)."""
+        with self._lock:
+            entry = self._devices.get(device_id)
+            if entry is not None:
+                entry[1] = status
+                if status != 'offline':
+                    self._went_offline.discard(device_id)
+                    self._wheel.schedule(device_id, entry[2] + entry[0])
+
+    def heartbeats(self, beats, now=None):
+        """Record (device id, epoch seconds) heartbeats."""
+        now = time.time() if now is None else now
+        with self._lock:
+            devices = self._devices
+            for device_id, at in beats:
+                entry = devices.get(device_id)
+                if entry is None:
+                    continue
+                if at > now:
+                    at = now
+                if at <= entry[2]:
+                    continue
+                entry[2] = at
+                if entry[1] == 'offline':
+                    self._came_online.add(device_id)
+                    self._wheel.schedule(device_id, at + entry[0])
+                elif at - entry[3] >= entry[0] / 2:
+                    self._touched.add(device_id)
+
+    def expire(self, now=None):
+        """Advance the wheel; devices past their deadline are queued to go offline."""
+        now = time.time() if now is None else now
+        with self._lock:
+            for device_id in self._wheel.advance(now):
+                entry = self._devices.get(device_id)
+                if entry is None:
+                    continue
+                deadline = entry[2] + entry[0]
+                if deadline > now:
+                    self._wheel.schedule(device_id, deadline)
+                elif entry[1] != 'offline':
+                    self._went_offline.add(device_id)
+
+    def _take(self):
+        with self._lock:
+            went_offline, self._went_offline = self._went_offline, set()
+            came_online, self._came_online = self._came_online, set()
+            touched, self._touched = self._touched, set()
+            return went_offline, came_online, touched - came_online
+
+    def _chunks(self, device_ids):
+        device_ids = sorted(device_ids)
+        for start in range(0, len(device_ids), self.batch_size):
+            yield device_ids[start:start + self.batch_size]
+
+    def apply(self, session, now=None):
+        """Write the queued status changes and last_seen updates; return (offline, online) counts."""
+        now = time.time() if now is None else now
+        went_offline, came_online, touched = self._take()
+        offline = online = 0
+        for chunk in self._chunks(went_offline):
+            for device in session.scalars(select(Device).where(Device.device_id.in_(chunk))):
+                entry = self._devices.get(device.device_id)
+                if entry is None or device.status == 'offline':
+                    continue
+                seen = max(entry[2], epoch_seconds(device.last_seen) if device.last_seen else 0.0)
+                if seen + entry[0] > now:
+                    # Heard from since it expired, here or by another process
+                    with self._lock:
+                        entry[2] = max(entry[2], seen)
+                        entry[3] = max(entry[3], seen)
+                        self._wheel.schedule(device.device_id, entry[2] + entry[0])
+                    continue
+                device.status = 'offline'
+                offline += 1
+            session.commit()
+        for chunk in self._chunks(came_online):
+            for device in session.scalars(select(Device).where(Device.device_id.in_(chunk))):
+                entry = self._devices.get(device.device_id)
+                if entry is None:
+                    continue
+                device.last_seen = datetime.utcfromtimestamp(entry[2])
+                entry[3] = entry[2]
+                if device.status == 'offline':
+                    device.status = 'online'
+                    online += 1
+            session.commit()
+        if touched:
+            seen_at = datetime.utcfromtimestamp(now)
+            for chunk in self._chunks(touched):
+                session.execute(
+                    update(Device).where(Device.device_id.in_(chunk)).values(last_seen=seen_at)
+                    .execution_options(synchronize_session=False)
+                )
+                with self._lock:
+                    for device_id in chunk:
+                        entry = self._devices.get(device_id)
+                        if entry is not None:
+                            entry[3] = now
+            session.commit()
+        if offline or online:
+            logger.info(f"{offline} device(s) went offline, {online} came back online")
+        return offline, online
+
+    def load(self, session, now=None):
+        """Track every device, from its stored status and last_seen."""
+        now = time.time() if now is None else now
+        rows = session.execute(select(Device.device_id, Device.type, Device.status, Device.last_seen)).all()
+        for device_id, device_type, status, last_seen in rows:
+            self.track(device_id, device_type, status, epoch_seconds(last_seen) if last_seen else None, now)
+        logger.info(f"Tracking liveness of {len(rows)} device(s)")
+
+    def run(self, app, tick):
+        loaded = False
+        while True:
+            try:
+                with app.app_context():
+                    if not loaded:
+                        self.load(db.session)
+                        db.session.commit()
+                        loaded = True
+                    else:
+                        self.expire()
+                        self.apply(db.session)
+            except Exception:
+                logger.exception('Liveness update failed')
+            time.sleep(tick)
+
+
+tracker = LivenessTracker()
+
+
+@event.listens_for(Session, 'after_flush')
+def _collect_heartbeats(session, flush_context):
+    if not tracker.enabled:
+        return
+    changes = []
+    for instance in session.new:
+        if isinstance(instance, SensorData) and instance.timestamp is not None:
+            changes.append(('beat', instance.device_id, instance.timestamp))
+        elif isinstance(instance, Device):
+            changes.append(('track', instance.device_id, (instance.type, instance.status, instance.last_seen)))
+    for instance in session.dirty:
+        if isinstance(instance, Device):
+            state = inspect(instance)
+            if state.attrs.type.history.has_changes():
+                changes.append(('track', instance.device_id, (instance.type, instance.status, instance.last_seen)))
+                continue
+            if state.attrs.status.history.has_changes():
+                changes.append(('status', instance.device_id, instance.status))
+            if state.attrs.last_seen.history.has_changes() and instance.last_seen is not None:
+                changes.append(('beat', instance.device_id, instance.last_seen))
+    for instance in session.deleted:
+        if isinstance(instance, Device):
+            changes.append(('forget', instance.device_id, None))
+    if changes:
+        session.info.setdefault(_CHANGES_KEY, []).extend(changes)
+
+
+@event.listens_for(Session, 'after_commit')
+def _apply_heartbeats(session):
+    changes = session.info.pop(_CHANGES_KEY, None)
+    if not changes:
+        return
+    beats = []
+    for change, device_id, value in changes:
+        if change == 'beat':
+            beats.append((device_id, epoch_seconds(value)))
+        elif change == 'status':
+            tracker.set_status(device_id, value)
+        elif change == 'track':
+            device_type, status, last_seen = value
+            tracker.track(device_id, device_type, status, epoch_seconds(last_seen) if last_seen else None)
+        else:
+            tracker.forget(device_id)
+    if beats:
+        tracker.heartbeats(beats)
+
+
+@event.listens_for(Session, 'after_rollback')
+def _discard_heartbeats(session):
+    session.info.pop(_CHANGES_KEY, None)
+
+
+def init_app(app):
+    """Mark devices offline when they go silent, and online when they report again."""
+    tracker.enabled = app.config.get('LIVENESS_ENABLED', True)
+    if not tracker.enabled:
+        return
+    tick = app.config.get('LIVENESS_TICK', 1.0)
+    tracker.configure(
+        app.config.get('DEVICE_OFFLINE_TIMEOUT', 300),
+        parse_timeouts(app.config.get('DEVICE_OFFLINE_TIMEOUTS')),
+        slots=app.config.get('LIVENESS_WHEEL_SLOTS', 512),
+        tick=tick
+    )
+    threading.Thread(target=tracker.run, args=(app, tick), name='device-liveness', daemon=True).start()
@@ -0,0 +1,333 @@
+import time
+import weakref
+import itertools
+import threading
+from bisect import bisect_left
+from datetime import datetime
+from flask import request, Response
+from sqlalchemy import event, Insert
+from sqlalchemy.engine import Engine
+
+# Default latency buckets in seconds
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# Ingest lag buckets in seconds (sub-second up to a day)
+LAG_BUCKETS = (0.1, 0.5, 1.0, 5.0, 15.0, 60.0, 300.0, 900.0, 3600.0, 86400.0)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_labels(names, values, extra=None):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+class _Shard:
+    """A thread's samples; the thread-local reference to it dies with the thread."""
+    __slots__ = ('samples', '__weakref__')
+
+    def __init__(self):
+        self.samples = {}
+
+
+class _Metric:
+    """Base class for metrics whose samples are sharded per thread.
+
+    Each thread only ever writes to its own shard (held in a threading.local),
+    so recording a sample never takes a lock. When a thread exits its shard is
+    folded into a shared base, so short-lived threads don't accumulate shards.
+    The base and the live shards are summed when the metrics are scraped.
+    """
+    type_name = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._local = threading.local()
+        self._shards = {}
+        self._base = {}
+        self._lock = threading.Lock()
+        self._shard_ids = itertools.count()
+
+    def _shard(self):
+        try:
+            return self._local.shard.samples
+        except AttributeError:
+            shard = self._local.shard = _Shard()
+            shard_id = next(self._shard_ids)
+            with self._lock:
+                self._shards[shard_id] = shard.samples
+            weakref.finalize(shard, self._retire, shard_id, shard.samples)
+            return shard.samples
+
+    def _retire(self, shard_id, samples):
+        with self._lock:
+            self._shards.pop(shard_id, None)
+            self._fold(self._base, samples)
+
+    def _merged(self):
+        merged = {}
+        with self._lock:
+            self._fold(merged, self._base)
+            for samples in list(self._shards.values()):
+                self._fold(merged, samples)
+        return merged
+
+    def expose(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.type_name}']
+        lines.extend(self._samples())
+        return lines
+
+
+class Counter(_Metric):
+    type_name = 'counter'
+
+    def inc(self, *labelvalues, amount=1):
+        shard = self._shard()
+        shard[labelvalues] = shard.get(labelvalues, 0) + amount
+
+    @staticmethod
+    def _fold(into, samples):
+        for key, value in list(samples.items()):
+            into[key] = into.get(key, 0) + value
+
+    def values(self):
+        return self._merged()
+
+    def _samples(self):
+        for key, value in sorted(self.values().items()):
+            yield f'{self.name}{_format_labels(self.labelnames, key)} {value}'
+
+
+class Histogram(_Metric):
+    type_name = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, *labelvalues):
+        shard = self._shard()
+        slots = shard.get(labelvalues)
+        if slots is None:
+            # One slot per bucket, one for +Inf, then sum and count
+            slots = shard[labelvalues] = [0] * (len(self.buckets) + 3)
+        slots[bisect_left(self.buckets, value)] += 1
+        slots[-2] += value
+        slots[-1] += 1
+
+    @staticmethod
+    def _fold(into, samples):
+        for key, slots in list(samples.items()):
+            total = into.setdefault(key, [0] * len(slots))
+            for i, value in enumerate(list(slots)):
+                total[i] += value
+
+    def _samples(self):
+        for key, slots in sorted(self._merged().items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), slots):
+                cumulative += count
+                labels = _format_labels(self.labelnames, key, f'le="{bound}"')
+                yield f'{self.name}_bucket{labels} {cumulative}'
+            labels = _format_labels(self.labelnames, key)
+            yield f'{self.name}_sum{labels} {slots[-2]}'
+            yield f'{self.name}_count{labels} {slots[-1]}'
+
+
+class Gauge(_Metric):
+    """Gauge whose samples are computed by a callback at scrape time."""
+    type_name = 'gauge'
+
+    def __init__(self, name, documentation, labelnames=(), callback=None):
+        super().__init__(name, documentation, labelnames)
+        self.callback = callback
+
+    def _samples(self):
+        for key, value in sorted((self.callback() if self.callback else {}).items()):
+            yield f'{self.name}{_format_labels(self.labelnames, key)} {value}'
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def expose(self):
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.expose())
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+# HTTP
+http_requests = registry.register(Counter(
+    'http_requests_total', 'HTTP requests by endpoint, method and status code.',
+    ('endpoint', 'method', 'status')))
+http_latency = registry.register(Histogram(
+    'http_request_duration_seconds', 'HTTP request latency by endpoint and method.',
+    ('endpoint', 'method')))
+
+# Database
+db_statement_latency = registry.register(Histogram(
+    'db_statement_duration_seconds', 'Duration of SQL statements.'))
+db_pool_checkouts = registry.register(Counter(
+    'db_pool_checkouts_total', 'Connections checked out of the pool.', ('engine',)))
+db_pool_wait = registry.register(Histogram(
+    'db_pool_wait_seconds', 'Time spent waiting to check a connection out of the pool.', ('engine',)))
+db_pool_checkout_duration = registry.register(Histogram(
+    'db_pool_checkout_duration_seconds', 'Time a connection stays checked out.', ('engine',)))
+db_replica_lag = registry.register(Gauge(
+    'db_replica_lag_seconds', 'Time since the newest heartbeat visible on the read replica.'))
+db_routed_requests = registry.register(Counter(
+    'db_routed_requests_total', 'Requests by the database their reads used, and why.', ('target', 'reason')))
+
+# Ingest
+sensor_rows_inserted = registry.register(Counter(
+    'sensor_data_rows_inserted_total', 'Rows inserted into sensor_data.'))
+ingest_lag = registry.register(Histogram(
+    'ingest_lag_seconds', 'Delay between a reading being taken and being stored.',
+    buckets=LAG_BUCKETS))
+
+# Device commands
+device_commands = registry.register(Counter(
+    'device_commands_total', 'Device commands by action and result.', ('action', 'result')))
+device_command_retries = registry.register(Counter(
+    'device_command_retries_total', 'Device commands published again after an acknowledgement timeout.',
+    ('action',)))
+device_command_latency = registry.register(Histogram(
+    'device_command_round_trip_seconds', 'Time from first publishing a command to its final result.',
+    ('action', 'result'), buckets=(0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)))
+device_commands_in_flight = registry.register(Gauge(
+    'device_commands_in_flight', 'Device commands waiting for an acknowledgement.'))
+
+# Alerts
+alerts_fired = registry.register(Counter(
+    'alerts_fired_total', 'Alerts raised by alert rules, by rule kind.', ('kind',)))
+alerts_dropped = registry.register(Counter(
+    'alerts_dropped_total', 'Alerts dropped because the delivery queue was full.'))
+
+# Automation
+automation_commands = registry.register(Counter(
+    'automation_commands_total', 'Commands sent by automation rules, by result.', ('result',)))
+automation_latency = registry.register(Histogram(
+    'automation_reading_to_command_seconds',
+    'Time from committing a triggering reading to publishing the command.'))
+
+# Caches
+cache_requests = registry.register(Counter(
+    'cache_requests_total', 'Cache lookups by cache and result (hit or miss).', ('cache', 'result')))
+
+
+def _cache_hit_ratios():
+    totals = {}
+    for (cache, result), value in cache_requests.values().items():
+        hits, lookups = totals.get(cache, (0, 0))
+        totals[cache] = (hits + (value if result == 'hit' else 0), lookups + value)
+    return {(cache,): hits / lookups for cache, (hits, lookups) in totals.items() if lookups}
+
+
+registry.register(Gauge(
+    'cache_hit_ratio', 'Fraction of cache lookups that were hits.', ('cache',),
+    callback=_cache_hit_ratios))
+
+
+def record_cache(cache, hit):
+    """Record a lookup in a named cache."""
+    cache_requests.inc(cache, 'hit' if hit else 'miss')
+
+
+def record_ingest(timestamp):
+    """Record the ingest lag of a reading taken at `timestamp` (naive UTC)."""
+    if timestamp is not None:
+        ingest_lag.observe(max((datetime.utcnow() - timestamp).total_seconds(), 0.0))
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _start_statement(conn, cursor, statement, parameters, context, executemany):
+    # Kept on the execution context, so a failed statement leaves nothing behind
+    if context is not None:
+        context._metrics_start = time.perf_counter()
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _time_statement(conn, cursor, statement, parameters, context, executemany):
+    started = getattr(context, '_metrics_start', None)
+    if started is not None:
+        db_statement_latency.observe(time.perf_counter() - started)
+
+
+@event.listens_for(Engine, 'after_execute')
+def _count_sensor_rows(conn, clauseelement, multiparams, params, execution_options, result):
+    # Counted per execute() call: cursor rowcounts are unreliable for batched
+    # inserts, but both ORM flushes and Core executemany pass every row here
+    if isinstance(clauseelement, Insert) and clauseelement.table.name == 'sensor_data':
+        sensor_rows_inserted.inc(amount=len(multiparams) or 1)
+
+
+def instrument_engine(engine, name='default'):
+    """Record checkout counts, wait times and hold times for an engine's pool."""
+    pool = engine.pool
+    connect = pool.connect
+
+    def timed_connect():
+        start = time.perf_counter()
+        connection = connect()
+        db_pool_wait.observe(time.perf_counter() - start, name)
+        return connection
+
+    pool.connect = timed_connect
+
+    @event.listens_for(engine, 'checkout')
+    def on_checkout(dbapi_connection, connection_record, connection_proxy):
+        db_pool_checkouts.inc(name)
+        connection_record.info['metrics_checkout_time'] = time.perf_counter()
+
+    @event.listens_for(engine, 'checkin')
+    def on_checkin(dbapi_connection, connection_record):
+        started = connection_record.info.pop('metrics_checkout_time', None)
+        if started is not None:
+            db_pool_checkout_duration.observe(time.perf_counter() - started, name)
+
+
+def init_app(app, db):
+    """Record HTTP, DB and ingest metrics and expose them on /metrics."""
+    if not app.config.get('METRICS_ENABLED', True):
+        return
+
+    with app.app_context():
+        for bind, engine in db.engines.items():
+            instrument_engine(engine, bind or 'default')
+
+    from models import SensorData
+
+    @event.listens_for(SensorData, 'after_insert')
+    def on_sensor_data_insert(mapper, connection, target):
+        record_ingest(target.timestamp)
+
+    @app.before_request
+    def start_request_timer():
+        request.environ['smart_home.metrics_start'] = time.perf_counter()
+
+    @app.after_request
+    def record_request(response):
+        started = request.environ.get('smart_home.metrics_start')
+        if started is not None:
+            endpoint = request.endpoint or 'unmatched'
+            http_latency.observe(time.perf_counter() - started, endpoint, request.method)
+            http_requests.inc(endpoint, request.method, str(response.status_code))
+        return response
+
+    @app.route('/metrics')
+    def metrics_endpoint():
+        """Expose metrics in the Prometheus text exposition format."""
+        return Response(registry.expose(), mimetype='text/plain; version=0.0.4')
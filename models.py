@@ -1,9 +1,15 @@
 from flask_sqlalchemy import SQLAlchemy
-from datetime import datetime
+from datetime import datetime, timedelta
+from sqlalchemy import event, inspect, select, update, func, case
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+from sketches import DDSketch, RunningStats
 from werkzeug.security import generate_password_hash, check_password_hash
 from flask_login import UserMixin
+import sharding
+from sharding import ShardedSession
 
-db = SQLAlchemy()
+db = SQLAlchemy(session_options={'class_': ShardedSession})
 
 # User Authentication and Authorization
 class User(UserMixin, db.Model):
@@ -87,8 +93,21 @@ class UserRoleMapping(db.Model):
         return f'<UserRoleMapping User:{self.user_id} Role:{self.role_id}>'
 
 
+# Denormalized device counters kept on Home, Floor and Room
+COUNTER_FIELDS = ('device_count', 'online_count', 'active_count')
+
+
+class DeviceCounterMixin:
+    device_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    online_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    active_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    
+    def counters_to_dict(self):
+        return {field: getattr(self, field) or 0 for field in COUNTER_FIELDS}
+
+
 # Home Structure
-class Home(db.Model):
+class Home(DeviceCounterMixin, db.Model):
     __tablename__ = 'homes'
     
     id = db.Column(db.Integer, primary_key=True)
@@ -110,11 +129,12 @@ class Home(db.Model):
             'name': self.name,
             'address': self.address,
             'owner_id': self.owner_id,
-            'created_at': self.created_at.isoformat() if self.created_at else None
+            'created_at': self.created_at.isoformat() if self.created_at else None,
+            **self.counters_to_dict()
         }
 
 
-class Floor(db.Model):
+class Floor(DeviceCounterMixin, db.Model):
     __tablename__ = 'floors'
     
     id = db.Column(db.Integer, primary_key=True)
@@ -137,11 +157,12 @@ class Floor(db.Model):
             'id': self.id,
             'home_id': self.home_id,
             'floor_number': self.floor_number,
-            'name': self.name
+            'name': self.name,
+            **self.counters_to_dict()
         }
 
 
-class Room(db.Model):
+class Room(DeviceCounterMixin, db.Model):
     __tablename__ = 'rooms'
     
     id = db.Column(db.Integer, primary_key=True)
@@ -160,7 +181,8 @@ class Room(db.Model):
             'id': self.id,
             'floor_id': self.floor_id,
             'name': self.name,
-            'room_type': self.room_type
+            'room_type': self.room_type,
+            **self.counters_to_dict()
         }
 
 
@@ -186,6 +208,14 @@ class Device(db.Model):
                                   foreign_keys='UserAction.device_id',
                                   primaryjoin='Device.device_id==UserAction.device_id',
                                   cascade="all, delete-orphan")
+    sketches = db.relationship('SensorDataSketch', lazy=True,
+                               foreign_keys='SensorDataSketch.device_id',
+                               primaryjoin='Device.device_id==SensorDataSketch.device_id',
+                               cascade="all, delete-orphan")
+    aliases = db.relationship('DeviceAlias', backref='device', lazy=True,
+                              foreign_keys='DeviceAlias.device_id',
+                              primaryjoin='Device.device_id==DeviceAlias.device_id',
+                              cascade="all, delete-orphan")
     
     def __repr__(self):
         return f'<Device {self.name} ({self.device_id})>'
@@ -203,6 +233,27 @@ class Device(db.Model):
         }
 
 
+class DeviceAlias(db.Model):
+    """Alternate id of a device, e.g. one used by an older dashboard."""
+    __tablename__ = 'device_aliases'
+    
+    id = db.Column(db.Integer, primary_key=True)
+    alias = db.Column(db.String(100), unique=True, nullable=False, index=True)
+    device_id = db.Column(db.String(50), db.ForeignKey('devices.device_id'), nullable=False, index=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    def __repr__(self):
+        return f'<DeviceAlias {self.alias} -> {self.device_id}>'
+    
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'alias': self.alias,
+            'device_id': self.device_id,
+            'created_at': self.created_at.isoformat() if self.created_at else None
+        }
+
+
 class SensorData(db.Model):
     __tablename__ = 'sensor_data'
     
@@ -229,6 +280,219 @@ class SensorData(db.Model):
         }
 
 
+class SensorDataSketch(db.Model):
+    """Mergeable summary of one device's readings over one hour."""
+    __tablename__ = 'sensor_data_sketches'
+    
+    id = db.Column(db.Integer, primary_key=True)
+    device_id = db.Column(db.String(50), db.ForeignKey('devices.device_id'), nullable=False)
+    bucket_start = db.Column(db.DateTime, nullable=False)
+    count = db.Column(db.Integer, nullable=False, default=0)
+    mean = db.Column(db.Float, nullable=False, default=0.0)
+    m2 = db.Column(db.Float, nullable=False, default=0.0)
+    min_value = db.Column(db.Float)
+    max_value = db.Column(db.Float)
+    sketch = db.Column(db.Text, nullable=False)
+    
+    __table_args__ = (
+        db.UniqueConstraint('device_id', 'bucket_start', name='unique_device_sketch_bucket'),
+    )
+    
+    def __repr__(self):
+        return f'<SensorDataSketch {self.device_id} @ {self.bucket_start}: {self.count}>'
+    
+    def running_stats(self):
+        return RunningStats(self.count, self.mean, self.m2, self.min_value, self.max_value)
+    
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'device_id': self.device_id,
+            'bucket_start': self.bucket_start.isoformat(),
+            'count': self.count,
+            'mean': self.mean,
+            'min': self.min_value,
+            'max': self.max_value
+        }
+
+
+class LateDataEvent(db.Model):
+    """Readings written into a closed (past) day; invalidates cached results."""
+    __tablename__ = 'late_data_events'
+    
+    id = db.Column(db.Integer, primary_key=True)
+    # NULL means the change may affect every device (e.g. a bulk import)
+    device_id = db.Column(db.String(50))
+    earliest_timestamp = db.Column(db.DateTime, nullable=False)
+    # Events are pruned by age (see result_cache.py)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)
+    
+    def __repr__(self):
+        return f'<LateDataEvent {self.device_id or "*"} since {self.earliest_timestamp}>'
+    
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'device_id': self.device_id,
+            'earliest_timestamp': self.earliest_timestamp.isoformat(),
+            'created_at': self.created_at.isoformat() if self.created_at else None
+        }
+
+
+class AlertRule(db.Model):
+    """Condition on the readings of a device, or of every device of a type (see alerts.py)."""
+    __tablename__ = 'alert_rules'
+    
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(100), nullable=False)
+    kind = db.Column(db.String(20), nullable=False, default='threshold')  # 'threshold', 'count', 'deviation'
+    # Scope: a single device, or every device of a type (optionally in one room;
+    # deviation rules in a room then compare devices with the room's baseline)
+    device_id = db.Column(db.String(50), db.ForeignKey('devices.device_id'), index=True)
+    device_type = db.Column(db.String(50), index=True)
+    room_id = db.Column(db.Integer, db.ForeignKey('rooms.id'))
+    operator = db.Column(db.String(2), nullable=False, default='>')
+    threshold = db.Column(db.Float)
+    duration = db.Column(db.Integer, nullable=False, default=0)  # seconds the condition must hold
+    window = db.Column(db.Integer, nullable=False, default=300)  # seconds, for 'count' rules
+    min_count = db.Column(db.Integer, nullable=False, default=1)
+    sigma = db.Column(db.Float, nullable=False, default=3.0)
+    alpha = db.Column(db.Float, nullable=False, default=0.1)  # EWMA smoothing factor
+    is_active = db.Column(db.Boolean, default=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    def __repr__(self):
+        return f'<AlertRule {self.name} ({self.kind})>'
+    
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'name': self.name,
+            'kind': self.kind,
+            'device_id': self.device_id,
+            'device_type': self.device_type,
+            'room_id': self.room_id,
+            'operator': self.operator,
+            'threshold': self.threshold,
+            'duration': self.duration,
+            'window': self.window,
+            'min_count': self.min_count,
+            'sigma': self.sigma,
+            'alpha': self.alpha,
+            'is_active': self.is_active,
+            'created_at': self.created_at.isoformat() if self.created_at else None
+        }
+
+
+class AlertEvent(db.Model):
+    """Alert raised by an AlertRule for a reading."""
+    __tablename__ = 'alert_events'
+    
+    id = db.Column(db.Integer, primary_key=True)
+    rule_id = db.Column(db.Integer, db.ForeignKey('alert_rules.id'), nullable=False, index=True)
+    device_id = db.Column(db.String(50), nullable=False)
+    value = db.Column(db.Float, nullable=False)
+    message = db.Column(db.String(255))
+    # Timestamp of the reading that raised the alert
+    triggered_at = db.Column(db.DateTime, nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    def __repr__(self):
+        return f'<AlertEvent rule={self.rule_id} {self.device_id}: {self.value}>'
+    
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'rule_id': self.rule_id,
+            'device_id': self.device_id,
+            'value': self.value,
+            'message': self.message,
+            'triggered_at': self.triggered_at.isoformat(),
+            'created_at': self.created_at.isoformat() if self.created_at else None
+        }
+
+
+class AutomationRule(db.Model):
+    """'When a reading crosses a threshold, send a command to a device' (see automation.py)."""
+    __tablename__ = 'automation_rules'
+    
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(100), nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
+    # Trigger: readings of one device, or of the devices of a room (optionally of one type)
+    trigger_device_id = db.Column(db.String(50), db.ForeignKey('devices.device_id'))
+    trigger_room_id = db.Column(db.Integer, db.ForeignKey('rooms.id'))
+    trigger_type = db.Column(db.String(50))
+    operator = db.Column(db.String(2), nullable=False, default='>')
+    threshold = db.Column(db.Float, nullable=False)
+    # Command sent to the target device when the trigger fires
+    target_device_id = db.Column(db.String(50), db.ForeignKey('devices.device_id'), nullable=False)
+    action = db.Column(db.String(50), nullable=False)
+    value = db.Column(db.String(50))
+    debounce = db.Column(db.Integer, nullable=False, default=0)  # seconds the condition must hold
+    cooldown = db.Column(db.Integer, nullable=False, default=300)  # minimum seconds between commands
+    is_active = db.Column(db.Boolean, default=True)
+    last_triggered_at = db.Column(db.DateTime)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    def __repr__(self):
+        return f'<AutomationRule {self.name}>'
+    
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'name': self.name,
+            'user_id': self.user_id,
+            'trigger_device_id': self.trigger_device_id,
+            'trigger_room_id': self.trigger_room_id,
+            'trigger_type': self.trigger_type,
+            'operator': self.operator,
+            'threshold': self.threshold,
+            'target_device_id': self.target_device_id,
+            'action': self.action,
+            'value': self.value,
+            'debounce': self.debounce,
+            'cooldown': self.cooldown,
+            'is_active': self.is_active,
+            'last_triggered_at': self.last_triggered_at.isoformat() if self.last_triggered_at else None,
+            'created_at': self.created_at.isoformat() if self.created_at else None
+        }
+
+
+class ReplicationHeartbeat(db.Model):
+    """Time last written on the primary; read back from the replica to measure its lag."""
+    __tablename__ = 'replication_heartbeats'
+    
+    id = db.Column(db.Integer, primary_key=True)
+    beat_at = db.Column(db.DateTime, nullable=False)
+    
+    def __repr__(self):
+        return f'<ReplicationHeartbeat {self.beat_at}>'
+
+
+class HomeShard(db.Model):
+    """Shard of a home moved off its hashed shard (see sharding.py)."""
+    __tablename__ = 'home_shards'
+    
+    home_id = db.Column(db.Integer, db.ForeignKey('homes.id'), primary_key=True)
+    shard = db.Column(db.Integer, nullable=False)
+    moved_at = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    def __repr__(self):
+        return f'<HomeShard home={self.home_id} shard={self.shard}>'
+
+
+class ShardIdBlock(db.Model):
+    """Next unreserved row id of a sharded table."""
+    __tablename__ = 'shard_id_blocks'
+    
+    name = db.Column(db.String(50), primary_key=True)
+    next_id = db.Column(db.Integer, nullable=False)
+    
+    def __repr__(self):
+        return f'<ShardIdBlock {self.name}: {self.next_id}>'
+
+
 class UserAction(db.Model):
     __tablename__ = 'user_actions'
     
@@ -281,4 +545,394 @@ class HomeAccess(db.Model):
             'home_id': self.home_id,
             'user_id': self.user_id,
             'access_level': self.access_level
-        }
\ No newline at end of file
+        }
+
+# Device counter maintenance
+#
+# Every flush that creates, deletes, moves or changes the status of a Device
+# adjusts the counters of the affected Room, Floor and Home in the same
+# transaction. The state of each device before the flush is captured in
+# before_flush; the state after the flush is read in after_flush, once foreign
+# keys set through relationships have been synchronized.
+def _device_contribution(device):
+    """Return (room_id, device, online, active) for a device's current state."""
+    return (
+        device.room_id,
+        1,
+        1 if device.status == 'online' else 0,
+        1 if device.is_active else 0
+    )
+
+
+def _room_parents(connection, room_ids):
+    """Map room id -> (floor id, home id) for the given rooms."""
+    if not room_ids:
+        return {}
+    rows = connection.execute(
+        select(Room.id, Floor.id, Floor.home_id)
+        .join(Floor, Room.floor_id == Floor.id)
+        .where(Room.id.in_(room_ids))
+    )
+    return {room_id: (floor_id, home_id) for room_id, floor_id, home_id in rows}
+
+
+@event.listens_for(Session, 'before_flush')
+def _capture_device_counters(session, flush_context, instances):
+    device_ids = [
+        device.id for device in list(session.dirty) + list(session.deleted)
+        if isinstance(device, Device) and device.id is not None
+    ]
+    if not device_ids:
+        return
+    # Read the committed state from the database: attributes set on expired
+    # instances carry no history of their previous value
+    connection = session.connection()
+    rows = connection.execute(
+        select(Device.room_id, Device.status, Device.is_active)
+        .where(Device.id.in_(device_ids))
+    )
+    previous = [
+        (room_id, 1, 1 if status == 'online' else 0, 1 if is_active else 0)
+        for room_id, status, is_active in rows
+    ]
+    room_ids = {contribution[0] for contribution in previous if contribution[0]}
+    session.info['device_counters_previous'] = previous
+    # Parents are resolved now because the rooms may be deleted by this flush
+    session.info['device_counters_parents'] = _room_parents(connection, room_ids)
+
+
+@event.listens_for(Session, 'after_flush')
+def _apply_device_counters(session, flush_context):
+    previous = session.info.pop('device_counters_previous', [])
+    parents = session.info.pop('device_counters_parents', {})
+    
+    deltas = {}
+    
+    def add(contribution, sign):
+        room_id = contribution[0]
+        if room_id is None:
+            return
+        delta = deltas.setdefault(room_id, [0, 0, 0])
+        for i in range(3):
+            delta[i] += sign * contribution[i + 1]
+    
+    deleted = session.deleted
+    for device in list(session.new) + list(session.dirty):
+        if isinstance(device, Device) and device not in deleted:
+            add(_device_contribution(device), 1)
+    for contribution in previous:
+        add(contribution, -1)
+    
+    deltas = {room_id: delta for room_id, delta in deltas.items() if any(delta)}
+    if not deltas:
+        return
+    
+    connection = session.connection()
+    missing = [room_id for room_id in deltas if room_id not in parents]
+    parents.update(_room_parents(connection, missing))
+    
+    floor_deltas = {}
+    home_deltas = {}
+    for room_id, delta in deltas.items():
+        if room_id not in parents:
+            continue
+        floor_id, home_id = parents[room_id]
+        for target, key in ((floor_deltas, floor_id), (home_deltas, home_id)):
+            total = target.setdefault(key, [0, 0, 0])
+            for i in range(3):
+                total[i] += delta[i]
+    
+    for model, model_deltas in ((Room, deltas), (Floor, floor_deltas), (Home, home_deltas)):
+        table = model.__table__
+        for ident, delta in model_deltas.items():
+            if not any(delta):
+                continue
+            connection.execute(
+                update(table)
+                .where(table.c.id == ident)
+                .values({
+                    field: table.c[field] + delta[i]
+                    for i, field in enumerate(COUNTER_FIELDS)
+                })
+            )
+            # Loaded instances now hold stale counters
+            instance = session.identity_map.get(session.identity_key(model, ident))
+            if instance is not None:
+                session.info.setdefault('device_counters_stale', []).append(instance)
+
+
+@event.listens_for(Session, 'after_flush_postexec')
+def _expire_device_counters(session, flush_context):
+    for instance in session.info.pop('device_counters_stale', []):
+        if instance in session:
+            session.expire(instance, list(COUNTER_FIELDS))
+
+
+def reconcile_device_counters(session=None):
+    """Recompute Room, Floor and Home device counters from the devices table.
+    
+    Returns a dict mapping table name to the number of rows that were repaired.
+    """
+    session = session or db.session
+    online = func.sum(case((Device.status == 'online', 1), else_=0))
+    active = func.sum(case((Device.is_active == True, 1), else_=0))  # noqa: E712
+    
+    actual = {
+        Room: select(Room.id, func.count(Device.id), online, active)
+            .outerjoin(Device, Device.room_id == Room.id)
+            .group_by(Room.id),
+        Floor: select(Floor.id, func.count(Device.id), online, active)
+            .outerjoin(Room, Room.floor_id == Floor.id)
+            .outerjoin(Device, Device.room_id == Room.id)
+            .group_by(Floor.id),
+        Home: select(Home.id, func.count(Device.id), online, active)
+            .outerjoin(Floor, Floor.home_id == Home.id)
+            .outerjoin(Room, Room.floor_id == Floor.id)
+            .outerjoin(Device, Device.room_id == Room.id)
+            .group_by(Home.id),
+    }
+    
+    repaired = {}
+    for model, query in actual.items():
+        expected = {
+            row[0]: tuple(int(value or 0) for value in row[1:])
+            for row in session.execute(query)
+        }
+        stored = session.execute(
+            select(model.id, *(getattr(model, field) for field in COUNTER_FIELDS))
+        )
+        table = model.__table__
+        count = 0
+        for row in stored:
+            target = expected.get(row[0], (0, 0, 0))
+            if tuple(value or 0 for value in row[1:]) != target:
+                session.execute(
+                    update(table)
+                    .where(table.c.id == row[0])
+                    .values(dict(zip(COUNTER_FIELDS, target)))
+                )
+                count += 1
+        repaired[model.__tablename__] = count
+    session.commit()
+    return repaired
+
+
+def add_counter_columns(engine=None):
+    """Add the device counter columns to homes, floors and rooms tables created without them.
+    
+    db.create_all() never alters existing tables. Returns the names of the
+    tables altered; their counters start at 0 until reconcile_device_counters()
+    recomputes them.
+    """
+    engine = engine or db.engine
+    inspector = inspect(engine)
+    altered = []
+    with engine.begin() as connection:
+        for model in (Home, Floor, Room):
+            table = model.__tablename__
+            columns = {column['name'] for column in inspector.get_columns(table)}
+            missing = [field for field in COUNTER_FIELDS if field not in columns]
+            for field in missing:
+                connection.exec_driver_sql(f'ALTER TABLE {table} ADD COLUMN {field} INTEGER NOT NULL DEFAULT 0')
+            if missing:
+                altered.append(table)
+    return altered
+
+
+
+# Sensor data sketch maintenance
+#
+# Readings inserted through the ORM are folded into the hourly sketch of
+# their device in the same transaction, and the sketches of the hours that
+# readings are deleted from through the ORM are recomputed. Rows written or
+# deleted with Core statements (e.g. fake_data_generator.py --bulk) are only
+# summarized by rebuild_sensor_sketches() (flask rebuild-sketches).
+SKETCH_BUCKET = timedelta(hours=1)
+
+
+def sketch_bucket_start(timestamp):
+    """Return the start of the sketch bucket containing a timestamp."""
+    return timestamp.replace(minute=0, second=0, microsecond=0)
+
+
+def _merge_into_sketch(connection, device_id, bucket_start, stats, sketch):
+    """Merge new readings into the stored sketch row for (device, bucket).
+    
+    A missing row is inserted in a SAVEPOINT: if a concurrent writer
+    inserted it first, the unique constraint rejects ours and the readings
+    are merged into the other writer's row instead.
+    """
+    table = SensorDataSketch.__table__
+    existing_row = select(table).where(
+        table.c.device_id == device_id,
+        table.c.bucket_start == bucket_start
+    ).with_for_update()
+    existing = connection.execute(existing_row).first()
+    if existing is None:
+        try:
+            with connection.begin_nested():
+                connection.execute(table.insert().values(
+                    device_id=device_id, bucket_start=bucket_start,
+                    count=stats.count, mean=stats.mean, m2=stats.m2,
+                    min_value=stats.min, max_value=stats.max, sketch=sketch.to_json()
+                ))
+            return
+        except IntegrityError:
+            existing = connection.execute(existing_row).first()
+            if existing is None:
+                raise
+    merged = RunningStats(existing.count, existing.mean, existing.m2,
+                          existing.min_value, existing.max_value).merge(stats)
+    stored = DDSketch.from_json(existing.sketch).merge(sketch)
+    connection.execute(table.update().where(table.c.id == existing.id).values(
+        count=merged.count, mean=merged.mean, m2=merged.m2,
+        min_value=merged.min, max_value=merged.max, sketch=stored.to_json()
+    ))
+
+
+def _recompute_sketch(session, connection, device_id, bucket_start):
+    """Replace the sketch row for (device, bucket) with a summary of the readings left."""
+    table = SensorDataSketch.__table__
+    with sharding.for_device(device_id):
+        values = session.execute(select(SensorData.value).where(
+            SensorData.device_id == device_id,
+            SensorData.timestamp >= bucket_start,
+            SensorData.timestamp < bucket_start + SKETCH_BUCKET
+        )).scalars().all()
+    connection.execute(table.delete().where(
+        table.c.device_id == device_id,
+        table.c.bucket_start == bucket_start
+    ))
+    if not values:
+        return
+    stats, sketch = RunningStats(), DDSketch()
+    for value in values:
+        stats.add(value)
+        sketch.add(value)
+    connection.execute(table.insert().values(
+        device_id=device_id, bucket_start=bucket_start,
+        count=stats.count, mean=stats.mean, m2=stats.m2,
+        min_value=stats.min, max_value=stats.max, sketch=sketch.to_json()
+    ))
+
+
+@event.listens_for(Session, 'after_flush')
+def _update_sensor_sketches(session, flush_context):
+    # Sketches cannot subtract readings, so the hours deleted from are recomputed
+    recompute = {
+        (reading.device_id, sketch_bucket_start(reading.timestamp)) for reading in session.deleted
+        if isinstance(reading, SensorData) and reading.timestamp is not None
+    }
+    buckets = {}
+    for reading in session.new:
+        if isinstance(reading, SensorData) and reading.timestamp is not None:
+            key = (reading.device_id, sketch_bucket_start(reading.timestamp))
+            if key in recompute:
+                # Already flushed, so the recomputed summary includes it
+                continue
+            if key not in buckets:
+                buckets[key] = (RunningStats(), DDSketch())
+            stats, sketch = buckets[key]
+            stats.add(reading.value)
+            sketch.add(reading.value)
+    if not buckets and not recompute:
+        return
+    connection = session.connection()
+    for (device_id, bucket_start), (stats, sketch) in buckets.items():
+        _merge_into_sketch(connection, device_id, bucket_start, stats, sketch)
+    for device_id, bucket_start in recompute:
+        _recompute_sketch(session, connection, device_id, bucket_start)
+
+
+def rebuild_sensor_sketches(session=None, device_ids=None, batch_size=50000):
+    """Recompute hourly sketches from the raw sensor_data rows.
+    
+    Returns the number of sketch rows written.
+    """
+    session = session or db.session
+    table = SensorDataSketch.__table__
+    delete = table.delete()
+    query = select(SensorData.device_id, SensorData.timestamp, SensorData.value)\
+        .order_by(SensorData.device_id, SensorData.timestamp)
+    if device_ids is not None:
+        delete = delete.where(table.c.device_id.in_(device_ids))
+        query = query.where(SensorData.device_id.in_(device_ids))
+    session.execute(delete)
+    
+    def readings():
+        # Each device's readings are on a single shard
+        for shard in sharding.shards():
+            with sharding.use(shard):
+                yield from session.execute(query.execution_options(yield_per=batch_size))
+    
+    rows = []
+    current_key = None
+    stats = sketch = None
+    
+    def flush_bucket():
+        rows.append({
+            'device_id': current_key[0], 'bucket_start': current_key[1],
+            'count': stats.count, 'mean': stats.mean, 'm2': stats.m2,
+            'min_value': stats.min, 'max_value': stats.max, 'sketch': sketch.to_json()
+        })
+    
+    written = 0
+    for device_id, timestamp, value in readings():
+        key = (device_id, sketch_bucket_start(timestamp))
+        if key != current_key:
+            if current_key is not None:
+                flush_bucket()
+            current_key = key
+            stats, sketch = RunningStats(), DDSketch()
+        stats.add(value)
+        sketch.add(value)
+        if len(rows) >= 5000:
+            session.execute(table.insert(), rows)
+            written += len(rows)
+            rows = []
+    if current_key is not None:
+        flush_bucket()
+    if rows:
+        session.execute(table.insert(), rows)
+        written += len(rows)
+    session.commit()
+    return written
+
+
+
+# Late data tracking
+#
+# Results for closed days are cached in memory (see result_cache.py). Any
+# flush that inserts or deletes readings before the start of the current UTC
+# day records the earliest affected timestamp per device, in the same
+# transaction, so every process can invalidate the affected entries.
+def closed_day_boundary():
+    """Return the start of the current UTC day; earlier days are closed."""
+    return datetime.utcnow().replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+def record_late_data(connection, device_id, earliest_timestamp):
+    """Record a change to readings at or after `earliest_timestamp`."""
+    connection.execute(LateDataEvent.__table__.insert().values(
+        device_id=device_id,
+        earliest_timestamp=earliest_timestamp,
+        created_at=datetime.utcnow()
+    ))
+
+
+@event.listens_for(Session, 'after_flush')
+def _record_late_sensor_data(session, flush_context):
+    boundary = None
+    earliest = {}
+    for reading in list(session.new) + list(session.deleted):
+        if isinstance(reading, SensorData) and reading.timestamp is not None:
+            boundary = boundary or closed_day_boundary()
+            if reading.timestamp < boundary:
+                current = earliest.get(reading.device_id)
+                if current is None or reading.timestamp < current:
+                    earliest[reading.device_id] = reading.timestamp
+    if not earliest:
+        return
+    connection = session.connection()
+    for device_id, timestamp in earliest.items():
+        record_late_data(connection, device_id, timestamp)
@@ -0,0 +1,215 @@
+"""Read replica routing.
+
+When REPLICA_DATABASE_URL is set it becomes the 'replica' bind, and the
+SELECTs of GET/HEAD requests (API routes and pages) run on it. Everything
+else stays on the primary:
+
+- write requests, background threads and CLI commands,
+- endpoints in PRIMARY_ENDPOINTS (login, token checks, command status),
+- the rest of a request once it has flushed a write,
+- clients whose last write the replica has not caught up with yet,
+- every request while the replica is more than REPLICA_MAX_LAG seconds
+  behind, or its lag is unknown.
+
+Lag is measured with a heartbeat: each process writes the current time to
+the replication_heartbeats table on the primary every
+REPLICA_HEARTBEAT_INTERVAL seconds and reads it back from the replica. The
+time since the newest heartbeat visible on the replica is the lag (an upper
+bound, off by at most one interval).
+
+A client's last write is remembered per process (and in the session cookie
+of browser users); its reads go to the primary until the replica shows a
+heartbeat written after that write.
+
+For local testing, either point the replica at the primary file through a
+read-only connection (sqlite:///file:smart_home.db?mode=ro&uri=true), or at
+a second file kept up to date with the sync-replica CLI command.
+"""
+import time
+import sqlite3
+import logging
+import threading
+from datetime import datetime
+
+from flask import request, session, has_request_context
+from flask_sqlalchemy.session import Session
+from sqlalchemy import event, select, update, insert
+from sqlalchemy.exc import SQLAlchemyError
+
+import metrics
+
+# Get logger
+logger = logging.getLogger('smart_home.replica')
+
+REPLICA_BIND = 'replica'
+# Endpoints that must see their own (or just-committed) writes
+PRIMARY_ENDPOINTS = {
+    'login', 'register', 'logout', 'validate_token', 'api_get_action', 'health', 'metrics_endpoint'
+}
+
+_ROUTE_KEY = 'smart_home.db_route'
+_WROTE_KEY = 'smart_home.db_wrote'
+_SESSION_WRITE_KEY = '_db_written_at'
+
+
+class ReplicaRouter:
+    """Decides, per request, whether reads may use the replica."""
+
+    def __init__(self):
+        self.enabled = False
+        self.max_lag = 5.0
+        # Heartbeat time visible on the replica, and how long ago that was
+        self.position = None
+        self.lag = None
+        self._last_writes = {}
+
+    def client_key(self):
+        """Identify the client of the current request (session user or token)."""
+        if session.get('_user_id'):
+            return ('user', session['_user_id'])
+        auth_header = request.headers.get('Authorization', '')
+        token = auth_header[7:] if auth_header.startswith('Bearer ') else request.args.get('access_token')
+        return ('token', token) if token else None
+
+    def route(self):
+        """Return 'replica' or 'primary' for the reads of the current request."""
+        route = request.environ.get(_ROUTE_KEY)
+        if route is None:
+            route, reason = self._choose()
+            request.environ[_ROUTE_KEY] = route
+            metrics.db_routed_requests.inc(route, reason)
+        return route
+
+    def _choose(self):
+        if request.method not in ('GET', 'HEAD'):
+            return 'primary', 'write_request'
+        if request.endpoint in PRIMARY_ENDPOINTS:
+            return 'primary', 'endpoint'
+        if self.lag is None or self.lag > self.max_lag:
+            return 'primary', 'lag'
+        written = self._last_writes.get(self.client_key())
+        session_written = session.get(_SESSION_WRITE_KEY)
+        if session_written:
+            written = max(written or datetime.min, datetime.fromisoformat(session_written))
+        if written and written >= self.position:
+            return 'primary', 'own_writes'
+        return 'replica', 'read'
+
+    def record_write(self):
+        """Pin the current client's reads to the primary until the replica catches up."""
+        now = datetime.utcnow()
+        key = self.client_key()
+        if key is not None:
+            self._last_writes[key] = now
+        if session.get('_user_id'):
+            session[_SESSION_WRITE_KEY] = now.isoformat()
+
+    def heartbeat(self, db, heartbeat_table):
+        """Write a heartbeat to the primary and read the newest one from the replica."""
+        now = datetime.utcnow()
+        try:
+            with db.engines[None].begin() as connection:
+                updated = connection.execute(
+                    update(heartbeat_table).where(heartbeat_table.c.id == 1).values(beat_at=now)
+                ).rowcount
+                if not updated:
+                    connection.execute(insert(heartbeat_table).values(id=1, beat_at=now))
+        except SQLAlchemyError:
+            # Another process inserted the row first; its heartbeat is as good
+            pass
+        try:
+            with db.engines[REPLICA_BIND].connect() as connection:
+                position = connection.execute(
+                    select(heartbeat_table.c.beat_at).where(heartbeat_table.c.id == 1)
+                ).scalar()
+        except SQLAlchemyError as e:
+            if self.lag is not None:
+                logger.warning(f"Cannot read the replica heartbeat, reading from the primary: {e}")
+            self.position = self.lag = None
+            return
+        was_healthy = self.lag is not None and self.lag <= self.max_lag
+        self.position = position
+        self.lag = max((datetime.utcnow() - position).total_seconds(), 0.0) if position else None
+        healthy = self.lag is not None and self.lag <= self.max_lag
+        if was_healthy != healthy:
+            logger.warning(f"Replica lag {self.lag}s, reads go to the {'replica' if healthy else 'primary'}")
+        # Writes the replica has caught up with no longer pin their clients
+        if position:
+            self._last_writes = {key: at for key, at in self._last_writes.items() if at >= position}
+
+
+router = ReplicaRouter()
+
+
+class RoutingSession(Session):
+    """Session that sends the SELECTs of eligible requests to the replica."""
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        engine = super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+        if (router.enabled and bind is None and not self._flushing
+                and getattr(clause, 'is_select', False)
+                and engine is self._db.engines.get(None)
+                and has_request_context() and router.route() == 'replica'):
+            return self._db.engines[REPLICA_BIND]
+        return engine
+
+
+@event.listens_for(RoutingSession, 'after_flush')
+def _pin_after_write(db_session, flush_context):
+    if has_request_context():
+        request.environ[_ROUTE_KEY] = 'primary'
+        request.environ[_WROTE_KEY] = True
+
+
+def sqlite_path(engine):
+    """Return the file path of a SQLite engine's database."""
+    path = engine.url.database
+    if path.startswith('file:'):
+        path = path[5:].split('?', 1)[0]
+    return path
+
+
+def sync_sqlite_replica(primary, replica):
+    """Copy the primary SQLite database into the replica file."""
+    source_path, target_path = sqlite_path(primary), sqlite_path(replica)
+    if source_path == target_path:
+        raise ValueError('The replica is the primary database file')
+    source = sqlite3.connect(source_path)
+    target = sqlite3.connect(target_path, timeout=30)
+    try:
+        target.execute('PRAGMA journal_mode=WAL')
+        source.backup(target)
+    finally:
+        target.close()
+        source.close()
+
+
+def init_app(app, db):
+    """Route reads to the replica bind, if one is configured, and track its lag."""
+    with app.app_context():
+        router.enabled = REPLICA_BIND in db.engines
+    if not router.enabled:
+        return
+    router.max_lag = app.config.get('REPLICA_MAX_LAG', 5.0)
+    interval = app.config.get('REPLICA_HEARTBEAT_INTERVAL', 1.0)
+    metrics.db_replica_lag.callback = lambda: {(): router.lag} if router.lag is not None else {}
+
+    from models import ReplicationHeartbeat
+    heartbeat_table = ReplicationHeartbeat.__table__
+
+    @app.after_request
+    def record_client_write(response):
+        if request.environ.get(_WROTE_KEY) and response.status_code < 400:
+            router.record_write()
+        return response
+
+    def beat():
+        while True:
+            try:
+                with app.app_context():
+                    router.heartbeat(db, heartbeat_table)
+            except Exception:
+                logger.exception('Replica heartbeat failed')
+            time.sleep(interval)
+
+    threading.Thread(target=beat, name='replica-heartbeat', daemon=True).start()
@@ -0,0 +1,186 @@
+"""In-memory cache of sensor data results for closed days.
+
+Statistics and aggregates over past days only change when late data arrives,
+so results are cached per UTC day and never expire on their own. Writers
+record every change to a closed day in the late_data_events table (see
+models.py); each process applies new events before reading from its cache,
+dropping the entries of the affected devices from the earliest changed day
+onwards. The open "today" bucket is never cached.
+
+Events older than RESULT_CACHE_EVENT_RETENTION are deleted by the sync
+(at most every PRUNE_INTERVAL seconds per process). A process that hasn't
+synced for longer than the retention may have missed pruned events, so it
+drops its whole cache instead.
+"""
+import time
+import threading
+from collections import OrderedDict
+from datetime import datetime, timedelta
+
+from sqlalchemy import delete
+
+from models import LateDataEvent, closed_day_boundary
+import metrics
+
+DAY = timedelta(days=1)
+# Events are re-read this far behind the newest one seen, so that events from
+# transactions that commit out of id order are not missed
+EVENT_RESCAN_WINDOW = 256
+# Seconds between deletions of expired events
+PRUNE_INTERVAL = 600
+
+
+class ResultCache:
+    """LRU cache of per-day results, invalidated by late data events."""
+
+    def __init__(self, max_entries=10000, close_grace=timedelta(minutes=5), enabled=True,
+                 event_retention=timedelta(days=1)):
+        self.max_entries = max_entries
+        # A day is only treated as closed this long after midnight, so that
+        # readings still in flight (or from writers with a slightly late clock)
+        # are stored before the day is first cached
+        self.close_grace = close_grace
+        self.enabled = enabled
+        self.event_retention = event_retention
+        self._entries = OrderedDict()
+        self._by_day = {}
+        self._seen_events = set()
+        self._last_event_id = None
+        self._synced_at = None
+        self._pruned_at = None
+        self._lock = threading.Lock()
+
+    def closed_before(self, now=None):
+        """Return the end of the last closed day."""
+        boundary = closed_day_boundary()
+        now = now or datetime.utcnow()
+        if now - boundary < self.close_grace:
+            boundary -= DAY
+        return boundary
+
+    def split_window(self, since, until=None):
+        """Split a window into (closed days, head, tail).
+
+        `days` are the start times of the whole closed days in the window,
+        `head` is the (since, first day) range before them and `tail` is the
+        (end of last day, until) range after them, with `until` inclusive.
+        Returns ([], None, None) when the window contains no closed day.
+        """
+        if not self.enabled or since is None:
+            return [], None, None
+        first_day = since.replace(hour=0, minute=0, second=0, microsecond=0)
+        if first_day < since:
+            first_day += DAY
+        end = self.closed_before()
+        if until is not None:
+            end = min(end, until.replace(hour=0, minute=0, second=0, microsecond=0))
+        days = []
+        day = first_day
+        while day + DAY <= end:
+            days.append(day)
+            day += DAY
+        if not days:
+            return [], None, None
+        head = (since, first_day) if since < first_day else None
+        return days, head, (day, until)
+
+    def sync(self, session):
+        """Apply late data events recorded since the last sync, by any process."""
+        if not self.enabled:
+            return
+        now = time.monotonic()
+        if self._synced_at is not None and now - self._synced_at > self.event_retention.total_seconds():
+            # Events this process never read may have been pruned since
+            self.clear()
+            self._last_event_id = None
+        self._synced_at = now
+        if self._pruned_at is None or now - self._pruned_at >= PRUNE_INTERVAL:
+            self._pruned_at = now
+            self.prune(session)
+        if self._last_event_id is None:
+            # Nothing is cached yet, so earlier events are irrelevant
+            self._last_event_id = session.query(
+                LateDataEvent.id).order_by(LateDataEvent.id.desc()).limit(1).scalar() or 0
+            return
+        events = session.query(
+            LateDataEvent.id, LateDataEvent.device_id, LateDataEvent.earliest_timestamp
+        ).filter(
+            LateDataEvent.id > self._last_event_id - EVENT_RESCAN_WINDOW
+        ).order_by(LateDataEvent.id).all()
+        with self._lock:
+            for event_id, device_id, earliest in events:
+                if event_id in self._seen_events:
+                    continue
+                self._seen_events.add(event_id)
+                self._last_event_id = max(self._last_event_id, event_id)
+                self._invalidate(device_id, earliest)
+            low_water = self._last_event_id - EVENT_RESCAN_WINDOW
+            self._seen_events = {event_id for event_id in self._seen_events if event_id > low_water}
+
+    def prune(self, session):
+        """Delete late data events older than the event retention; returns the number deleted."""
+        cutoff = datetime.utcnow() - self.event_retention
+        # In its own transaction: the request's session may not commit
+        with session.connection().engine.begin() as connection:
+            result = connection.execute(delete(LateDataEvent).where(LateDataEvent.created_at < cutoff))
+        return result.rowcount
+
+    def get(self, name, key):
+        """Return the cached value for `key`, or None (counted in cache metrics)."""
+        if not self.enabled:
+            return None
+        with self._lock:
+            entry = self._entries.get((name, key))
+            if entry is not None:
+                self._entries.move_to_end((name, key))
+        metrics.record_cache(name, entry is not None)
+        return entry[2] if entry is not None else None
+
+    def set(self, name, key, value, devices, day):
+        """Cache `value`, computed from the readings of `devices` on `day`."""
+        if not self.enabled:
+            return
+        with self._lock:
+            self._discard((name, key))
+            self._entries[(name, key)] = (frozenset(devices), day, value)
+            self._by_day.setdefault(day, set()).add((name, key))
+            while len(self._entries) > self.max_entries:
+                self._discard(next(iter(self._entries)))
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._by_day.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _invalidate(self, device_id, earliest):
+        since_day = earliest.replace(hour=0, minute=0, second=0, microsecond=0)
+        for day in [day for day in self._by_day if day >= since_day]:
+            for entry_key in list(self._by_day.get(day, ())):
+                devices = self._entries[entry_key][0]
+                if device_id is None or device_id in devices:
+                    self._discard(entry_key)
+
+    def _discard(self, entry_key):
+        entry = self._entries.pop(entry_key, None)
+        if entry is None:
+            return
+        keys = self._by_day.get(entry[1])
+        if keys is not None:
+            keys.discard(entry_key)
+            if not keys:
+                del self._by_day[entry[1]]
+
+
+cache = ResultCache()
+
+
+def init_app(app):
+    """Configure the result cache from the app config."""
+    cache.enabled = app.config.get('RESULT_CACHE_ENABLED', True)
+    cache.max_entries = app.config.get('RESULT_CACHE_MAX_ENTRIES', 10000)
+    cache.close_grace = timedelta(seconds=app.config.get('RESULT_CACHE_CLOSE_GRACE', 300))
+    cache.event_retention = timedelta(seconds=app.config.get('RESULT_CACHE_EVENT_RETENTION', 86400))
+    cache.clear()
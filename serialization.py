@@ -0,0 +1,141 @@
+"""Response encoding: fast JSON, MessagePack negotiation and compression.
+
+- jsonify uses orjson when it is installed (stdlib json otherwise).
+- Views that return `api_response(...)` send MessagePack to clients that
+  prefer `application/msgpack` (requires the msgpack package).
+- Text, JSON and MessagePack bodies larger than COMPRESS_MIN_SIZE are
+  compressed with brotli (if installed) or gzip, per Accept-Encoding.
+"""
+import gzip
+import json
+import decimal
+from datetime import date, datetime
+from flask import request, current_app, jsonify
+from flask.json.provider import DefaultJSONProvider
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+MSGPACK_MIMETYPE = 'application/msgpack'
+COMPRESSIBLE_MIMETYPES = {
+    'application/json', 'application/msgpack', 'application/javascript',
+    'text/html', 'text/plain', 'text/css', 'text/csv'
+}
+
+
+def _default(value):
+    """Encode values that orjson and msgpack do not support natively."""
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    if isinstance(value, decimal.Decimal):
+        return float(value)
+    if isinstance(value, (set, frozenset, tuple)):
+        return list(value)
+    if hasattr(value, 'to_dict'):
+        return value.to_dict()
+    raise TypeError(f'Object of type {type(value).__name__} is not serializable')
+
+
+class OrjsonProvider(DefaultJSONProvider):
+    """JSON provider that serializes with orjson.
+
+    Keys are not sorted: orjson preserves insertion order, which is already
+    deterministic, and sorting costs more than the encoding itself.
+    """
+    sort_keys = False
+
+    def dumps(self, obj, **kwargs):
+        if kwargs:
+            return json.dumps(obj, default=_default, **kwargs)
+        return orjson.dumps(obj, default=_default, option=orjson.OPT_NON_STR_KEYS).decode()
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        if self.compact is False or (self.compact is None and current_app.debug):
+            option = orjson.OPT_NON_STR_KEYS | orjson.OPT_INDENT_2
+        else:
+            option = orjson.OPT_NON_STR_KEYS
+        body = orjson.dumps(obj, default=_default, option=option)
+        return current_app.response_class(body, mimetype=self.mimetype)
+
+
+def wants_msgpack():
+    """Return True if the client prefers MessagePack and it can be produced."""
+    if msgpack is None:
+        return False
+    best = request.accept_mimetypes.best_match(['application/json', MSGPACK_MIMETYPE])
+    return best == MSGPACK_MIMETYPE
+
+
+def api_response(payload, status=200):
+    """Return `payload` as JSON or, if the client asks for it, MessagePack."""
+    if wants_msgpack():
+        body = msgpack.packb(payload, default=_default)
+        response = current_app.response_class(body, status=status, mimetype=MSGPACK_MIMETYPE)
+    else:
+        response = jsonify(payload)
+        response.status_code = status
+    response.vary.add('Accept')
+    return response
+
+
+def _choose_encoding():
+    accepted = request.accept_encodings
+    if brotli is not None and accepted['br']:
+        return 'br'
+    if accepted['gzip']:
+        return 'gzip'
+    return None
+
+
+def compress_response(response, min_size, level=6):
+    """Compress a buffered response in place if it is large and compressible."""
+    if (response.direct_passthrough or response.is_streamed
+            or response.status_code < 200 or response.status_code in (204, 304)
+            or 'Content-Encoding' in response.headers
+            or response.mimetype not in COMPRESSIBLE_MIMETYPES):
+        return response
+    response.vary.add('Accept-Encoding')
+    encoding = _choose_encoding()
+    if encoding is None or response.content_length is None or response.content_length < min_size:
+        return response
+
+    data = response.get_data()
+    if encoding == 'br':
+        data = brotli.compress(data, quality=min(level, 11))
+    else:
+        data = gzip.compress(data, compresslevel=level, mtime=0)
+    response.set_data(data)
+    response.headers['Content-Encoding'] = encoding
+    # The ETag describes the uncompressed representation
+    etag, weak = response.get_etag()
+    if etag and not weak:
+        response.set_etag(etag, weak=True)
+    return response
+
+
+def init_app(app):
+    """Use orjson for JSON responses and compress large response bodies."""
+    if orjson is not None and app.config.get('FAST_JSON', True):
+        app.json = OrjsonProvider(app)
+
+    min_size = app.config.get('COMPRESS_MIN_SIZE', 1024)
+    level = app.config.get('COMPRESS_LEVEL', 6)
+    if min_size is None:
+        return
+
+    @app.after_request
+    def compress(response):
+        return compress_response(response, min_size, level)
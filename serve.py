@@ -0,0 +1,169 @@
+"""Production server: eventlet green threads in one or more worker processes.
+
+Usage:
+    python serve.py
+    python serve.py --workers 4 --connections 500 --port 8000
+
+The listening socket is opened once and shared by SERVER_WORKERS forked
+processes; each serves up to SERVER_WORKER_CONNECTIONS concurrent
+connections with green threads. `python app.py` remains the development
+server (debugger, reloader).
+
+Every green thread gets its own contextvars, so the app context, and with it
+the Flask-SQLAlchemy session, is never shared between concurrent requests.
+The session is removed when the request's app context ends, and connections
+waiting for a free pool slot yield to other green threads instead of
+blocking the process. The standard library is monkey-patched before the app
+is imported, which also makes the command dispatcher's background threads
+green. SQLite calls still run without yielding, so with SQLite run one
+worker per CPU rather than relying on more connections per worker.
+
+Caches, in-flight device commands and /metrics samples are kept per worker
+process.
+"""
+import os
+import sys
+import signal
+import socket
+import logging
+import argparse
+import importlib.util
+
+import eventlet
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+# Get logger
+logger = logging.getLogger('smart_home.server')
+
+
+def load_app():
+    """Import app.py (the app/ package shadows `import app`)."""
+    sys.path.insert(0, ROOT)
+    spec = importlib.util.spec_from_file_location('smart_home_app', os.path.join(ROOT, 'app.py'))
+    module = importlib.util.module_from_spec(spec)
+    sys.modules['smart_home_app'] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+def cooperative(wsgi_app):
+    """Yield to other green threads before each request.
+
+    A keep-alive connection whose next request is already buffered would
+    otherwise be served again without ever switching, starving the others.
+    """
+    def application(environ, start_response):
+        eventlet.sleep(0)
+        return wsgi_app(environ, start_response)
+    return application
+
+
+def run_worker(sock, connections):
+    """Import the app and serve requests from `sock` until terminated."""
+    import eventlet.wsgi
+
+    app = load_app().app
+    app.config.update(DEBUG=False)
+    logger.info(f"Worker {os.getpid()} serving up to {connections} connections")
+    eventlet.wsgi.server(
+        sock,
+        cooperative(app),
+        max_size=connections,
+        keepalive=app.config.get('SERVER_KEEPALIVE', 75) or False,
+        log_output=app.config.get('SERVER_ACCESS_LOG', False),
+        socket_timeout=app.config.get('SERVER_SOCKET_TIMEOUT', 60) or None,
+        debug=False
+    )
+
+
+def create_tables():
+    """Create missing tables once, in a child process, before the workers start."""
+    pid = os.fork()
+    if pid == 0:
+        status = 1
+        try:
+            load_app().init_app()
+            status = 0
+        finally:
+            os._exit(status)
+    _, status = os.waitpid(pid, 0)
+    if status != 0:
+        sys.exit('Could not create the database tables')
+
+
+def supervise(sock, workers, connections):
+    """Fork the workers and restart any that exits until a stop signal arrives."""
+    children = {}
+    stopping = False
+
+    def spawn():
+        pid = os.fork()
+        if pid == 0:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            try:
+                run_worker(sock, connections)
+            finally:
+                os._exit(0)
+        children[pid] = True
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for pid in list(children):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    for _ in range(workers):
+        spawn()
+
+    while children:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        except InterruptedError:
+            continue
+        children.pop(pid, None)
+        if not stopping:
+            logger.warning(f"Worker {pid} exited with status {status}, restarting")
+            spawn()
+
+
+def main():
+    # Only the configuration is read before monkey-patching
+    from config import Config
+
+    parser = argparse.ArgumentParser(description='Run the Smart Home Dashboard with eventlet')
+    parser.add_argument('--host', default=Config.SERVER_HOST, help='Address to listen on')
+    parser.add_argument('--port', type=int, default=Config.SERVER_PORT, help='Port to listen on')
+    parser.add_argument('--workers', type=int, default=Config.SERVER_WORKERS,
+                        help='Worker processes')
+    parser.add_argument('--connections', type=int, default=Config.SERVER_WORKER_CONNECTIONS,
+                        help='Concurrent connections (green threads) per worker')
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    )
+    eventlet.monkey_patch()
+    sock = eventlet.listen((args.host, args.port), backlog=Config.SERVER_BACKLOG)
+    # Accepted connections inherit this; without it, responses written in
+    # several sends stall on delayed ACKs over keep-alive connections
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    create_tables()
+    logger.info(f"Listening on http://{args.host}:{args.port} with {args.workers} worker(s)")
+    if args.workers <= 1:
+        run_worker(sock, args.connections)
+    else:
+        supervise(sock, args.workers, args.connections)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,439 @@
+"""Horizontal sharding of sensor data and user actions by home.
+
+When SHARD_DATABASE_URLS lists N databases they become the binds
+'shard0'..'shard<N-1>', and the sensor_data and user_actions rows of each
+home live on exactly one of them: crc32(home id) % N, unless the home was
+moved with the move-home CLI command (recorded in the home_shards table).
+Everything else, including the hourly sketches, late data events and the
+home/floor/room/device hierarchy, stays on the primary database.
+
+Queries on the sharded tables run inside `use(shard)` (or `for_device`,
+`for_home`); the session sends them to that shard and raises
+ShardRoutingError outside of one, so a query never silently reads the
+primary's copy of the tables. Inserts, updates and deletes are routed per
+row by device. Code reading many devices groups them with
+`group_by_shard()` and merges the per-shard results, so only admin pages and
+'all' queries visit every shard.
+
+Row ids are reserved in blocks from the shard_id_blocks table, so they are
+unique across shards and rows keep their ids when a home moves. A commit
+that wrote to several databases commits them one after another; there is no
+two-phase commit.
+"""
+import time
+import zlib
+import logging
+import threading
+import contextvars
+from datetime import datetime
+from contextlib import contextmanager
+
+from sqlalchemy import MetaData, Table, Column, Index, event, inspect, select, update, insert, delete, func
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.sql.util import find_tables
+
+from replica import RoutingSession
+
+# Get logger
+logger = logging.getLogger('smart_home.sharding')
+
+SHARDED_TABLES = frozenset({'sensor_data', 'user_actions'})
+# Copies of the sharded tables without foreign keys, built by init_app
+_shard_tables = None
+
+_active_shard = contextvars.ContextVar('smart_home_shard', default=None)
+
+
+class ShardRoutingError(RuntimeError):
+    """A sharded table was queried without choosing a shard."""
+
+
+def shard_key(shard):
+    """Return the bind key of a shard index."""
+    return f'shard{shard}'
+
+
+class ShardMap:
+    """Home and device placement, cached per process for SHARD_MAP_TTL seconds."""
+
+    def __init__(self):
+        self.count = 0
+        self.ttl = 30.0
+        self.primary = None
+        self.engines = []
+        self._device_homes = {}
+        self._moved_homes = {}
+        self._loaded_at = None
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return self.count > 0
+
+    def invalidate(self):
+        self._loaded_at = None
+
+    def _refresh(self):
+        if self._loaded_at is not None and time.monotonic() - self._loaded_at < self.ttl:
+            return
+        from models import Device, Room, Floor, HomeShard
+        with self._lock:
+            if self._loaded_at is not None and time.monotonic() - self._loaded_at < self.ttl:
+                return
+            with self.primary.connect() as connection:
+                moved = dict(connection.execute(select(HomeShard.home_id, HomeShard.shard)).all())
+                devices = dict(connection.execute(
+                    select(Device.device_id, Floor.home_id)
+                    .join(Room, Device.room_id == Room.id).join(Floor, Room.floor_id == Floor.id)
+                ).all())
+            self._moved_homes, self._device_homes = moved, devices
+            self._loaded_at = time.monotonic()
+
+    def _load_device(self, device_id):
+        from models import Device, Room, Floor
+        with self.primary.connect() as connection:
+            home_id = connection.execute(
+                select(Floor.home_id)
+                .join(Room, Room.floor_id == Floor.id).join(Device, Device.room_id == Room.id)
+                .where(Device.device_id == device_id)
+            ).scalar()
+        if home_id is not None:
+            self._device_homes[device_id] = home_id
+        return home_id
+
+    def home_shard(self, home_id):
+        """Return the shard holding a home's rows."""
+        self._refresh()
+        moved = self._moved_homes.get(home_id)
+        if moved is not None:
+            return moved
+        return zlib.crc32(str(home_id).encode()) % self.count
+
+    def device_shard(self, device_id):
+        """Return the shard holding a device's rows (shard 0 for unknown devices)."""
+        self._refresh()
+        home_id = self._device_homes.get(device_id)
+        if home_id is None:
+            # Registered since the last refresh
+            home_id = self._load_device(device_id)
+        return self.home_shard(home_id) if home_id is not None else 0
+
+
+shard_map = ShardMap()
+
+
+class IdAllocator:
+    """Hands out row ids of the sharded tables from blocks reserved on the primary."""
+
+    def __init__(self, block_size=1000):
+        self.block_size = block_size
+        self._blocks = {}
+        self._lock = threading.Lock()
+
+    def allocate(self, table_name, count):
+        """Return `count` ids, unique across shards and processes."""
+        with self._lock:
+            next_id, end = self._blocks.get(table_name, (0, 0))
+            ids = list(range(next_id, min(end, next_id + count)))
+            if len(ids) < count:
+                size = max(count - len(ids), self.block_size)
+                next_id = self._reserve(table_name, size)
+                end = next_id + size
+                ids.extend(range(next_id, next_id + count - len(ids)))
+            self._blocks[table_name] = (ids[-1] + 1 if ids else next_id, end)
+            return ids
+
+    def _reserve(self, table_name, size):
+        from models import ShardIdBlock
+        blocks = ShardIdBlock.__table__
+        while True:
+            with shard_map.primary.begin() as connection:
+                if connection.execute(
+                    update(blocks).where(blocks.c.name == table_name)
+                    .values(next_id=blocks.c.next_id + size)
+                ).rowcount:
+                    return connection.execute(
+                        select(blocks.c.next_id).where(blocks.c.name == table_name)
+                    ).scalar() - size
+            # First reservation: start after every id already in use
+            first = max(_highest_id(engine, table_name) for engine in [shard_map.primary] + shard_map.engines) + 1
+            try:
+                with shard_map.primary.begin() as connection:
+                    connection.execute(insert(blocks).values(name=table_name, next_id=first + size))
+                return first
+            except IntegrityError:
+                # Another process reserved the first block; reserve the next one
+                continue
+
+
+id_allocator = IdAllocator()
+
+
+def _highest_id(engine, table_name):
+    with engine.connect() as connection:
+        if not inspect(connection).has_table(table_name):
+            return 0
+        table = _shard_tables.tables[table_name]
+        return connection.execute(select(func.max(table.c.id))).scalar() or 0
+
+
+def shards():
+    """Return every shard index, or [None] when sharding is off."""
+    return list(range(shard_map.count)) if shard_map.enabled else [None]
+
+
+def device_shard(device_id):
+    return shard_map.device_shard(device_id) if shard_map.enabled else None
+
+
+def home_shard(home_id):
+    return shard_map.home_shard(home_id) if shard_map.enabled else None
+
+
+@contextmanager
+def use(shard):
+    """Send the queries on sharded tables inside the block to `shard`."""
+    token = _active_shard.set(shard)
+    try:
+        yield shard
+    finally:
+        _active_shard.reset(token)
+
+
+def for_device(device_id):
+    return use(device_shard(device_id))
+
+
+def for_home(home_id):
+    return use(home_shard(home_id))
+
+
+def for_instance(item):
+    """Choose the shard of a model instance's sensor data and user actions.
+
+    Deleting a home, floor, room or device loads the rows its cascade removes.
+    """
+    if not shard_map.enabled:
+        return use(None)
+    from models import Home, Floor, Room
+    if getattr(item, 'device_id', None) is not None:
+        return for_device(item.device_id)
+    if isinstance(item, Home):
+        home_id = item.id
+    elif isinstance(item, Floor):
+        home_id = item.home_id
+    elif isinstance(item, Room) and item.floor is not None:
+        home_id = item.floor.home_id
+    else:
+        home_id = None
+    return for_home(home_id) if home_id is not None else use(None)
+
+
+def group_by_shard(device_ids):
+    """Group device ids as {shard: [device_id, ...]} ({None: ids} when sharding is off)."""
+    if not shard_map.enabled:
+        return {None: list(device_ids)}
+    groups = {}
+    for device_id in device_ids:
+        groups.setdefault(shard_map.device_shard(device_id), []).append(device_id)
+    return groups
+
+
+def find(db_session, model, pk):
+    """Get a row of a sharded model by primary key from whichever shard holds it."""
+    for shard in shards():
+        with use(shard):
+            item = db_session.get(model, pk)
+        if item is not None:
+            return item
+    return None
+
+
+def _touches_shards(mapper, clause):
+    if mapper is not None:
+        return mapper.local_table.name in SHARDED_TABLES
+    if clause is None:
+        return False
+    return any(getattr(table, 'name', None) in SHARDED_TABLES for table in find_tables(clause))
+
+
+class ShardedSession(RoutingSession):
+    """RoutingSession that keeps sensor data and user actions on their shard."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        if shard_map.enabled:
+            # Called by the flush for each row, so every row goes to its own shard
+            self.connection_callable = self._row_connection
+
+    def _row_connection(self, mapper=None, instance=None, **kwargs):
+        bind_arguments = {'mapper': mapper}
+        if instance is not None and mapper.local_table.name in SHARDED_TABLES:
+            bind_arguments['shard'] = shard_map.device_shard(instance.device_id)
+        return self.connection(bind_arguments=bind_arguments)
+
+    def get_bind(self, mapper=None, clause=None, bind=None, shard=None, **kwargs):
+        if shard is None and shard_map.enabled and bind is None and _touches_shards(mapper, clause):
+            shard = _active_shard.get()
+            if shard is None:
+                raise ShardRoutingError(
+                    'Sensor data and user actions are sharded; query them inside sharding.use()')
+        if shard is not None:
+            return self._db.engines[shard_key(shard)]
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+
+@event.listens_for(ShardedSession, 'before_flush')
+def _assign_row_ids(db_session, flush_context, instances):
+    if not shard_map.enabled:
+        return
+    pending = {}
+    for item in db_session.new:
+        table_name = getattr(item, '__tablename__', None)
+        if table_name in SHARDED_TABLES and item.id is None:
+            pending.setdefault(table_name, []).append(item)
+    for table_name, items in pending.items():
+        items.sort(key=lambda item: inspect(item).insert_order)
+        for item, row_id in zip(items, id_allocator.allocate(table_name, len(items))):
+            item.id = row_id
+
+
+def _build_shard_tables():
+    """Copy the sharded tables without foreign keys (their targets stay on the primary)."""
+    from models import SensorData, UserAction
+    metadata = MetaData()
+    for model in (SensorData, UserAction):
+        source = model.__table__
+        table = Table(source.name, metadata, *[
+            Column(column.name, column.type, primary_key=column.primary_key, nullable=column.nullable)
+            for column in source.columns
+        ])
+        for index in source.indexes:
+            Index(index.name, *[table.c[column.name] for column in index.columns], unique=index.unique)
+    return metadata
+
+
+def create_tables():
+    """Create the sharded tables on every shard."""
+    for engine in shard_map.engines:
+        _shard_tables.create_all(engine)
+
+
+def drop_tables():
+    """Drop the sharded tables from every shard."""
+    for engine in shard_map.engines:
+        _shard_tables.drop_all(engine)
+
+
+def _copy_rows(source, target, table, device_ids, after_id=0, batch_size=5000):
+    """Copy rows of `device_ids` with ids above `after_id` that the target lacks.
+
+    Returns (rows copied, highest id seen).
+    """
+    copied, last_id = 0, after_id
+    while True:
+        with source.connect() as connection:
+            rows = connection.execute(
+                select(table).where(table.c.device_id.in_(device_ids), table.c.id > last_id)
+                .order_by(table.c.id).limit(batch_size)
+            ).mappings().all()
+        if not rows:
+            return copied, last_id
+        last_id = rows[-1]['id']
+        with target.begin() as connection:
+            present = set(connection.execute(
+                select(table.c.id).where(table.c.id.in_([row['id'] for row in rows]))
+            ).scalars())
+            missing = [dict(row) for row in rows if row['id'] not in present]
+            if missing:
+                connection.execute(insert(table), missing)
+        copied += len(missing)
+
+
+def _sync_statuses(source, target, table, device_ids):
+    """Copy the status of actions still pending on the target (acknowledged meanwhile)."""
+    with target.connect() as connection:
+        pending = list(connection.execute(
+            select(table.c.id).where(table.c.device_id.in_(device_ids), table.c.status == 'pending')
+        ).scalars())
+    if not pending:
+        return
+    with source.connect() as connection:
+        statuses = connection.execute(
+            select(table.c.id, table.c.status).where(table.c.id.in_(pending), table.c.status != 'pending')
+        ).all()
+    with target.begin() as connection:
+        for row_id, status in statuses:
+            connection.execute(update(table).where(table.c.id == row_id).values(status=status))
+
+
+def move_home(home_id, target, from_primary=False, log=logger.info):
+    """Move a home's sensor data and user actions to shard `target`.
+
+    1. copy the rows to the target,
+    2. record the target in home_shards; every process routes the home's
+       reads and writes there once its shard map is reloaded,
+    3. wait out SHARD_MAP_TTL, then copy the rows written in the meantime,
+    4. delete the rows from the source.
+
+    With `from_primary` the rows are taken from the primary database (data
+    written before sharding was enabled). Copies skip rows the target already
+    has, so an interrupted move can be run again. Status changes of existing
+    rows during step 3 are only carried over for pending user actions.
+    """
+    from models import Device, Room, Floor, HomeShard
+    if not 0 <= target < shard_map.count:
+        raise ValueError(f'No shard {target}; shards are 0..{shard_map.count - 1}')
+    source_shard = None if from_primary else shard_map.home_shard(home_id)
+    if source_shard == target:
+        raise ValueError(f'Home {home_id} is already on shard {target}')
+    source = shard_map.engines[source_shard] if source_shard is not None else shard_map.primary
+    target_engine = shard_map.engines[target]
+    with shard_map.primary.connect() as connection:
+        device_ids = list(connection.execute(
+            select(Device.device_id).join(Room, Device.room_id == Room.id)
+            .join(Floor, Room.floor_id == Floor.id).where(Floor.home_id == home_id)
+        ).scalars())
+    tables = [_shard_tables.tables[name] for name in sorted(SHARDED_TABLES)]
+
+    last_ids = {}
+    for table in tables:
+        copied, last_ids[table.name] = _copy_rows(source, target_engine, table, device_ids)
+        log(f"{table.name}: {copied} row(s) copied")
+
+    with shard_map.primary.begin() as connection:
+        moved = HomeShard.__table__
+        values = {'shard': target, 'moved_at': datetime.utcnow()}
+        if not connection.execute(update(moved).where(moved.c.home_id == home_id).values(**values)).rowcount:
+            connection.execute(insert(moved).values(home_id=home_id, **values))
+    shard_map.invalidate()
+    log(f"Home {home_id} now routed to shard {target}; waiting {shard_map.ttl:g}s for every process")
+    time.sleep(shard_map.ttl + 1)
+
+    for table in tables:
+        copied, _ = _copy_rows(source, target_engine, table, device_ids, last_ids[table.name])
+        log(f"{table.name}: {copied} row(s) written during the move copied")
+    _sync_statuses(source, target_engine, _shard_tables.tables['user_actions'], device_ids)
+
+    with source.begin() as connection:
+        for table in tables:
+            deleted = connection.execute(delete(table).where(table.c.device_id.in_(device_ids))).rowcount
+            log(f"{table.name}: {deleted} row(s) deleted from the source")
+
+
+def init_app(app, db):
+    """Route the sharded tables to the SHARD_DATABASE_URLS binds, if any."""
+    global _shard_tables
+    shard_map.count = len(app.config.get('SHARD_DATABASE_URLS') or [])
+    if not shard_map.enabled:
+        return
+    shard_map.ttl = app.config.get('SHARD_MAP_TTL', 30.0)
+    _shard_tables = _build_shard_tables()
+    with app.app_context():
+        missing = [shard_key(shard) for shard in range(shard_map.count) if shard_key(shard) not in db.engines]
+        if missing:
+            raise RuntimeError(f"SQLALCHEMY_BINDS lacks the shard binds {', '.join(missing)}")
+        shard_map.primary = db.engines[None]
+        shard_map.engines = [db.engines[shard_key(shard)] for shard in range(shard_map.count)]
+    shard_map.invalidate()
+    logger.info(f"Sensor data and user actions sharded across {shard_map.count} database(s)")
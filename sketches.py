@@ -0,0 +1,140 @@
+"""Mergeable summaries of sensor readings.
+
+DDSketch answers quantile queries with a bounded relative error and
+RunningStats keeps count, mean, variance, min and max with Welford's
+algorithm. Both can be merged, so per-device, per-hour summaries can be
+combined to describe any window or set of devices without rescanning the
+raw readings.
+"""
+import json
+import math
+
+# Quantiles are accurate to within 1% of the true value
+DEFAULT_RELATIVE_ACCURACY = 0.01
+# Values closer to zero than this are counted in the zero bucket
+MIN_INDEXABLE_VALUE = 1e-9
+
+
+class DDSketch:
+    """Quantile sketch with relative-error guarantees (Masson et al., 2019)."""
+
+    def __init__(self, relative_accuracy=DEFAULT_RELATIVE_ACCURACY):
+        self.relative_accuracy = relative_accuracy
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self._log_gamma = math.log(self.gamma)
+        self.positive = {}
+        self.negative = {}
+        self.zero_count = 0
+        self.count = 0
+
+    def _index(self, value):
+        return math.ceil(math.log(value) / self._log_gamma)
+
+    def _value(self, index):
+        return 2 * self.gamma ** index / (self.gamma + 1)
+
+    def add(self, value, count=1):
+        if value > MIN_INDEXABLE_VALUE:
+            index = self._index(value)
+            self.positive[index] = self.positive.get(index, 0) + count
+        elif value < -MIN_INDEXABLE_VALUE:
+            index = self._index(-value)
+            self.negative[index] = self.negative.get(index, 0) + count
+        else:
+            self.zero_count += count
+        self.count += count
+
+    def merge(self, other):
+        if other.relative_accuracy != self.relative_accuracy:
+            raise ValueError('Cannot merge sketches with different relative accuracy')
+        for index, count in other.positive.items():
+            self.positive[index] = self.positive.get(index, 0) + count
+        for index, count in other.negative.items():
+            self.negative[index] = self.negative.get(index, 0) + count
+        self.zero_count += other.zero_count
+        self.count += other.count
+        return self
+
+    def quantile(self, q):
+        """Return the estimated q-quantile (0 <= q <= 1), or None if empty."""
+        if not self.count:
+            return None
+        rank = q * (self.count - 1)
+        seen = 0
+        # Most negative values first, then zeros, then positive values
+        for index in sorted(self.negative, reverse=True):
+            seen += self.negative[index]
+            if seen > rank:
+                return -self._value(index)
+        seen += self.zero_count
+        if seen > rank:
+            return 0.0
+        for index in sorted(self.positive):
+            seen += self.positive[index]
+            if seen > rank:
+                return self._value(index)
+        return self._value(max(self.positive)) if self.positive else 0.0
+
+    def to_json(self):
+        return json.dumps({
+            'a': self.relative_accuracy,
+            'p': self.positive,
+            'n': self.negative,
+            'z': self.zero_count
+        }, separators=(',', ':'))
+
+    @classmethod
+    def from_json(cls, text):
+        data = json.loads(text)
+        sketch = cls(data['a'])
+        sketch.positive = {int(index): count for index, count in data['p'].items()}
+        sketch.negative = {int(index): count for index, count in data['n'].items()}
+        sketch.zero_count = data['z']
+        sketch.count = sum(sketch.positive.values()) + sum(sketch.negative.values()) + sketch.zero_count
+        return sketch
+
+
+class RunningStats:
+    """Count, mean, variance, min and max using Welford's online algorithm."""
+
+    def __init__(self, count=0, mean=0.0, m2=0.0, minimum=None, maximum=None):
+        self.count = count
+        self.mean = mean
+        self.m2 = m2
+        self.min = minimum
+        self.max = maximum
+
+    def add(self, value):
+        self.count += 1
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (value - self.mean)
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+
+    def merge(self, other):
+        """Combine with another RunningStats (Chan et al. parallel variance)."""
+        if not other.count:
+            return self
+        if not self.count:
+            self.count, self.mean, self.m2 = other.count, other.mean, other.m2
+            self.min, self.max = other.min, other.max
+            return self
+        count = self.count + other.count
+        delta = other.mean - self.mean
+        self.mean += delta * other.count / count
+        self.m2 += other.m2 + delta * delta * self.count * other.count / count
+        self.count = count
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        return self
+
+    @property
+    def variance(self):
+        """Population variance of the values seen so far."""
+        return self.m2 / self.count if self.count else None
+
+    @property
+    def std_dev(self):
+        variance = self.variance
+        return math.sqrt(max(variance, 0.0)) if variance is not None else None
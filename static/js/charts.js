@@ -169,6 +169,13 @@ function getYAxisTitle(deviceType) {
     }
 }
 
+// Ask the data API for the columnar response format
+function withColumnarFormat(url) {
+    const parsed = new URL(url, window.location.origin);
+    parsed.searchParams.set('format', 'columnar');
+    return parsed.pathname + parsed.search;
+}
+
 // Load historical data for a device
 function loadHistoricalData(deviceId, url) {
     // Show loading indicator if exists
@@ -180,27 +187,16 @@ function loadHistoricalData(deviceId, url) {
         }
     }
     
-    // Fetch data from API
-    fetch(url)
+    // Fetch data from API as parallel arrays (oldest first)
+    fetch(withColumnarFormat(url))
         .then(response => response.json())
         .then(result => {
-            if (result.success && result.data && result.data.length > 0) {
-                // Process and add data to chart
-                const data = result.data;
-                
-                // Clear existing data
-                chartData[deviceId].labels = [];
-                chartData[deviceId].datasets[0].data = [];
-                
-                // Add data points (limited to maxDataPoints)
-                const pointsToAdd = Math.min(data.length, maxDataPoints);
-                for (let i = 0; i < pointsToAdd; i++) {
-                    const point = data[data.length - 1 - i]; // Start from the most recent
-                    
-                    // Add data point
-                    chartData[deviceId].labels.unshift(new Date(point.timestamp));
-                    chartData[deviceId].datasets[0].data.unshift(point.value);
-                }
+            const series = result.success && result.series ? result.series[0] : null;
+            if (series && series.timestamps.length > 0) {
+                // Keep the most recent maxDataPoints points
+                const start = Math.max(series.timestamps.length - maxDataPoints, 0);
+                chartData[deviceId].labels = series.timestamps.slice(start).map(ms => new Date(ms));
+                chartData[deviceId].datasets[0].data = series.values.slice(start);
                 
                 // Update chart
                 deviceCharts[deviceId].update();
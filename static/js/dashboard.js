@@ -1754,30 +1754,55 @@ function createFloorStructure() {
 
 // Initialize charts
 function initializeCharts() {
-  // Find all chart containers
-  const chartContainers = document.querySelectorAll("[data-chart-device]");
+  // Find all chart containers and load their data with one request
+  const chartContainers = Array.from(
+    document.querySelectorAll("[data-chart-device]")
+  ).filter((container) => container.id);
 
-  chartContainers.forEach((container) => {
-    const deviceId = container.getAttribute("data-chart-device");
-    const chartType = container.getAttribute("data-chart-type") || "line";
+  loadChartsData(chartContainers);
+}
 
-    if (deviceId && container.id) {
-      // Load data for this device only if it belongs to the user
-      loadDeviceData(deviceId, container.id, chartType);
-    }
-  });
+// Devices per /api/data/series request (the server's SERIES_MAX_DEVICES)
+const SERIES_MAX_DEVICES = 200;
+
+// Fetch recent readings for several devices from the batch series endpoint,
+// SERIES_MAX_DEVICES at a time. Resolves to
+// {deviceId: [{timestamp, value}, ...]}, newest first; devices the server
+// denied are left out.
+function fetchDeviceSeries(deviceIds, params) {
+  const chunks = [];
+  for (let i = 0; i < deviceIds.length; i += SERIES_MAX_DEVICES) {
+    chunks.push(deviceIds.slice(i, i + SERIES_MAX_DEVICES));
+  }
+  return Promise.all(
+    chunks.map((chunk) =>
+      // A failed chunk only leaves its own charts empty
+      fetchDeviceSeriesChunk(chunk, params).catch((error) => {
+        console.error(`Error loading series of ${chunk.length} device(s):`, error);
+        return {};
+      })
+    )
+  ).then((results) => Object.assign({}, ...results));
 }
 
-// Update loadDeviceData to use the existing API endpoint
-function loadDeviceData(deviceId, containerId, chartType) {
-  // Use the existing '/api/devices/{deviceId}/data' endpoint
-  fetch(`/api/devices/${deviceId}/data?days=1&limit=100`, {
+function fetchDeviceSeriesChunk(deviceIds, params) {
+  const query = new URLSearchParams({
+    ...params,
+    device_ids: deviceIds.join(","),
+  });
+  const token = localStorage.getItem("access_token");
+  const headers = {
+    Accept: "application/json",
+    "X-Requested-With": "XMLHttpRequest",
+  };
+  if (token) {
+    headers.Authorization = `Bearer ${token}`;
+  }
+
+  return fetch(`/api/data/series?${query}`, {
     method: "GET",
     credentials: "same-origin",
-    headers: {
-      Accept: "application/json",
-      "X-Requested-With": "XMLHttpRequest",
-    },
+    headers: headers,
   })
     .then((response) => {
       if (!response.ok) {
@@ -1785,26 +1810,66 @@ function loadDeviceData(deviceId, containerId, chartType) {
       }
       return response.json();
     })
-    .then((data) => {
-      if (data.success) {
-        // Store in the global namespace
-        if (!window.smartHome.deviceData[deviceId]) {
-          window.smartHome.deviceData[deviceId] = [];
-        }
-        window.smartHome.deviceData[deviceId] = data.data;
-        createChart(containerId, deviceId, data.data, chartType);
-      } else {
-        console.error(
-          `Error loading data for device ${deviceId}:`,
-          data.message || "Unknown error"
-        );
+    .then((result) => {
+      if (!result.success) {
+        throw new Error(result.message || "Unknown error");
       }
+      if (result.denied && result.denied.length) {
+        console.warn(`No access to device(s): ${result.denied.join(", ")}`);
+      }
+      const seriesByDevice = {};
+      result.series.forEach((series) => {
+        const rows = [];
+        for (let i = series.timestamps.length - 1; i >= 0; i--) {
+          rows.push({
+            timestamp: new Date(series.timestamps[i]).toISOString(),
+            value: series.values[i],
+          });
+        }
+        seriesByDevice[series.device_id] = rows;
+      });
+      return seriesByDevice;
+    });
+}
+
+// Load and draw the charts in the given containers
+function loadChartsData(containers) {
+  const deviceIds = [
+    ...new Set(
+      containers.map((container) => container.getAttribute("data-chart-device"))
+    ),
+  ];
+  if (deviceIds.length === 0) return;
+
+  fetchDeviceSeries(deviceIds, { days: 1, limit: 100 })
+    .then((seriesByDevice) => {
+      containers.forEach((container) => {
+        const deviceId = container.getAttribute("data-chart-device");
+        const chartType = container.getAttribute("data-chart-type") || "line";
+        const data = seriesByDevice[deviceId] || [];
+
+        // Store in the global namespace
+        window.smartHome.deviceData[deviceId] = data;
+        createChart(container.id, deviceId, data, chartType);
+      });
     })
     .catch((error) => {
-      console.error(`Error loading data for device ${deviceId}:`, error);
+      console.error(`Error loading chart data for ${deviceIds.length} device(s):`, error);
     });
 }
 
+// Load the chart of a single device
+function loadDeviceData(deviceId, containerId, chartType) {
+  const container = document.getElementById(containerId);
+  if (container) {
+    if (!container.getAttribute("data-chart-device")) {
+      container.setAttribute("data-chart-device", deviceId);
+    }
+    container.setAttribute("data-chart-type", chartType || "line");
+    loadChartsData([container]);
+  }
+}
+
 function createChart(containerId, deviceId, data, chartType) {
   const container = document.getElementById(containerId);
   if (!container) return;
@@ -1856,18 +1921,18 @@ function createChart(containerId, deviceId, data, chartType) {
 }
 
 function refreshChartData() {
-  // Refresh all charts
+  // Refresh all charts with one request
+  const chartContainers = [];
   for (const deviceId in window.smartHome.deviceData) {
-    const chartContainers = document.querySelectorAll(
-      `[data-chart-device="${deviceId}"]`
-    );
-    chartContainers.forEach((container) => {
-      if (container.id) {
-        const chartType = container.getAttribute("data-chart-type") || "line";
-        loadDeviceData(deviceId, container.id, chartType);
-      }
-    });
+    document
+      .querySelectorAll(`[data-chart-device="${deviceId}"]`)
+      .forEach((container) => {
+        if (container.id) {
+          chartContainers.push(container);
+        }
+      });
   }
+  loadChartsData(chartContainers);
 }
 
 // Function that can be called from socket_handler.js to update a chart with new data
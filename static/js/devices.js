@@ -699,18 +699,21 @@ function loadDeviceChart(deviceId, deviceType) {
     const chartContainer = document.getElementById('deviceDetailsChart');
     if (!chartContainer) return;
     
-    fetch(`/api/devices/${deviceId}/data?days=1&limit=24`)
+    const token = localStorage.getItem('access_token');
+    fetch(`/api/data/series?device_ids=${encodeURIComponent(deviceId)}&days=1&limit=24`, {
+        headers: token ? { 'Authorization': `Bearer ${token}` } : {}
+    })
         .then(response => response.json())
         .then(data => {
-            if (data.success && data.data.length > 0) {
-                const chartData = data.data.reverse(); // Reverse to get chronological order
-                
-                const timestamps = chartData.map(item => {
-                    const date = new Date(item.timestamp);
+            // Series arrays are already in chronological order
+            const series = data.success && data.series ? data.series[0] : null;
+            if (series && series.timestamps.length > 0) {
+                const timestamps = series.timestamps.map(ms => {
+                    const date = new Date(ms);
                     return date.getHours() + ':' + date.getMinutes().toString().padStart(2, '0');
                 });
                 
-                const values = chartData.map(item => item.value);
+                const values = series.values;
                 
                 let yAxisLabel = '';
                 let borderColor = '#007bff';
@@ -120,8 +120,49 @@ document.addEventListener('DOMContentLoaded', function() {
         // Auto-load data for selected device
         setTimeout(loadHistoricalData, 500);
     }
+    
+    // Device search (the page only renders the first devices)
+    let searchTimer = null;
+    document.getElementById('deviceSearch').addEventListener('input', function() {
+        clearTimeout(searchTimer);
+        searchTimer = setTimeout(() => searchDevices(this.value), 200);
+    });
 });
 
+/**
+ * Replace the device picker options with the devices matching a search
+ */
+function searchDevices(query) {
+    const url = `/api/devices/search?q=${encodeURIComponent(query.trim())}&limit=20`;
+    fetch(url)
+        .then(response => response.json())
+        .then(result => {
+            if (!result.success) {
+                throw new Error(result.message || 'Device search failed');
+            }
+            const deviceSelect = document.getElementById('deviceSelect');
+            const selected = deviceSelect.options[deviceSelect.selectedIndex];
+            // Keep "All Devices" and the current selection
+            for (let i = deviceSelect.options.length - 1; i > 0; i--) {
+                if (deviceSelect.options[i] !== selected) {
+                    deviceSelect.remove(i);
+                }
+            }
+            result.devices.forEach(device => {
+                if (selected && selected.value === device.device_id) {
+                    return;
+                }
+                const option = document.createElement('option');
+                option.value = device.device_id;
+                option.textContent = `${device.name} (${device.room || device.device_id})`;
+                deviceSelect.appendChild(option);
+            });
+        })
+        .catch(error => {
+            console.error('Error searching devices:', error);
+        });
+}
+
 /**
  * Load historical data from the API
  */
@@ -0,0 +1,393 @@
+"""Approximate table statistics: row counts, sizes, time range and ingest rate.
+
+The admin dashboard used to COUNT(*) every table on each load. Statistics are
+instead refreshed every TABLE_STATS_REFRESH seconds by a background thread,
+with queries whose cost does not grow with the table:
+
+- rows: a count capped at TABLE_STATS_EXACT_LIMIT rows (exact for small
+  tables), then the engine's own estimate (sqlite_stat1, pg_class.reltuples,
+  information_schema.tables.table_rows), then the range of an integer
+  primary key,
+- table and index bytes: pg_table_size()/pg_indexes_size(), data_length and
+  index_length, or SQLite's dbstat table. dbstat reads every page of the
+  table, so on SQLite sizes are refreshed every TABLE_STATS_SIZE_REFRESH
+  seconds only,
+- oldest and newest: the timestamp (or created_at) of the rows with the
+  lowest and highest primary key.
+
+On SQLite, sqlite_stat1 only changes when a table is analyzed, so the
+refresh thread analyzes every large table on each refresh, with
+analysis_limit=TABLE_STATS_ANALYZE_LIMIT bounding the rows ANALYZE reads.
+Such an ANALYZE samples and tends to undercount, so the range of an integer
+primary key is used when it is larger.
+
+Between refreshes, the rows inserted and deleted by committed statements of
+this process are added to the counts, and newer timestamps move `newest`.
+The ingest rate is the rows per second committed by this process over the
+last TABLE_STATS_RATE_WINDOW seconds. Sharded tables add up their shards.
+"""
+import time
+import logging
+import threading
+from collections import deque
+from datetime import datetime
+
+from sqlalchemy import event, select, func, literal, text
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.sql.dml import Insert, Delete
+
+import sharding
+
+# Get logger
+logger = logging.getLogger('smart_home.table_stats')
+
+_CHANGES_KEY = 'table_stats_changes'
+TIME_COLUMNS = ('timestamp', 'created_at')
+
+
+def time_column(table):
+    """Return the column that records when a row was written, or None."""
+    for name in TIME_COLUMNS:
+        if name in table.columns:
+            return table.columns[name]
+    return None
+
+
+def is_leading_index_column(table, column):
+    """Return True if an index of `table` starts with `column` (min/max are a single lookup)."""
+    return any(list(index.columns)[0] is column for index in table.indexes)
+
+
+def sqlite_metadata(connection, table_name, sizes=False, analyze_limit=0):
+    """Return (rows, table bytes, index bytes) known to SQLite; unknown values are None."""
+    def stat_rows():
+        if not connection.execute(text(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'sqlite_stat1'"
+        )).first():
+            return None
+        stats = connection.execute(
+            text('SELECT stat FROM sqlite_stat1 WHERE tbl = :name'), {'name': table_name}
+        ).scalars().all()
+        # The first number of each stat is the row count of the table or index
+        return max((int(stat.split()[0]) for stat in stats if stat), default=None)
+
+    if analyze_limit:
+        connection.execute(text(f'PRAGMA analysis_limit={int(analyze_limit)}'))
+        connection.execute(text(f'ANALYZE "{table_name}"'))
+        connection.commit()
+        logger.debug(f"Analyzed {table_name}")
+    rows = stat_rows()
+    table_bytes = index_bytes = None
+    if sizes:
+        try:
+            table_bytes = connection.execute(
+                text('SELECT SUM(pgsize) FROM dbstat WHERE name = :name'), {'name': table_name}
+            ).scalar()
+            index_bytes = connection.execute(text(
+                "SELECT SUM(pgsize) FROM dbstat WHERE name IN "
+                "(SELECT name FROM sqlite_master WHERE type = 'index' AND tbl_name = :name)"
+            ), {'name': table_name}).scalar() or 0
+        except DBAPIError:
+            # SQLite built without SQLITE_ENABLE_DBSTAT_VTAB
+            pass
+    return rows, table_bytes, index_bytes
+
+
+def postgresql_metadata(connection, table_name, **options):
+    row = connection.execute(text(
+        'SELECT reltuples, pg_table_size(oid), pg_indexes_size(oid) FROM pg_class '
+        'WHERE oid = to_regclass(:name)'
+    ), {'name': table_name}).first()
+    if row is None:
+        return None, None, None
+    # reltuples is -1 (0 before PostgreSQL 14) until the table is vacuumed or analyzed
+    rows = int(row[0]) if row[0] > 0 else None
+    return rows, row[1], row[2]
+
+
+def mysql_metadata(connection, table_name, **options):
+    row = connection.execute(text(
+        'SELECT table_rows, data_length, index_length FROM information_schema.tables '
+        'WHERE table_schema = DATABASE() AND table_name = :name'
+    ), {'name': table_name}).first()
+    return tuple(row) if row is not None else (None, None, None)
+
+
+METADATA = {
+    'sqlite': sqlite_metadata,
+    'postgresql': postgresql_metadata,
+    'mysql': mysql_metadata,
+    'mariadb': mysql_metadata,
+}
+
+
+class TableStats:
+    """Statistics of one table, as of its last refresh plus the changes committed since."""
+    __slots__ = ('name', 'rows', 'source', 'table_bytes', 'index_bytes', 'oldest', 'newest',
+                 'refreshed_at', 'inserted', 'deleted', 'recent')
+
+    def __init__(self, name):
+        self.name = name
+        self.rows = None
+        self.source = None
+        self.table_bytes = None
+        self.index_bytes = None
+        self.oldest = None
+        self.newest = None
+        self.refreshed_at = None
+        # Rows committed by this process since the refresh
+        self.inserted = 0
+        self.deleted = 0
+        # [second, rows inserted in that second], oldest first
+        self.recent = deque()
+
+    def count(self):
+        if self.rows is None:
+            return None
+        return max(self.rows + self.inserted - self.deleted, 0)
+
+    def ingest_rate(self, window, now):
+        since = int(now) - window
+        return sum(rows for second, rows in self.recent if second > since) / window
+
+    def to_dict(self, window, now):
+        return {
+            'table': self.name,
+            'rows': self.count(),
+            'rows_exact': self.source == 'exact' and not (self.inserted or self.deleted),
+            'rows_source': self.source,
+            'table_bytes': self.table_bytes,
+            'index_bytes': self.index_bytes,
+            'oldest': self.oldest.isoformat() if self.oldest else None,
+            'newest': self.newest.isoformat() if self.newest else None,
+            'ingest_rate': round(self.ingest_rate(window, now), 3),
+            'refreshed_at': self.refreshed_at.isoformat() if self.refreshed_at else None,
+        }
+
+
+class StatisticsService:
+    """Keeps TableStats for every model table."""
+
+    def __init__(self, refresh=300.0, size_refresh=3600.0, exact_limit=10000, rate_window=60,
+                 analyze_limit=1000):
+        self.enabled = False
+        self.refresh = refresh
+        self.size_refresh = size_refresh
+        self.exact_limit = exact_limit
+        self.rate_window = rate_window
+        self.analyze_limit = analyze_limit
+        self.loaded_at = None
+        self.sized_at = None
+        self._tables = {}
+        self._models = {}
+        self._lock = threading.Lock()
+
+    def configure(self, models):
+        """Track the tables of `models` ({model name: model class})."""
+        with self._lock:
+            self._models = dict(models)
+            self._tables = {model.__tablename__: TableStats(model.__tablename__) for model in models.values()}
+
+    def record(self, changes, now=None):
+        """Add committed (table name, rows inserted, rows deleted, newest timestamp) changes."""
+        now = time.time() if now is None else now
+        second = int(now)
+        with self._lock:
+            for table_name, inserted, deleted, newest in changes:
+                stats = self._tables.get(table_name)
+                if stats is None:
+                    continue
+                stats.inserted += inserted
+                stats.deleted += deleted
+                if newest is not None and (stats.newest is None or newest > stats.newest):
+                    stats.newest = newest
+                if inserted:
+                    recent = stats.recent
+                    if recent and recent[-1][0] == second:
+                        recent[-1][1] += inserted
+                    else:
+                        recent.append([second, inserted])
+                        while recent[0][0] <= second - self.rate_window:
+                            recent.popleft()
+
+    def rows(self, table_name):
+        """Return the approximate row count of a table, or None if unknown."""
+        stats = self._tables.get(table_name)
+        return stats.count() if stats is not None else None
+
+    def _engines(self, table_name, db):
+        if table_name in sharding.SHARDED_TABLES and sharding.shard_map.enabled:
+            return sharding.shard_map.engines
+        return [db.engine]
+
+    def _measure(self, connection, table, sizes, analyze):
+        """Return (rows, source, table bytes, index bytes, oldest, newest) of a table on one database."""
+        key = list(table.primary_key.columns)[0]
+        capped = select(literal(1)).select_from(table).limit(self.exact_limit + 1).subquery()
+        rows = connection.execute(select(func.count()).select_from(capped)).scalar()
+        source = 'exact'
+        metadata = METADATA.get(connection.dialect.name)
+        table_bytes = index_bytes = None
+        if metadata is not None:
+            try:
+                metadata_rows, table_bytes, index_bytes = metadata(
+                    connection, table.name, sizes=sizes,
+                    analyze_limit=self.analyze_limit if analyze and rows > self.exact_limit else 0
+                )
+            except DBAPIError:
+                logger.exception(f"Reading {connection.dialect.name} statistics of {table.name} failed")
+                connection.rollback()
+                metadata_rows = None
+            if rows > self.exact_limit and metadata_rows is not None:
+                rows, source = max(metadata_rows, rows), connection.dialect.name
+        if rows > self.exact_limit and source == 'exact':
+            source = 'key_range'
+        # Also a floor under SQLite's estimate: a bounded ANALYZE tends to undercount
+        if source in ('key_range', 'sqlite') and key.type.python_type is int:
+            low, high = connection.execute(select(func.min(key), func.max(key))).one()
+            rows = max(high - low + 1, rows)
+        oldest = newest = None
+        column = time_column(table)
+        if column is not None and (source == 'exact' or is_leading_index_column(table, column)):
+            oldest, newest = connection.execute(select(func.min(column), func.max(column))).one()
+        elif column is not None:
+            # Rows are numbered in the order they are written
+            oldest = connection.execute(
+                select(column).where(key == select(func.min(key)).scalar_subquery())
+            ).scalar()
+            newest = connection.execute(
+                select(column).where(key == select(func.max(key)).scalar_subquery())
+            ).scalar()
+        return rows, source, table_bytes, index_bytes, oldest, newest
+
+    def load(self, db, sizes=False, analyze=False):
+        """Refresh every table's statistics from the database(s); return False if a table failed.
+
+        SQLite sizes are only read with `sizes`; until then the previous ones are kept.
+        """
+        started = time.monotonic()
+        refreshed = {}
+        failed = []
+        for table_name in list(self._tables):
+            table = db.metadata.tables[table_name]
+            totals = [0, 'exact', None, None, None, None]
+            try:
+                measures = []
+                for engine in self._engines(table_name, db):
+                    with engine.connect() as connection:
+                        measures.append(self._measure(connection, table, sizes, analyze))
+            except DBAPIError as e:
+                # e.g. a table not created yet; its previous statistics are kept
+                logger.warning(f"Reading statistics of {table_name} failed: {e.orig}")
+                failed.append(table_name)
+                continue
+            for rows, source, table_bytes, index_bytes, oldest, newest in measures:
+                totals[0] += rows
+                if source != 'exact':
+                    totals[1] = source
+                if table_bytes is not None:
+                    totals[2] = (totals[2] or 0) + table_bytes
+                    totals[3] = (totals[3] or 0) + (index_bytes or 0)
+                if oldest is not None and (totals[4] is None or oldest < totals[4]):
+                    totals[4] = oldest
+                if newest is not None and (totals[5] is None or newest > totals[5]):
+                    totals[5] = newest
+            refreshed[table_name] = totals
+        now = datetime.utcnow()
+        with self._lock:
+            for table_name, (rows, source, table_bytes, index_bytes, oldest, newest) in refreshed.items():
+                stats = self._tables[table_name]
+                # An engine estimate that did not change may predate the changes since
+                reanalyzed = analyze and source == 'sqlite'
+                if reanalyzed or source in ('exact', 'key_range') or (rows, source) != (stats.rows, stats.source):
+                    stats.inserted = stats.deleted = 0
+                stats.rows, stats.source = rows, source
+                if table_bytes is not None or sizes:
+                    stats.table_bytes, stats.index_bytes = table_bytes, index_bytes
+                stats.oldest, stats.newest = oldest, newest
+                stats.refreshed_at = now
+            if not failed:
+                self.loaded_at = time.monotonic()
+        logger.info(f"Refreshed statistics of {len(refreshed)} table(s) in {time.monotonic() - started:.3f}s")
+        return not failed
+
+    def snapshot(self, db, now=None):
+        """Return the statistics of every table, loading them if they were never loaded or are stale."""
+        if self.loaded_at is None or time.monotonic() - self.loaded_at >= 2 * self.refresh:
+            # The refresh thread is off or behind; the capped queries keep this bounded
+            self.load(db)
+        now = time.time() if now is None else now
+        with self._lock:
+            return {
+                name: {'name': name, **self._tables[model.__tablename__].to_dict(self.rate_window, now)}
+                for name, model in self._models.items()
+            }
+
+    def run(self, app, db):
+        while True:
+            complete = False
+            try:
+                with app.app_context():
+                    sizes = bool(self.size_refresh) and (
+                        self.sized_at is None or time.monotonic() - self.sized_at >= self.size_refresh
+                    )
+                    complete = self.load(db, sizes=sizes, analyze=True)
+                    if sizes and complete:
+                        self.sized_at = time.monotonic()
+            except Exception:
+                logger.exception('Refreshing table statistics failed')
+            # Retry soon after a failure, e.g. when started before the tables were created
+            time.sleep(self.refresh if complete else min(self.refresh, 10))
+
+
+service = StatisticsService()
+
+
+@event.listens_for(Engine, 'after_execute')
+def _collect_changes(conn, clauseelement, multiparams, params, execution_options, result):
+    if not service.enabled or not isinstance(clauseelement, (Insert, Delete)):
+        return
+    table = clauseelement.table
+    if isinstance(clauseelement, Delete):
+        change = (table.name, 0, max(result.rowcount, 0), None)
+    else:
+        rows = multiparams or [params]
+        column = time_column(table) if table.name in service._tables else None
+        newest = None
+        if column is not None:
+            newest = max((row[column.key] for row in rows if row and row.get(column.key) is not None),
+                         default=None)
+        change = (table.name, len(multiparams) or 1, 0, newest if isinstance(newest, datetime) else None)
+    conn.info.setdefault(_CHANGES_KEY, []).append(change)
+
+
+@event.listens_for(Engine, 'commit')
+def _apply_changes(conn):
+    changes = conn.info.pop(_CHANGES_KEY, None)
+    if changes:
+        service.record(changes)
+
+
+@event.listens_for(Engine, 'rollback')
+def _discard_changes(conn):
+    conn.info.pop(_CHANGES_KEY, None)
+
+
+def init_app(app, db):
+    """Keep approximate statistics of every model table for the admin dashboard."""
+    import inspect
+    import models
+
+    service.configure({
+        name: obj for name, obj in inspect.getmembers(models)
+        if inspect.isclass(obj) and hasattr(obj, '__tablename__')
+    })
+    service.refresh = app.config.get('TABLE_STATS_REFRESH', 300.0)
+    service.size_refresh = app.config.get('TABLE_STATS_SIZE_REFRESH', 3600.0)
+    service.exact_limit = app.config.get('TABLE_STATS_EXACT_LIMIT', 10000)
+    service.rate_window = app.config.get('TABLE_STATS_RATE_WINDOW', 60)
+    service.analyze_limit = app.config.get('TABLE_STATS_ANALYZE_LIMIT', 1000)
+    service.enabled = app.config.get('TABLE_STATS_ENABLED', True)
+    if service.enabled:
+        threading.Thread(target=service.run, args=(app, db), name='table-stats', daemon=True).start()